@@ -0,0 +1,162 @@
+"""
+Tree level amplitudes for scalar theories, evaluated on whole batches of phase space points.
+"""
+import numpy
+from PerturbationLib.Theory import Theory, Field
+from PerturbationLib.Feynman import Feynman, Diagram
+from typing import Mapping, Sequence, List
+
+
+class TreeAmplitude:
+    """
+    Sum of tree diagrams for a process, compiled into arrays so that the amplitude for
+    many momentum configurations is a handful of NumPy operations.
+
+    Couplings are given by their symbols in the Lagrangian. The value given for a kinetic
+    term m_{f} is the coefficient of f\\bar{f}, the mass squared of f; fields without one
+    are massless. Interactions enter as written (coupling times fields), so each diagram is
+    multiplied by its Diagram.weight(). The amplitude is returned without the overall factor
+    of -i shared by all tree diagrams.
+
+    Only amputated diagrams are summed: those with a two point vertex on an external leg put
+    that leg's propagator on shell, where it diverges, and belong to the leg's normalization
+    rather than to the amplitude.
+    """
+    def __init__(self, theory: Theory, diagrams: Sequence[Diagram], couplings: Mapping[str, complex],
+                 widths: Mapping[str, float] = None):
+        """
+        :param theory: theory the diagrams were generated from
+        :param diagrams: diagrams for one process, as given by Feynman.listDiagrams
+        :param couplings: dict{coupling symbol: value}
+        :param widths: optional dict{field name: decay width} regulating propagator poles
+        """
+        self.diagrams = [d for d in diagrams if isTree(d) and isAmputated(d)]
+        if len(self.diagrams) == 0:
+            raise ValueError("No tree diagrams given.")
+        widths = widths or {}
+
+        mass2 = {}
+        for k in theory.getK():
+            if k.coupling in couplings:
+                mass2[k.fields[0].name] = float(numpy.real(couplings[k.coupling]))
+
+        externals = self.diagrams[0].externals
+        self.nlegs = len(externals)
+
+        coefficients, masses, indices, factors = [], [], [], []
+        for d in self.diagrams:
+            if [v.label for v in d.externals] != [v.label for v in externals]:
+                raise ValueError("Diagrams do not share the same external particles.")
+            factor = complex(d.weight())
+            for vertex in d.vertices:
+                if vertex.inter.coupling not in couplings:
+                    raise ValueError("No value given for coupling {}".format(vertex.inter.coupling))
+                factor *= couplings[vertex.inter.coupling]
+            factors.append(factor)
+
+            edgeindices = []
+            for coefficient, particle in propagatorMomenta(d):
+                name = particle.name
+                m2 = mass2.get(name, 0.0)
+                coefficients.append(coefficient)
+                masses.append(complex(m2, numpy.sqrt(max(m2, 0.0)) * widths.get(name, 0.0)))
+                edgeindices.append(len(coefficients) - 1)
+            indices.append(edgeindices)
+
+        # Diagrams with fewer propagators are padded with a column of ones
+        self.coefficients = numpy.array(coefficients, dtype=float).reshape(-1, self.nlegs)
+        self.masses = numpy.array(masses, dtype=complex)
+        maxedges = max(len(e) for e in indices)
+        self.indices = numpy.full((len(self.diagrams), maxedges), len(coefficients), dtype=int)
+        for i, e in enumerate(indices):
+            self.indices[i, :len(e)] = e
+        self.factors = numpy.array(factors, dtype=complex)
+
+    @classmethod
+    def fromProcess(cls, theory: Theory, startstate: Mapping[Field, int], endstate: Mapping[Field, int],
+                    couplings: Mapping[str, complex], widths: Mapping[str, float] = None) -> 'TreeAmplitude':
+        """
+        Generate the tree diagrams for a process and compile them.
+        Momenta are ordered as the particles of startstate followed by those of endstate.
+        :param theory: theory providing the interactions
+        :param startstate: incoming particles as dict{field: num_particles}
+        :param endstate: outgoing particles as dict{field: num_particles}
+        :param couplings: dict{coupling symbol: value}
+        :param widths: optional dict{field name: decay width}
+        :return: TreeAmplitude
+        """
+        feyn = Feynman(theory)
+        nlegs = sum(startstate.values()) + sum(endstate.values())
+        diagrams = feyn.listDiagrams(startstate, endstate, maxorder=max(nlegs - 2, 1))
+        return cls(theory, diagrams, couplings, widths)
+
+    def amplitude(self, momenta: numpy.ndarray) -> numpy.ndarray:
+        """
+        :param momenta: array of shape (N_points, n_legs, 4) of (E, px, py, pz)
+        :return: complex amplitudes of shape (N_points,)
+        """
+        momenta = numpy.asarray(momenta, dtype=float)
+        if momenta.ndim != 3 or momenta.shape[1:] != (self.nlegs, 4):
+            raise ValueError("Expected momenta of shape (N, {}, 4), got {}".format(self.nlegs, momenta.shape))
+        # Momentum through each propagator of each diagram: (N, n_propagators, 4)
+        p = numpy.einsum('el,nlm->nem', self.coefficients, momenta)
+        p2 = p[..., 0] ** 2 - numpy.sum(p[..., 1:] ** 2, axis=-1)
+        propagators = numpy.ones((len(momenta), len(self.masses) + 1), dtype=complex)
+        propagators[:, :-1] = 1.0 / (p2 - self.masses.real + 1j * self.masses.imag)
+        return numpy.prod(propagators[:, self.indices], axis=-1).dot(self.factors)
+
+    def __call__(self, momenta: numpy.ndarray) -> numpy.ndarray:
+        """
+        :param momenta: array of shape (N_points, n_legs, 4) of (E, px, py, pz)
+        :return: |M|^2 of shape (N_points,)
+        """
+        return numpy.abs(self.amplitude(momenta)) ** 2
+
+
+def isTree(diagram: Diagram) -> bool:
+    """
+    :return: true if the diagram is connected and has no loops
+    """
+    internal = [e for e in diagram.edges if not (e[0].isExternal() or e[1].isExternal())]
+    return diagram.isConnected() and len(internal) == len(diagram.vertices) - 1
+
+
+def isAmputated(diagram: Diagram) -> bool:
+    """
+    :param diagram: a tree diagram
+    :return: true if no internal line carries the momentum of a single external leg, i.e.
+    nothing is inserted on the external legs
+    """
+    nlegs = len(diagram.externals)
+    for coefficient, _ in propagatorMomenta(diagram):
+        if numpy.count_nonzero(coefficient) in (1, nlegs - 1):
+            return False
+    return True
+
+
+def propagatorMomenta(diagram: Diagram) -> List:
+    """
+    Momentum carried by each internal line of a tree diagram in terms of the external momenta.
+    Removing the line splits the tree in two, and the line carries everything flowing into
+    the side it leaves from. Incoming momenta count positively and outgoing negatively.
+    :param diagram: a tree diagram
+    :return: [(coefficient per external leg, particle)]
+    """
+    legs = {v: i for i, v in enumerate(diagram.externals)}
+    result = []
+    for source, sink, particle in diagram.edges:
+        if source.isExternal() or sink.isExternal():
+            continue
+        coefficient = numpy.zeros(len(legs))
+        seen = {source, sink}
+        stack = [source]
+        while stack:
+            v = stack.pop()
+            if v in legs:
+                coefficient[legs[v]] = 1.0 if v.incoming else -1.0
+            for other in v.vertex_paths:
+                if other not in seen:
+                    seen.add(other)
+                    stack.append(other)
+        result.append((coefficient, particle))
+    return result
@@ -0,0 +1,198 @@
+"""
+Benchmarks of the core engines, giving time and peak memory as each problem grows.
+
+    python -m PerturbationLib.Benchmark --output results.json
+    python -m PerturbationLib.Benchmark --baseline results.json
+
+Results are written as JSON, one record per case. When a baseline is given, cases
+slower (or using more memory) than the baseline by more than the tolerance are
+reported and the exit status is nonzero. Times shorter than --min-seconds in both runs are
+not compared, as at that scale the ratio measures timer and scheduling noise.
+"""
+import argparse
+import gc
+import json
+import sys
+import time
+import tracemalloc
+from typing import Callable, Generator, List, Mapping, Tuple
+
+from PerturbationLib.Feynman import Feynman
+from PerturbationLib.ParticleState import SingleState, State, XOp, COp, AOp
+from PerturbationLib.SUSymmetry import SU, Tableau, clearCombineCache
+from PerturbationLib.Symmetries import U, clearMemos
+from PerturbationLib.Theory import Theory, Field
+
+# A case is (benchmark name, parameters, setup) where setup() returns the callable to time
+Case = Tuple[str, Mapping, Callable[[], Callable[[], object]]]
+
+
+def makeTheory(nfields: int, trunc: int) -> Theory:
+    """
+    A U(1) x SU(2) theory with nfields scalars of increasing charge,
+    alternating between singlets and doublets.
+    """
+    usym = U(1)
+    susym = SU(2)
+    t = Theory(usym, susym, trunc=trunc)
+    for i in range(nfields):
+        t.addField(Field("f_{}".format(i), usym((i % 3,)), susym((i % 2,))))
+    return t
+
+
+def theoryCases(quick: bool) -> Generator[Case, None, None]:
+    for nfields in ([2, 3] if quick else [2, 3, 4, 5]):
+        for trunc in ([3, 4] if quick else [3, 4, 5]):
+            yield ("Theory.calculateL", {"fields": nfields, "trunc": trunc},
+                   lambda n=nfields, k=trunc: makeTheory(n, k).calculateL)
+
+
+def symmetryCases(quick: bool) -> Generator[Case, None, None]:
+    for N in ([2, 3] if quick else [2, 3, 4]):
+        for size in ([1, 2] if quick else [1, 2, 3]):
+            rep = tuple([size] + [0] * (N - 2))
+            conj = rep[::-1]
+            yield ("SU.combine", {"N": N, "irrep": list(rep)},
+                   lambda N=N, rep=rep, conj=conj: lambda: SU(N, multiplets=[rep]).combine(SU(N, multiplets=[conj])))
+            yield ("Tableau.combine", {"N": N, "irrep": list(rep)},
+                   lambda rep=rep, conj=conj: lambda: Tableau(rep=rep).combine(Tableau(rep=conj)))
+
+
+def feynmanCases(quick: bool) -> Generator[Case, None, None]:
+    theory = makeTheory(3, 4)
+    theory.calculateL()
+    start = {("f_2", False): 1}
+    end = {("f_1", False): 2}
+    yield ("Feynman.__init__", {"fields": 3, "trunc": 4}, lambda: lambda: Feynman(theory))
+    feyn = Feynman(theory)
+    for order in ([1, 2, 3] if quick else [1, 2, 3, 4, 5]):
+        yield ("Feynman.listPaths", {"order": order},
+               lambda k=order: lambda: sum(1 for _ in feyn.listPaths(start, end, maxorder=k)))
+
+
+def stateCases(quick: bool) -> Generator[Case, None, None]:
+    for nterms in ([5, 10, 20] if quick else [10, 30, 60]):
+        def setup(n=nterms):
+            state = State([SingleState([i % 4, (i // 4) % 4, i // 16]) for i in range(n)])
+            op = XOp(0) * XOp(1) + COp(2) * AOp(0)
+            return lambda: op * state
+        yield ("ParticleState.apply", {"terms": nterms}, setup)
+
+
+BENCHMARKS = [theoryCases, symmetryCases, feynmanCases, stateCases]
+
+
+def clearCaches():
+    """
+    Forget the symmetry products memoized by earlier runs, so every run does the work afresh
+    rather than the repeats timing memo lookups
+    """
+    clearMemos()
+    clearCombineCache()
+
+
+def measure(setup: Callable[[], Callable[[], object]], repeat: int) -> Tuple[float, int]:
+    """
+    :param setup: returns a fresh callable for each run, setup itself is not timed
+    :param repeat: number of timed runs, each starting from empty symmetry caches
+    :return: best wall time in seconds, peak traced memory in bytes
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        run = setup()
+        clearCaches()
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+
+    # Memory is traced in a separate run as tracing slows everything down
+    run = setup()
+    clearCaches()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+def runBenchmarks(quick: bool = False, repeat: int = 3, only: str = None,
+                  log: Callable[[str], None] = None) -> List[Mapping]:
+    """
+    :param quick: use small problem sizes
+    :param repeat: number of timed runs per case
+    :param only: run only benchmarks whose name contains this string
+    :param log: called with a line of text after each case
+    :return: [{"name", "params", "seconds", "peak_bytes"}]
+    """
+    results = []
+    for benchmark in BENCHMARKS:
+        for name, params, setup in benchmark(quick):
+            if only is not None and only not in name:
+                continue
+            seconds, peak = measure(setup, repeat)
+            results.append({"name": name, "params": dict(params), "seconds": seconds, "peak_bytes": peak})
+            if log is not None:
+                log("{:<24} {:<32} {:>10.4f}s {:>12,d}B".format(name, json.dumps(params), seconds, peak))
+    return results
+
+
+def compareResults(results: List[Mapping], baseline: List[Mapping],
+                   tolerance: float = 1.5, minseconds: float = 0.01) -> List[str]:
+    """
+    :param results: output of runBenchmarks
+    :param baseline: earlier output of runBenchmarks
+    :param tolerance: largest accepted ratio of new to baseline time or memory
+    :param minseconds: times are only compared when either run takes at least this long
+    :return: description of each regression
+    """
+    def key(r):
+        return r["name"], json.dumps(r["params"], sort_keys=True)
+
+    old = {key(r): r for r in baseline}
+    regressions = []
+    for r in results:
+        if key(r) not in old:
+            continue
+        b = old[key(r)]
+        for quantity in ["seconds", "peak_bytes"]:
+            if quantity == "seconds" and max(b[quantity], r[quantity]) < minseconds:
+                continue
+            if b[quantity] > 0 and r[quantity] / b[quantity] > tolerance:
+                regressions.append("{} {} {}: {:.4g} -> {:.4g} ({:.2f}x)".format(
+                    r["name"], json.dumps(r["params"]), quantity, b[quantity], r[quantity],
+                    r[quantity] / b[quantity]))
+    return regressions
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quick", action="store_true", help="small problem sizes only")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per case")
+    parser.add_argument("--only", help="run only benchmarks whose name contains this")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="compare against results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=1.5,
+                        help="ratio to baseline above which a case counts as a regression")
+    parser.add_argument("--min-seconds", type=float, default=0.01,
+                        help="times below this in both runs are too noisy to compare")
+    args = parser.parse_args(argv)
+
+    results = runBenchmarks(args.quick, args.repeat, args.only, log=print)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compareResults(results, json.load(f), args.tolerance, args.min_seconds)
+        for line in regressions:
+            print("REGRESSION " + line)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,180 @@
+"""
+On disk cache of calculated Lagrangians, keyed by Theory.contentHash().
+"""
+import os
+import struct
+import tempfile
+from typing import List, Optional, Tuple
+from PerturbationLib.Theory import Theory, Interaction
+
+MAGIC = b"PLLC"
+VERSION = 3
+SUFFIX = ".lag"
+# magic, version, digest of the key, number of kinetic terms, number of interactions
+HEADER = struct.Struct("<4sB32sII")
+
+
+class LagrangianCache:
+    """
+    A directory of calculated Lagrangians, one file per theory.
+
+    Each term is stored as its length followed by one uint16 per field, 2*i + anti where i is
+    the index of the field in theory.fields and anti is set for its antifield. Couplings are
+    not stored, they are relabelled in order exactly as calculateL labels them.
+
+    Files are written to a temporary file and renamed into place, so concurrent writers on
+    one machine never leave a partial file behind and readers see either nothing or a whole
+    file. Loading a file touches it, and once the directory grows past maxbytes the least
+    recently used files are removed.
+    """
+    def __init__(self, directory: str = None, maxbytes: int = 64 * 2**20):
+        """
+        :param directory: cache directory, defaults to $PERTURBATIONLIB_CACHE or ~/.cache/PerturbationLib
+        :param maxbytes: total size of cached files above which the oldest are evicted
+        """
+        if directory is None:
+            directory = os.environ.get("PERTURBATIONLIB_CACHE",
+                                       os.path.join(os.path.expanduser("~"), ".cache", "PerturbationLib"))
+        self.directory = directory
+        self.maxbytes = maxbytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + SUFFIX)
+
+    @staticmethod
+    def key(theory: Theory, filter_anti_dups: bool = True) -> str:
+        return theory.contentHash() + ("f" if filter_anti_dups else "a")
+
+    def load(self, theory: Theory, filter_anti_dups: bool = True
+             ) -> Optional[Tuple[List[Interaction], List[Interaction]]]:
+        """
+        :param theory: theory to look up
+        :param filter_anti_dups: as passed to calculateL
+        :return: (Lk, Lint) or None if not cached
+        """
+        key = self.key(theory, filter_anti_dups)
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            kinetic, interactions = decode(data, key)
+        except ValueError:
+            # Corrupt or from another version, drop it and recalculate
+            self._remove(path)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return rebuild(theory, kinetic, interactions)
+
+    def store(self, theory: Theory, lk: List[Interaction], lint: List[Interaction],
+              filter_anti_dups: bool = True):
+        """
+        Write the Lagrangian of a theory to the cache and evict old entries if it has grown too big
+        :param theory: theory the terms belong to
+        :param lk: kinetic terms
+        :param lint: interaction terms
+        :param filter_anti_dups: as passed to calculateL
+        """
+        key = self.key(theory, filter_anti_dups)
+        data = encode(theory, lk, lint, key)
+        fd, tmppath = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmppath, self.path(key))
+        except BaseException:
+            self._remove(tmppath)
+            raise
+        self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used files until the cache fits in maxbytes
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.maxbytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(SUFFIX):
+                self._remove(os.path.join(self.directory, name))
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def encode(theory: Theory, lk: List[Interaction], lint: List[Interaction], key: str) -> bytes:
+    """
+    :return: binary representation of the terms of a theory
+    """
+    findex = {field.name: i for i, field in enumerate(theory.fields)}
+    parts = [HEADER.pack(MAGIC, VERSION, _digest(key), len(lk), len(lint))]
+    for inter in lk + lint:
+        codes = [2 * findex[f.name] + int(f.anti != theory.fields[findex[f.name]].anti) for f in inter.fields]
+        parts.append(struct.pack("<B{}H".format(len(codes)), len(codes), *codes))
+    return b"".join(parts)
+
+
+def decode(data: bytes, key: str) -> Tuple[List[Tuple[int, ...]], List[Tuple[int, ...]]]:
+    """
+    :return: field codes of the kinetic terms and of the interactions
+    """
+    if len(data) < HEADER.size:
+        raise ValueError("Truncated cache file")
+    magic, version, digest, nk, nint = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION or digest != _digest(key):
+        raise ValueError("Cache file does not match")
+    terms = []
+    offset = HEADER.size
+    for _ in range(nk + nint):
+        if offset >= len(data):
+            raise ValueError("Truncated cache file")
+        n = data[offset]
+        if offset + 1 + 2 * n > len(data):
+            raise ValueError("Truncated cache file")
+        terms.append(struct.unpack_from("<{}H".format(n), data, offset + 1))
+        offset += 1 + 2 * n
+    if offset != len(data):
+        raise ValueError("Trailing data in cache file")
+    return terms[:nk], terms[nk:]
+
+
+def rebuild(theory: Theory, kinetic: List[Tuple[int, ...]],
+            interactions: List[Tuple[int, ...]]) -> Tuple[List[Interaction], List[Interaction]]:
+    """
+    Turn field codes back into terms, labelling couplings as calculateL does
+    """
+    fields = []
+    for f in theory.fields:
+        fields += [f, f.antifield()]
+    lk = [Interaction([fields[c] for c in codes], "m_{"+str(fields[codes[0]].name)+"}") for codes in kinetic]
+    lint = [Interaction([fields[c] for c in codes], "g_{"+str(i)+"}") for i, codes in enumerate(interactions)]
+    return lk, lint
+
+
+def _digest(key: str) -> bytes:
+    return bytes.fromhex(key[:64])
@@ -0,0 +1,246 @@
+"""
+Exact diagonalization of oscillator operators built from COp, AOp and XOp in a truncated Fock basis.
+"""
+import numpy
+import scipy.sparse
+import scipy.sparse.linalg
+from typing import Dict, List, Sequence, Tuple
+from PerturbationLib.ParticleState import Operator, Ladder, ladderTerms
+from PerturbationLib.Fock import FockBasis
+
+# A conserved quantity (name, weight of each mode's occupation, modulus), the modulus being
+# 0 for a sum which is conserved exactly and 2 for one whose parity is conserved
+Quantity = Tuple[str, numpy.ndarray, int]
+
+
+def compileOperator(op: Operator) -> List[Tuple[complex, Ladder]]:
+    """
+    Expand an operator expression into a sum of ladder products with numerical coefficients
+    :param op: COp, AOp, XOp or sums and products of them
+    :return: [(coefficient, ladder)] with equal ladders combined
+    """
+    return [(complex(c), ladder) for c, ladder in ladderTerms(op)]
+
+
+def numModes(terms: Sequence[Tuple[complex, Ladder]]) -> int:
+    """
+    :return: one more than the largest mode index used
+    """
+    return max((mode + 1 for _, ladder in terms for mode, _ in ladder), default=1)
+
+
+def assemble(op: Operator, cutoff: int, nmodes: int = None, total: bool = False,
+             chunksize: int = 2**16) -> Tuple[scipy.sparse.csr_matrix, FockBasis]:
+    """
+    Matrix of an operator in the truncated basis, dropping amplitude which leaves the basis.
+    Each ladder product is applied to a whole chunk of basis states at once: the factor is a
+    product of square roots of the touched occupations, and the resulting states are ranked
+    arithmetically by the FockBasis.
+    :param op: operator expression
+    :param cutoff: maximum excitations per mode, or in total if total
+    :param nmodes: number of modes, defaults to those used by op
+    :param total: truncate the total number of excitations rather than each mode
+    :param chunksize: number of basis states processed at once, bounds temporary memory
+    :return: sparse matrix, basis its rows and columns are numbered by
+    """
+    terms = compileOperator(op)
+    basis = FockBasis(nmodes or numModes(terms), cutoff, total=total)
+    return assembleInBasis(terms, basis, chunksize=chunksize), basis
+
+
+def assembleInBasis(terms: Sequence[Tuple[complex, Ladder]], basis: FockBasis, ranks: numpy.ndarray = None,
+                    chunksize: int = 2**16) -> scipy.sparse.csr_matrix:
+    """
+    :param terms: compiled operator, see compileOperator
+    :param basis: basis numbering the states
+    :param ranks: sorted ranks of the states spanning a block, rows and columns are numbered by
+                  position in ranks and amplitude leaving the block is dropped; the whole basis if None
+    :param chunksize: number of states processed at once
+    :return: sparse matrix of the operator
+    """
+    dim = len(basis) if ranks is None else len(ranks)
+    rows, cols, data = [], [], []
+    for start in range(0, dim, chunksize):
+        if ranks is None:
+            chunk = basis.states(start, start + chunksize)
+        else:
+            chunk = basis.unrank(ranks[start:start + chunksize])
+        index = numpy.arange(start, start + len(chunk))
+        for coefficient, ladder in terms:
+            factor = numpy.full(len(chunk), coefficient, dtype=complex)
+            occupation = {}
+            for mode, creation in reversed(ladder):
+                n = occupation.get(mode, chunk[:, mode])
+                if creation:
+                    factor *= numpy.sqrt(n + 1)
+                    occupation[mode] = n + 1
+                else:
+                    factor *= numpy.sqrt(numpy.maximum(n, 0))
+                    occupation[mode] = n - 1
+            valid = factor != 0
+            target = chunk[valid]
+            for mode, n in occupation.items():
+                target[:, mode] = n[valid]
+            target = basis.rank(target)
+            if ranks is not None:
+                position = numpy.minimum(numpy.searchsorted(ranks, target), dim - 1)
+                target = numpy.where(ranks[position] == target, position, -1)
+            inside = target >= 0
+            rows.append(target[inside])
+            cols.append(index[valid][inside])
+            data.append(factor[valid][inside])
+
+    matrix = scipy.sparse.coo_matrix((numpy.concatenate(data) if data else numpy.zeros(0),
+                                      (numpy.concatenate(rows) if rows else numpy.zeros(0, dtype=int),
+                                       numpy.concatenate(cols) if cols else numpy.zeros(0, dtype=int))),
+                                     shape=(dim, dim)).tocsr()
+    if not numpy.any(matrix.data.imag):
+        matrix = matrix.real
+    return matrix
+
+
+def conservedQuantities(terms: Sequence[Tuple[complex, Ladder]], nmodes: int) -> List[Quantity]:
+    """
+    Find quantities every term of a compiled operator conserves, from the net number of
+    excitations each term adds to each mode: the occupation of modes no term changes, the
+    total occupation of the other modes, and failing that the parities of modes only ever
+    changed in pairs and the total parity of the rest.
+    :param terms: compiled operator, see compileOperator
+    :param nmodes: number of modes
+    :return: [(name, weights, modulus)]
+    """
+    changes = numpy.zeros((len(terms), nmodes), dtype=int)
+    for t, (_, ladder) in enumerate(terms):
+        for mode, creation in ladder:
+            changes[t, mode] += 1 if creation else -1
+
+    quantities = []
+    fixed = numpy.all(changes == 0, axis=0)
+    for i in numpy.flatnonzero(fixed):
+        quantities.append(("N_{}".format(i), numpy.eye(nmodes, dtype=int)[i], 0))
+    rest = ~fixed
+    if not numpy.any(rest):
+        return quantities
+    if numpy.all(changes[:, rest].sum(axis=1) == 0):
+        quantities.append(("N", rest.astype(int), 0))
+        return quantities
+    even = numpy.all(changes % 2 == 0, axis=0) & rest
+    for i in numpy.flatnonzero(even):
+        quantities.append(("P_{}".format(i), numpy.eye(nmodes, dtype=int)[i], 2))
+    remaining = rest & ~even
+    if numpy.any(remaining) and numpy.all(changes[:, remaining].sum(axis=1) % 2 == 0):
+        quantities.append(("P", remaining.astype(int), 2))
+    return quantities
+
+
+def sectorRanks(basis: FockBasis, quantities: Sequence[Quantity],
+                chunksize: int = 2**16) -> Dict[Tuple[int, ...], numpy.ndarray]:
+    """
+    Split a basis into sectors of equal conserved quantities
+    :param basis: basis to split
+    :param quantities: see conservedQuantities
+    :param chunksize: number of states labelled at once
+    :return: dict{values of the quantities: sorted ranks of the states in the sector}
+    """
+    if len(quantities) == 0:
+        return {(): numpy.arange(len(basis), dtype=numpy.int64)}
+    weights = numpy.array([w for _, w, _ in quantities]).T
+    moduli = numpy.array([m for _, _, m in quantities])
+    parts = {}
+    for start in range(0, len(basis), chunksize):
+        values = basis.states(start, start + chunksize).dot(weights)
+        values = numpy.where(moduli > 0, values % numpy.maximum(moduli, 1), values)
+        labels, inverse = numpy.unique(values, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        order = numpy.argsort(inverse, kind='stable')
+        bounds = numpy.searchsorted(inverse[order], numpy.arange(len(labels) + 1))
+        for i, label in enumerate(labels.tolist()):
+            parts.setdefault(tuple(label), []).append(start + order[bounds[i]:bounds[i+1]])
+    return {label: numpy.concatenate(p) for label, p in sorted(parts.items())}
+
+
+def assembleBlocks(op: Operator, cutoff: int, nmodes: int = None, total: bool = False,
+                   chunksize: int = 2**16) -> Tuple[Dict[Tuple[int, ...], Tuple[scipy.sparse.csr_matrix, numpy.ndarray]],
+                                                    FockBasis, List[Quantity]]:
+    """
+    The operator as one sparse matrix per sector of its conserved quantities
+    :param op: operator expression
+    :param cutoff: maximum excitations per mode, or in total if total
+    :param nmodes: number of modes, defaults to those used by op
+    :param total: truncate the total number of excitations rather than each mode
+    :param chunksize: number of states processed at once
+    :return: dict{sector: (matrix, ranks of its states)}, basis, quantities labelling the sectors
+    """
+    terms = compileOperator(op)
+    basis = FockBasis(nmodes or numModes(terms), cutoff, total=total)
+    quantities = conservedQuantities(terms, basis.nmodes)
+    blocks = {}
+    for label, ranks in sectorRanks(basis, quantities, chunksize).items():
+        blocks[label] = (assembleInBasis(terms, basis, ranks, chunksize), ranks)
+    return blocks, basis, quantities
+
+
+def blockEigenpairs(op: Operator, cutoff: int, k: int = 6, nmodes: int = None, total: bool = False,
+                    **kwargs) -> Tuple[List[Tuple[float, Tuple[int, ...], numpy.ndarray, numpy.ndarray]], FockBasis]:
+    """
+    Lowest eigenpairs found sector by sector, without ever holding the whole matrix
+    :param op: Hermitian operator expression
+    :param cutoff: maximum excitations per mode, or in total if total
+    :param k: number of eigenpairs
+    :param nmodes: number of modes, defaults to those used by op
+    :param total: truncate the total number of excitations rather than each mode
+    :param kwargs: passed on to scipy.sparse.linalg.eigsh
+    :return: [(eigenvalue, sector, eigenvector within the sector, ranks of the sector)] ascending, basis
+    """
+    terms = compileOperator(op)
+    basis = FockBasis(nmodes or numModes(terms), cutoff, total=total)
+    quantities = conservedQuantities(terms, basis.nmodes)
+    found = []
+    for label, ranks in sectorRanks(basis, quantities).items():
+        values, vectors = eigenpairs(assembleInBasis(terms, basis, ranks), k, **kwargs)
+        found += [(values[i], label, vectors[:, i], ranks) for i in range(len(values))]
+        # Only the lowest k overall are needed
+        found = sorted(found, key=lambda x: x[0])[:k]
+    return found, basis
+
+
+def lowestEigenpairs(op: Operator, cutoff: int, k: int = 6, nmodes: int = None, total: bool = False,
+                     blocks: bool = True, **kwargs) -> Tuple[numpy.ndarray, numpy.ndarray, FockBasis]:
+    """
+    Lowest eigenvalues of a Hermitian operator in the truncated basis, from scipy's Lanczos
+    solver, or a dense solver for bases too small for it. Unless blocks is false, each sector
+    of the operator's conserved quantities is diagonalized separately (see blockEigenpairs).
+    :param op: Hermitian operator expression
+    :param cutoff: maximum excitations per mode, or in total if total
+    :param k: number of eigenpairs
+    :param nmodes: number of modes, defaults to those used by op
+    :param total: truncate the total number of excitations rather than each mode
+    :param blocks: diagonalize sector by sector
+    :param kwargs: passed on to scipy.sparse.linalg.eigsh
+    :return: eigenvalues ascending, eigenvectors as columns, basis numbering their components
+    """
+    if blocks:
+        found, basis = blockEigenpairs(op, cutoff, k, nmodes=nmodes, total=total, **kwargs)
+        vectors = numpy.zeros((len(basis), len(found)), dtype=numpy.result_type(*[v for _, _, v, _ in found]))
+        for i, (_, _, vector, ranks) in enumerate(found):
+            vectors[ranks, i] = vector
+        return numpy.array([value for value, _, _, _ in found]), vectors, basis
+    matrix, basis = assemble(op, cutoff, nmodes=nmodes, total=total)
+    values, vectors = eigenpairs(matrix, k, **kwargs)
+    return values, vectors, basis
+
+
+def eigenpairs(matrix: scipy.sparse.spmatrix, k: int, **kwargs) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Lanczos can miss eigenvalues of sectors the operator does not connect to the rest, so
+    operators with conserved quantities are best diagonalized one sector at a time.
+    :return: lowest k eigenvalues ascending and their eigenvectors as columns
+    """
+    dim = matrix.shape[0]
+    k = min(k, dim)
+    if dim <= max(2 * k + 1, 64):
+        values, vectors = numpy.linalg.eigh(matrix.toarray())
+        return values[:k], vectors[:, :k]
+    values, vectors = scipy.sparse.linalg.eigsh(matrix, k=k, which='SA', **kwargs)
+    order = numpy.argsort(values)
+    return values[order], vectors[:, order]
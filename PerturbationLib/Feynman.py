@@ -3,7 +3,16 @@ A package for keeping track of energy flow and so forth
 """
 from PerturbationLib.Theory import *
 from PerturbationLib.Utilities import *
-from typing import Generator, Mapping
+from PerturbationLib.Instrumentation import Stats
+from typing import Generator, Mapping, List, Tuple, Sequence, MutableMapping
+from fractions import Fraction
+import hashlib
+import itertools
+import json
+import math
+import os
+import pickle
+import time
 
 
 class Feynman:
@@ -11,7 +20,13 @@ class Feynman:
     Please remember that this is essentially the subset sum problem which
     is NP-Complete.
     """
-    def __init__(self, theory: Theory):
+    def __init__(self, theory: Theory, stats: Stats = None):
+        # Shares the theory's counters unless given its own
+        self.stats = theory.stats if stats is None else stats
+        with self.stats.phase("Feynman.__init__"):
+            self._build(theory)
+
+    def _build(self, theory: Theory):
         self.interactions = theory.getInt()
 
         # All fields and antifields
@@ -32,45 +47,363 @@ class Feynman:
 
             addedset = set()
             for i, o in Utilities.genInOutPairs(outvecinter, swapvec=swapvec):
-                taken, given = -i, o
+                taken, given = -i, o.copy()
                 checka = (inter, tuple(taken), tuple(given))
                 if checka not in addedset:
                     addedset.add(checka)
                     self.inters.append((inter, taken, given))
 
+        # Linear quantities used to bound the number of vertices between two states
+        self.chargenames, self.charges = self.linearQuantities()
+        self.effects = Utilities.nodeEffects(self.inters, self.charges)
+        # Rules for each way of using an interaction, indexed by the particles they take
+        self.vertexTable = VertexTable(self.inters)
+        # Incremental searches kept between calls, by start vector
+        self.searches = {}
+
+    def linearQuantities(self) -> Tuple[List[str], numpy.ndarray]:
+        """
+        Quantities which are linear in the particle counts: total particle number,
+        number of each field, particle minus antiparticle number, and the charges of every
+        symmetry giving abelianCharges for all fields, scaled to integers.
+        :return: names, array of weights of shape (num_quantities, len(self.fieldlist))
+        """
+        n = len(self.fieldlist)
+        names = ["N"]
+        weights = [[1 for _ in range(n)]]
+        for i, field in enumerate(self.fieldlist):
+            names.append("N({})".format(repr(field)))
+            weights.append([1 if j == i else 0 for j in range(n)])
+        for i, field in enumerate(self.fieldlist):
+            if not field.anti:
+                anti = self.findex[field.antifield()]
+                names.append("N({0})-N({1})".format(repr(field), repr(field.antifield())))
+                weights.append([1 if j == i else (-1 if j == anti else 0) for j in range(n)])
+
+        symnames = []
+        for field in self.fieldlist:
+            for sym in field.syms:
+                if sym.abelianCharges() is not None and sym.name not in symnames:
+                    symnames.append(sym.name)
+        for symname in symnames:
+            charges = []
+            for field in self.fieldlist:
+                fsyms = [sym for sym in field.syms if sym.name == symname]
+                q = fsyms[0].abelianCharges() if len(fsyms) == 1 else None
+                if q is None:
+                    break
+                charges.append(list(q))
+            else:
+                columns = Utilities.integerColumns(charges)
+                for j in range(columns.shape[1]):
+                    names.append("Q({})".format(symname) if columns.shape[1] == 1 else "Q_{}({})".format(j, symname))
+                    weights.append(list(columns[:, j]))
+        return names, numpy.array(weights, dtype=int).reshape(len(names), n)
+
+    def lowerBound(self, startstate: Mapping[Field, int], endstate: Mapping[Field, int]) -> float:
+        """
+        Admissible lower bound on the number of vertices needed to go from startstate to endstate,
+        infinite if a conserved charge differs between them.
+        :param startstate: Start state  as dict{field: num_particles}
+        :param endstate: State of interest as dict{field: num_particles}
+        :return: minimum number of vertices
+        """
+        endvec = self.convertDictToVec(endstate)
+        bound = Utilities.linearLowerBound(endvec, self.charges, self.effects)
+        return bound(tuple(int(x) for x in self.convertDictToVec(startstate)))
+
     def convertDictToVec(self, d: Mapping[Field, int]) -> Sequence[int]:
+        """
+        Converts a state to a vector of particle counts
+        :param d: dict{field: num_particles}, fields may also be given as (name, anti) tuples
+        :return: vector indexed like self.fieldlist
+        """
         vec = [0 for _ in range(len(self.fieldlist))]
         for field in d:
-            vec[self.findex[field]] = d[field]
+            key = field if isinstance(field, Field) else Field(field[0], anti=field[1])
+            if key not in self.findex:
+                raise ValueError("Field {} does not appear in any interaction.".format(key))
+            vec[self.findex[key]] = d[field]
         return numpy.array(vec)
 
+    def convertDictToFields(self, d: Mapping[Field, int]) -> List[Field]:
+        """
+        Expands a state into a list of particles
+        :param d: dict{field: num_particles}, fields may also be given as (name, anti) tuples
+        :return: [field] with each field repeated num_particles times, in the order of d
+        """
+        vec = self.convertDictToVec(d)
+        fields = []
+        for field in d:
+            key = field if isinstance(field, Field) else Field(field[0], anti=field[1])
+            fields += [self.fieldlist[self.findex[key]]] * int(vec[self.findex[key]])
+        return fields
+
+    def pathSearch(self, startstate: Mapping[Field, int]) -> Utilities.VectorPathSearch:
+        """
+        The incremental search from a start state, shared by every call made with it
+        :param startstate: Start state  as dict{field: num_particles}
+        """
+        key = tuple(int(x) for x in self.convertDictToVec(startstate))
+        if key not in self.searches:
+            self.searches[key] = Utilities.VectorPathSearch(key, self.inters,
+                                                            stats=self.stats if self.stats.enabled else None,
+                                                            index=self.vertexTable.index)
+        return self.searches[key]
+
     def listPaths(self, startstate: Mapping[Field, int], endstate: Mapping[Field, int],
-                  maxorder=4) -> Generator['Diagram', None, None]:
+                  maxorder=4, incremental=False, checkpoint: str = None,
+                  interval: float = 60.0) -> Generator[List[Tuple[Interaction, Sequence[int], Sequence[int]]], None, None]:
         """
         Lists each path to get to given endstate (endstate * state > 0)
         :param startstate: Start state  as dict{field: num_particles}
         :param endstate: State of interest as dict{field: num_particles}
         :param maxorder: maximum number of nodes allowed
-        :return: [paths]
+        :param incremental: use the search kept for startstate (see pathSearch), which only expands
+                            orders not reached by earlier calls, rather than a fresh pruned search
+        :param checkpoint: path of a file the paths are appended to as they are found. Rerunning
+                           the same search with the same checkpoint yields the stored paths first
+                           and continues the search after the last of them, giving the same paths
+                           in the same order as an uninterrupted run
+        :param interval: minimum number of seconds between appends to the checkpoint
+        :return: [paths] where each path is [(interaction, taken, given)]
         """
         startvec = self.convertDictToVec(startstate)
         endvec = self.convertDictToVec(endstate)
-        for path in Utilities.genVectorPaths(startvec, endvec, {v[0]: (v[1], v[2]) for v in self.inters}, maxorder):
-            diagrams = [Diagram(*[f for f in startstate for _ in range(startstate[f])])]
-            for inter, req, prod in path:
-                removed_fields = {self.fieldlist[i]: req[i] for i in range(len(self.fieldlist)) if req[i] > 0}
-                added_fields = {self.fieldlist[i]: prod[i] for i in range(len(self.fieldlist)) if prod[i] > 0}
+        stats = self.stats if self.stats.enabled else None
+        if checkpoint is not None:
+            if incremental:
+                raise ValueError("Checkpoints are only kept for searches which are not incremental.")
+            paths = self._checkpointedPaths(startvec, endvec, maxorder, checkpoint, interval, stats)
+        elif incremental:
+            paths = self.pathSearch(startstate).paths(endvec, maxorder)
+        else:
+            paths = Utilities.genVectorPaths(startvec, endvec, self.inters, maxorder,
+                                             weights=self.charges, effects=self.effects, stats=stats,
+                                             index=self.vertexTable.index)
+        for path in paths:
+            if stats is not None:
+                stats.count("paths")
+            yield path
+
+    def _checkpointedPaths(self, startvec: Sequence[int], endvec: Sequence[int], maxorder: int,
+                           checkpoint: str, interval: float, stats: Stats
+                           ) -> Generator[List[Tuple[Interaction, Sequence[int], Sequence[int]]], None, None]:
+        """
+        The checkpoint starts with a key identifying the search, followed by batches of paths
+        each given as indices into self.inters.
+        """
+        key = hashlib.sha256(json.dumps([[[repr(inter), [int(x) for x in taken], [int(x) for x in given]]
+                                           for inter, taken, given in self.inters],
+                                          [int(x) for x in startvec], [int(x) for x in endvec],
+                                          maxorder]).encode()).hexdigest()
+        records, end = Utilities.readPickleLog(checkpoint)
+        if len(records) > 0 and records[0] != key:
+            raise ValueError("Checkpoint {} belongs to a different search.".format(checkpoint))
+        stored = [codes for batch in records[1:] for codes in batch]
+        for codes in stored:
+            yield [self.inters[i] for i in codes]
+        if stats is not None:
+            stats.count("paths resumed", len(stored))
+
+        index = self.vertexTable.index
+        position = {id(entry[3]): i for i, entry in enumerate(index.nodelist)}
+        if os.path.exists(checkpoint):
+            # Drop a batch cut short by an interrupted run before appending to the file
+            os.truncate(checkpoint, end)
+        with open(checkpoint, "ab") as log:
+            def append(record):
+                pickle.dump(record, log)
+                log.flush()
+                os.fsync(log.fileno())
+
+            if len(records) == 0:
+                append(key)
+            batch = []
+            written = time.monotonic()
+            try:
+                for path in Utilities.genVectorPaths(startvec, endvec, self.inters, maxorder,
+                                                     weights=self.charges, effects=self.effects, stats=stats,
+                                                     index=index, after=stored[-1] if stored else None):
+                    batch.append(tuple(position[id(node)] for node in path))
+                    if time.monotonic() - written >= interval:
+                        append(batch)
+                        batch = []
+                        written = time.monotonic()
+                    yield path
+            finally:
+                if len(batch) > 0:
+                    append(batch)
+
+    def countPaths(self, startstate: Mapping[Field, int], endstate: Mapping[Field, int],
+                   maxorder=4, incremental=False) -> List[int]:
+        """
+        Counts the paths listPaths would give, without enumerating them. Every path has at
+        least one node, so the count of paths with no nodes is 0 even when startstate is endstate.
+        :param startstate: Start state  as dict{field: num_particles}
+        :param endstate: State of interest as dict{field: num_particles}
+        :param maxorder: maximum number of nodes allowed
+        :param incremental: read the counts off the search kept for startstate, see listPaths
+        :return: [number of paths with i nodes] for i in 0..maxorder, entry 0 always being 0
+        """
+        startvec = self.convertDictToVec(startstate)
+        endvec = self.convertDictToVec(endstate)
+        stats = self.stats if self.stats.enabled else None
+        with self.stats.phase("countPaths"):
+            if incremental:
+                return self.pathSearch(startstate).countPaths(endvec, maxorder)
+            return Utilities.countVectorPaths(startvec, endvec, self.inters, maxorder,
+                                              weights=self.charges, effects=self.effects, stats=stats,
+                                              index=self.vertexTable.index)
+
+    def listDiagrams(self, startstate: Mapping[Field, int], endstate: Mapping[Field, int],
+                     maxorder=4, connected=True, incremental=False) -> List['Diagram']:
+        """
+        Lists each distinct diagram taking startstate to endstate. Every path from listPaths
+        is turned into diagrams one interaction at a time, merging isomorphic partial diagrams
+        after each step, so the work done grows with the number of distinct topologies rather
+        than with the number of ways of labelling them. Merged diagrams add their multiplicities,
+        so each diagram returned carries its weight and symmetry factor.
+        :param startstate: Start state  as dict{field: num_particles}
+        :param endstate: State of interest as dict{field: num_particles}
+        :param maxorder: maximum number of vertices allowed
+        :param connected: drop diagrams which fall apart into several pieces
+        :param incremental: find the paths with the search kept for startstate, see listPaths
+        :return: [Diagram] sorted by number of vertices
+        """
+        with self.stats.phase("listDiagrams"):
+            return self._listDiagrams(startstate, endstate, maxorder, connected, incremental)
+
+    def _listDiagrams(self, startstate: Mapping[Field, int], endstate: Mapping[Field, int],
+                      maxorder: int, connected: bool, incremental: bool = False) -> List['Diagram']:
+        stats = self.stats
+        instrumented = stats.enabled
+        startfields = self.convertDictToFields(startstate)
+        endfields = self.convertDictToFields(endstate)
+        diagrams = {}
+        # Frontiers of partial diagrams for each prefix of the current path
+        prefixes = [((), {d.serialize(): d for d in [Diagram(*startfields)]})]
+        for path in self.listPaths(startstate, endstate, maxorder, incremental=incremental):
+            keys = tuple((repr(inter), tuple(taken), tuple(given)) for inter, taken, given in path)
+            depth = 0
+            while depth + 1 < len(prefixes) and depth < len(keys) and prefixes[depth + 1][0] == keys[:depth + 1]:
+                depth += 1
+            del prefixes[depth + 1:]
+            for step in range(depth, len(keys)):
+                inter, taken, given = path[step]
+                removed = {self.fieldlist[i]: -int(taken[i]) for i in range(len(self.fieldlist)) if taken[i] < 0}
+                added = {self.fieldlist[i]: int(given[i]) for i in range(len(self.fieldlist)) if given[i] > 0}
+                frontier = {}
+                for partial in prefixes[-1][1].values():
+                    for d in partial.applyInteraction(inter, removed, added):
+                        _merge(frontier, d)
+                        if instrumented:
+                            stats.count("partial diagrams")
+                if instrumented:
+                    stats.count("distinct partial diagrams", len(frontier))
+                prefixes.append((keys[:step + 1], frontier))
+            for partial in prefixes[-1][1].values():
+                for d in partial.close(*endfields):
+                    if not connected or d.isConnected():
+                        _merge(diagrams, d)
+                        if instrumented:
+                            stats.count("closed diagrams")
+        return sorted(diagrams.values(), key=lambda d: (len(d.vertices), d.serialize()))
+
+
+class FeynmanRule:
+    """
+    One way of using an interaction as a vertex: the particles it takes in and gives out as
+    vectors indexed like Feynman.fieldlist, its coupling symbol, and the number of ways of
+    attaching lines to its legs, prod_f n_f! over the numbers n_f of identical legs, which the
+    vertex carries when interactions appear as written (coupling times fields, with no 1/n!).
+    """
+    def __init__(self, inter: Interaction, taken: Sequence[int], given: Sequence[int]):
+        self.inter = inter
+        self.taken = tuple(int(x) for x in taken)
+        self.given = tuple(int(x) for x in given)
+        self.coupling = inter.coupling
+        self.factor = 1
+        for field in set(inter.fields):
+            self.factor *= math.factorial(inter.fields.count(field))
+
+    def __repr__(self):
+        return "{}: {} -> {}".format(repr(self.inter), self.taken, self.given)
+
+
+class VertexTable:
+    """
+    The Feynman rules of every (interaction, taken, given) in Feynman.inters, in the same order,
+    indexed by the particle types each takes in. Rules which may apply to a state are looked up
+    by which particle types it holds, so searches never try vertices needing a particle which
+    is absent.
+    """
+    def __init__(self, inters: Sequence[Tuple[Interaction, Sequence[int], Sequence[int]]]):
+        """
+        :param inters: [(interaction, taken, given)] with taken entries <= 0
+        """
+        self.rules = [FeynmanRule(inter, taken, given) for inter, taken, given in inters]
+        self.index = Utilities.NodeIndex(inters)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __getitem__(self, i: int) -> FeynmanRule:
+        return self.rules[i]
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    def compatible(self, state: Sequence[int]) -> List[FeynmanRule]:
+        """
+        :param state: vector of particle counts indexed like Feynman.fieldlist
+        :return: [FeynmanRule] taking only particle types present in state, in table order
+        """
+        return [self.rules[i] for i in self.index.forward(state)]
+
+    def producing(self, state: Sequence[int]) -> List[FeynmanRule]:
+        """
+        :param state: vector of particle counts indexed like Feynman.fieldlist
+        :return: [FeynmanRule] giving only particle types present in state, in table order
+        """
+        return [self.rules[i] for i in self.index.backward(state)]
 
 
 class Vertex:
-    def __init__(self, inter: Interaction):
-        self.fields = tuple(sorted(inter.getRawFields()))
-        self.free_fields = {field: self.fields.count(field) for field in self.fields}
+    """
+    A node of a diagram, either an interaction vertex or an external particle.
+    Legs are labelled by the field operator attached to them: a leg x creates an
+    x particle or destroys an anti-x particle, so an incoming particle p has a single
+    leg p and an outgoing particle p a single leg anti-p. A propagator joins a leg x
+    to a leg anti-x.
+    """
+    def __init__(self, inter: Interaction = None, external: Field = None, incoming: bool = True):
+        self.inter = inter
+        self.external = external
+        self.incoming = incoming
+        if inter is not None:
+            self.fields = tuple(sorted(inter.getFields(), key=repr))
+            self.label = repr(inter)
+        elif external is not None:
+            self.fields = (external.copy() if incoming else external.antifield(),)
+            self.label = ("in:" if incoming else "out:") + repr(external)
+        else:
+            raise ValueError("Vertex requires an interaction or an external field.")
+        self.free_fields = {}
+        for field in self.fields:
+            self.free_fields[field] = self.free_fields.get(field, 0) + 1
         self.field_paths = {}
         self.vertex_paths = {}
 
+    def isExternal(self) -> bool:
+        return self.inter is None
+
     def addPath(self, field: Field, vertex: 'Vertex'):
-        field = field.matterField()
+        """
+        Attach one free leg to another vertex
+        :param field: field of the leg being used
+        :param vertex: vertex at the other end of the propagator
+        """
         if field not in self.free_fields:
             raise ValueError("Field not in vertex.")
         if self.free_fields[field] == 0:
@@ -84,46 +417,274 @@ class Vertex:
         self.field_paths[field].append(vertex)
         self.vertex_paths[vertex].append(field)
 
-    def __hash__(self):
-        return hash(self.fields)
-
-    def __eq__(self, other):
-        if not isinstance(other, Vertex):
-            raise ValueError("Cannot compare non-like types.")
-        return self.fields == other.fields
+    def copy(self) -> 'Vertex':
+        """
+        :return: an unconnected vertex of the same kind
+        """
+        return Vertex(self.inter, self.external, self.incoming)
 
-    def __lt__(self, other):
-        if not isinstance(other, Vertex):
-            raise ValueError("Cannot compare non-like types.")
-        return self.fields < other.fields
+    def __repr__(self):
+        return self.label
 
-    def __le__(self, other):
-        if not isinstance(other, Vertex):
-            raise ValueError("Cannot compare non-like types.")
-        return self.fields <= other.fields
 
-    def __gt__(self, other):
-        if not isinstance(other, Vertex):
-            raise ValueError("Cannot compare non-like types.")
-        return self.fields > other.fields
+class Diagram:
+    """
+    A (possibly partial) Feynman diagram built one interaction at a time.
+    Particles which have been produced but not yet absorbed are kept as open lines
+    attached to the vertex which produced them. Diagrams compare equal when they
+    are isomorphic with external legs held fixed, which is decided by comparing
+    canonical forms.
+    Interactions are taken to be normal ordered, so no line starts and ends on one vertex.
 
-    def __ge__(self, other):
-        if not isinstance(other, Vertex):
-            raise ValueError("Cannot compare non-like types.")
-        return self.fields >= other.fields
+    Each diagram also counts the labelled contractions it stands for (the size of its
+    orbit under relabelling vertices and identical legs), summed over every time ordering
+    of its vertices. From that count follow the combinatorial weight and symmetry factor
+    without computing automorphisms.
+    """
+    def __init__(self, *fields: Field):
+        self.fields = tuple(fields)
+        self.multiplicity = 1
+        self.externals = [Vertex(external=field, incoming=True) for field in self.fields]
+        self.vertices = []
+        self.edges = []
+        self.open = [(vertex, field) for vertex, field in zip(self.externals, self.fields)]
+        self.closed = False
+        self._form = None
 
+    def copy(self) -> 'Diagram':
+        """
+        :return: a deep copy of this diagram, vertices included
+        """
+        new = Diagram()
+        new.fields = self.fields
+        mapping = {}
+        for v in self.externals + self.vertices:
+            mapping[v] = v.copy()
+        new.externals = [mapping[v] for v in self.externals]
+        new.vertices = [mapping[v] for v in self.vertices]
+        new.edges = []
+        for a, b, field in self.edges:
+            new.connect(mapping[a], mapping[b], field)
+        new.open = [(mapping[v], field) for v, field in self.open]
+        new.closed = self.closed
+        new.multiplicity = self.multiplicity
+        return new
 
-class Diagram:
-    def __init__(self, *fields: Field):
-        self.fields = tuple(sorted(fields))
+    def connect(self, source: Vertex, sink: Vertex, particle: Field):
+        """
+        Add a propagator carrying particle from source to sink
+        """
+        source.addPath(particle, sink)
+        sink.addPath(particle.antifield(), source)
+        self.edges.append((source, sink, particle))
+        self._form = None
 
     def applyInteraction(self, interaction: Interaction,
                          remove_particles: Mapping[Field, int],
                          add_particles: Mapping[Field, int]) -> Generator['Diagram', None, None]:
-        pass
+        """
+        Attach a new vertex which absorbs some open lines and produces new ones.
+        :param interaction: interaction at the new vertex
+        :param remove_particles: dict{particle: number} of open lines absorbed by the vertex
+        :param add_particles: dict{particle: number} of lines produced by the vertex
+        :yield: one diagram for each inequivalent choice of which open lines are absorbed,
+                with multiplicity counting the labelled choices of lines and legs it represents
+        """
+        if self.closed:
+            raise ValueError("Cannot add interactions to a closed diagram.")
+        legs = {}
+        for field in interaction.getFields():
+            legs[field] = legs.get(field, 0) + 1
+        for particle, n in remove_particles.items():
+            leg = particle.antifield()
+            legs[leg] = legs.get(leg, 0) - n
+        for particle, n in add_particles.items():
+            legs[particle] = legs.get(particle, 0) - n
+        if any(legs.values()):
+            raise ValueError("Particles do not match the fields of {}".format(interaction))
+
+        # Ways of attaching the absorbed lines to distinguishable legs of the new vertex
+        legfactor = 1
+        for field in set(interaction.getFields()):
+            nlegs = interaction.getFields().count(field)
+            nabsorbed = remove_particles.get(field.antifield(), 0)
+            legfactor *= math.factorial(nlegs) // math.factorial(nlegs - nabsorbed)
+
+        removals = [(particle, n) for particle, n in remove_particles.items() if n > 0]
+        for chosen, linefactor in self._chooseOpen(removals):
+            new = self.copy()
+            new.multiplicity *= legfactor * linefactor
+            vertex = Vertex(inter=interaction)
+            new.vertices.append(vertex)
+            for source_index, particle in zip(chosen, [p for p, n in removals for _ in range(n)]):
+                source = (new.externals + new.vertices)[source_index]
+                new.open.remove(next(o for o in new.open if o[0] is source and o[1] == particle))
+                new.connect(source, vertex, particle)
+            for particle, n in add_particles.items():
+                new.open += [(vertex, particle)] * n
+            yield new
+
+    def _chooseOpen(self, removals: Sequence[Tuple[Field, int]]) -> Generator[List[int], None, None]:
+        """
+        Choose open lines to absorb, lines of one particle type from the same vertex
+        being interchangeable.
+        :param removals: [(particle, number to absorb)]
+        :yield: ([index of source vertex] for each absorbed line in the order of removals,
+                 number of labelled choices of lines this stands for)
+        """
+        nodes = self.externals + self.vertices
+        position = {v: i for i, v in enumerate(nodes)}
+        if len(removals) == 0:
+            yield [], 1
+            return
+        (particle, n), rest = removals[0], removals[1:]
+        sources = {}
+        for v, p in self.open:
+            if p == particle:
+                sources[position[v]] = sources.get(position[v], 0) + 1
+        for taken in _distribute(n, sorted(sources.items())):
+            factor = 1
+            for i, k in taken:
+                factor *= math.comb(sources[i], k)
+            for tail, tailfactor in self._chooseOpen(rest):
+                yield [i for i, k in taken for _ in range(k)] + tail, factor * tailfactor
+
+    def close(self, *fields: Field) -> Generator['Diagram', None, None]:
+        """
+        Attach the remaining open lines to outgoing external particles
+        :param fields: outgoing particles, must match the open lines
+        :yield: one diagram for each inequivalent assignment of open lines to outgoing particles,
+                with multiplicity counting the labelled assignments it represents
+        """
+        if sorted(repr(p) for _, p in self.open) != sorted(repr(f) for f in fields):
+            return
+        nodes = self.externals + self.vertices
+        position = {v: i for i, v in enumerate(nodes)}
+        groups = {}
+        for v, p in self.open:
+            groups[(position[v], repr(p))] = groups.get((position[v], repr(p)), 0) + 1
+
+        def assign(k: int, remaining: Mapping) -> Generator[List[int], None, None]:
+            if k == len(fields):
+                yield []
+                return
+            for (i, prepr), count in sorted(remaining.items()):
+                if prepr == repr(fields[k]) and count > 0:
+                    left = dict(remaining)
+                    left[(i, prepr)] -= 1
+                    for tail in assign(k + 1, left):
+                        yield [i] + tail
+
+        # Lines from one vertex are interchangeable among the particles they are assigned to
+        groupfactor = 1
+        for count in groups.values():
+            groupfactor *= math.factorial(count)
+
+        for sources in assign(0, groups):
+            new = self.copy()
+            new.multiplicity *= groupfactor
+            newnodes = new.externals + new.vertices
+            outs = [Vertex(external=field, incoming=False) for field in fields]
+            for i, field, out in zip(sources, fields, outs):
+                new.connect(newnodes[i], out, field)
+            new.externals += outs
+            new.open = []
+            new.closed = True
+            yield new
+
+    def isConnected(self) -> bool:
+        """
+        :return: true if every vertex and external particle lies in a single component
+        """
+        nodes = self.externals + self.vertices
+        if len(nodes) == 0:
+            return True
+        seen = {nodes[0]}
+        stack = [nodes[0]]
+        while stack:
+            for other in stack.pop().vertex_paths:
+                if other not in seen:
+                    seen.add(other)
+                    stack.append(other)
+        return len(seen) == len(nodes)
+
+    def weight(self) -> Fraction:
+        """
+        Combinatorial factor multiplying the product of couplings and propagators when the
+        interactions appear in the Lagrangian as written (coupling times fields, with no 1/n!).
+        This is the number of labelled contractions divided by the number of vertex orderings.
+        :return: weight
+        """
+        return Fraction(self.multiplicity, math.factorial(len(self.vertices)))
+
+    def symmetryFactor(self) -> Fraction:
+        """
+        Symmetry factor S of the diagram, the order of its automorphism group with external
+        particles fixed. With interactions normalized by 1/n! for n identical fields, the
+        diagram enters with 1/S.
+        :return: S
+        """
+        legs = 1
+        for vertex in self.vertices:
+            for field in set(vertex.fields):
+                legs *= math.factorial(vertex.fields.count(field))
+        return Fraction(math.factorial(len(self.vertices)) * legs, self.multiplicity)
+
+    def canonicalForm(self) -> Tuple:
+        """
+        A labelling of the diagram which is the same for all isomorphic diagrams.
+        External particles keep their positions, internal vertices are first split into
+        classes by colour refinement and then ordered by trying each permutation within
+        classes, keeping the lexicographically smallest edge list.
+        :return: (node descriptions, edges)
+        """
+        if self._form is not None:
+            return self._form
+        nodes = self.externals + self.vertices
+        position = {v: i for i, v in enumerate(nodes)}
+        next_ext = len(self.externals)
+        edges = []
+        for a, b, particle in self.edges:
+            if particle.anti:
+                a, b, particle = b, a, particle.antifield()
+            edges.append((position[a], position[b], repr(particle)))
+        openlines = [[] for _ in nodes]
+        for v, particle in self.open:
+            openlines[position[v]].append(repr(particle))
+        descriptions = [(node.label, tuple(sorted(openlines[i]))) for i, node in enumerate(nodes)]
+
+        # Colour refinement, external particles are all distinguished
+        colors = _rank([(0, i) if i < next_ext else (1, descriptions[i]) for i in range(len(nodes))])
+        while True:
+            neighbours = [[] for _ in nodes]
+            for a, b, particle in edges:
+                neighbours[a].append((particle, 1, colors[b]))
+                neighbours[b].append((particle, -1, colors[a]))
+            refined = _rank([(colors[i], tuple(sorted(neighbours[i]))) for i in range(len(nodes))])
+            if len(set(refined)) == len(set(colors)):
+                break
+            colors = refined
+
+        cells = {}
+        for i in range(next_ext, len(nodes)):
+            cells.setdefault(colors[i], []).append(i)
+        cells = [cells[c] for c in sorted(cells)]
+
+        best = None
+        for ordering in itertools.product(*[itertools.permutations(cell) for cell in cells]):
+            label = list(range(len(nodes)))
+            order = list(range(next_ext)) + [i for cell in ordering for i in cell]
+            for new, old in enumerate(order):
+                label[old] = new
+            form = (tuple(descriptions[old] for old in order),
+                    tuple(sorted((label[a], label[b], p) for a, b, p in edges)))
+            if best is None or form < best:
+                best = form
+        self._form = best
+        return best
 
     def serialize(self) -> str:
-        pass
+        return repr(self.canonicalForm())
 
     def __eq__(self, other):
         if not isinstance(other, Diagram):
@@ -154,5 +715,54 @@ class Diagram:
         return hash(self.serialize())
 
     def __repr__(self):
-        pass
+        descriptions, edges = self.canonicalForm()
+        names = []
+        seen = {True: 0, False: 0}
+        for i, (label, _) in enumerate(descriptions):
+            if i < len(self.externals):
+                incoming = self.externals[i].incoming
+                names.append("{}{}:{}".format("in" if incoming else "out", seen[incoming],
+                                              repr(self.externals[i].external)))
+                seen[incoming] += 1
+            else:
+                names.append("v{}[{}]".format(i - len(self.externals), label))
+        lines = ["{} -{}-> {}".format(names[a], p, names[b]) for a, b, p in edges]
+        lines += ["{} -{}-> ?".format(names[i], p) for i, (_, ps) in enumerate(descriptions) for p in ps]
+        return "Diagram(" + "; ".join(lines) + ")"
+
+
+def _merge(diagrams: MutableMapping[str, Diagram], diagram: Diagram):
+    """
+    Add diagram to a dict keyed by canonical form, summing multiplicities of isomorphic diagrams
+    """
+    key = diagram.serialize()
+    if key in diagrams:
+        diagrams[key].multiplicity += diagram.multiplicity
+    else:
+        diagrams[key] = diagram
 
+
+def _rank(signatures: Sequence) -> List[int]:
+    """
+    Replace each signature by its position among the sorted distinct signatures
+    """
+    order = {sig: i for i, sig in enumerate(sorted(set(signatures)))}
+    return [order[sig] for sig in signatures]
+
+
+def _distribute(n: int, available: Sequence[Tuple[T, int]]) -> Generator[List[Tuple[T, int]], None, None]:
+    """
+    All ways of taking n items from bins of limited size
+    :param n: number of items to take
+    :param available: [(bin, size)]
+    :yield: [(bin, number taken)] with nonzero numbers taken
+    """
+    if n == 0:
+        yield []
+        return
+    if len(available) == 0:
+        return
+    (b, size), rest = available[0], available[1:]
+    for k in range(min(n, size), -1, -1):
+        for tail in _distribute(n - k, rest):
+            yield ([(b, k)] if k > 0 else []) + tail
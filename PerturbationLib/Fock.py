@@ -0,0 +1,130 @@
+"""
+Truncated Fock bases whose states are numbered arithmetically, without lookup tables.
+"""
+import numpy
+from typing import Tuple
+
+
+class FockBasis:
+    """
+    Occupation vectors of nmodes oscillators, truncated either by the total number of
+    excitations or by the number in each mode, each numbered by a rank in [0, len(basis)).
+
+    With a total cutoff states are ordered by their total n and then, within a total, by
+    the combinatorial number system: an occupation vector is a placement of nmodes-1 bars
+    among n stars, bar j sitting at b_j = n_0 + ... + n_j + j, and its rank within the total
+    is sum_j C(b_j, j + 1). States with total n start at rank C(n - 1 + nmodes, nmodes).
+    With a per mode cutoff the rank is the mixed radix number with one digit per mode.
+
+    rank and unrank work on whole arrays of states at once.
+    """
+    def __init__(self, nmodes: int, cutoff: int, total: bool = True):
+        """
+        :param nmodes: number of modes
+        :param cutoff: maximum number of excitations in all modes together, or in each if not total
+        :param total: truncate the total number of excitations rather than each mode
+        """
+        if nmodes < 1 or cutoff < 0:
+            raise ValueError("Need at least one mode and a non-negative cutoff.")
+        self.nmodes = nmodes
+        self.cutoff = cutoff
+        self.total = total
+        if total:
+            # binom[a, k] = C(a, k) for a up to cutoff + nmodes, checked to fit in 64 bits
+            size = cutoff + nmodes + 1
+            table = [[0] * (nmodes + 1) for _ in range(size)]
+            for a in range(size):
+                table[a][0] = 1
+                for k in range(1, min(a, nmodes) + 1):
+                    table[a][k] = table[a-1][k-1] + (table[a-1][k] if k <= a - 1 else 0)
+            if table[size - 1][nmodes] >= 2**63:
+                raise ValueError("Basis too large to number with 64 bit integers.")
+            self.binom = numpy.array(table, dtype=numpy.int64)
+            self.dim = int(self.binom[cutoff + nmodes, nmodes])
+        else:
+            if (cutoff + 1) ** nmodes >= 2**63:
+                raise ValueError("Basis too large to number with 64 bit integers.")
+            self.strides = (cutoff + 1) ** numpy.arange(nmodes - 1, -1, -1, dtype=numpy.int64)
+            self.dim = (cutoff + 1) ** nmodes
+
+    def __len__(self) -> int:
+        return self.dim
+
+    def contains(self, states: numpy.ndarray) -> numpy.ndarray:
+        """
+        :param states: occupations of shape (..., nmodes)
+        :return: boolean array of shape (...), true for states in the basis
+        """
+        states = numpy.asarray(states)
+        inside = numpy.all(states >= 0, axis=-1)
+        if self.total:
+            return inside & (states.sum(axis=-1) <= self.cutoff)
+        return inside & numpy.all(states <= self.cutoff, axis=-1)
+
+    def rank(self, states: numpy.ndarray) -> numpy.ndarray:
+        """
+        :param states: occupations of shape (..., nmodes)
+        :return: int64 ranks of shape (...), -1 for states outside the basis
+        """
+        states = numpy.asarray(states, dtype=numpy.int64)
+        inside = self.contains(states)
+        clipped = numpy.where(inside[..., None], states, 0)
+        if not self.total:
+            ranks = clipped.dot(self.strides)
+        else:
+            prefix = numpy.cumsum(clipped, axis=-1)
+            total = prefix[..., -1]
+            ranks = self.binom[total - 1 + self.nmodes, self.nmodes] * (total > 0)
+            for j in range(self.nmodes - 1):
+                ranks = ranks + self.binom[prefix[..., j] + j, j + 1]
+        return numpy.where(inside, ranks, -1)
+
+    def unrank(self, ranks: numpy.ndarray) -> numpy.ndarray:
+        """
+        :param ranks: integer ranks of shape (...), each in [0, len(basis))
+        :return: occupations of shape (..., nmodes)
+        """
+        ranks = numpy.asarray(ranks, dtype=numpy.int64)
+        if numpy.any(ranks < 0) or numpy.any(ranks >= self.dim):
+            raise ValueError("Rank outside of basis.")
+        if not self.total:
+            return (ranks[..., None] // self.strides) % (self.cutoff + 1)
+
+        # Total is the largest n whose first rank C(n - 1 + nmodes, nmodes) is at most the rank
+        starts = self.binom[numpy.arange(self.cutoff + 1) - 1 + self.nmodes, self.nmodes]
+        starts[0] = 0
+        total = numpy.searchsorted(starts, ranks, side='right') - 1
+        remainder = ranks - starts[total]
+
+        # Place bars from the last, each at the largest b with C(b, j + 1) <= remainder
+        states = numpy.empty(ranks.shape + (self.nmodes,), dtype=numpy.int64)
+        above = total + self.nmodes - 1
+        for j in range(self.nmodes - 2, -1, -1):
+            column = self.binom[:, j + 1]
+            bar = numpy.searchsorted(column, remainder, side='right') - 1
+            remainder = remainder - column[bar]
+            # Occupation of mode j + 1 is the number of stars between this bar and the next
+            states[..., j + 1] = above - bar - 1
+            above = bar
+        states[..., 0] = above
+        return states
+
+    def sectorRange(self, n: int) -> Tuple[int, int]:
+        """
+        :param n: total number of excitations
+        :return: start and stop ranks of the states with that total, for a total cutoff
+        """
+        if not self.total:
+            raise ValueError("States of one total are only contiguous with a total cutoff.")
+        start = int(self.binom[n - 1 + self.nmodes, self.nmodes]) if n > 0 else 0
+        return start, int(self.binom[n + self.nmodes, self.nmodes])
+
+    def states(self, start: int = 0, stop: int = None) -> numpy.ndarray:
+        """
+        :return: occupations of the states with ranks in [start, stop)
+        """
+        stop = self.dim if stop is None else min(stop, self.dim)
+        return self.unrank(numpy.arange(start, stop, dtype=numpy.int64))
+
+    def __repr__(self):
+        return "FockBasis({}, {}, total={})".format(self.nmodes, self.cutoff, self.total)
@@ -0,0 +1,121 @@
+"""
+Counting invariant operators from the Hilbert series of a theory, without listing them.
+
+The number of independent invariant polynomials of order n in the fields is the coefficient
+of t^n in the Molien-Weyl integral
+
+    H(t) = integral over the maximal torus of prod_{a > 0} (1 - z^a) PE[t chi(z)]
+
+where chi is the character of all fields and antifields together, a runs over the positive
+roots, and the plethystic exponential PE[t chi(z)] = prod_w 1 / (1 - t z^w) over the weights w
+is expanded as exp(sum_k t^k chi(z^k) / k).
+
+Up to order trunc the integrand is a Laurent polynomial in z of known degree, so averaging it
+over a uniform grid of one more point than that degree along each torus angle gives the
+integral exactly, with a cost polynomial in trunc.
+"""
+import itertools
+import numpy
+from typing import List, Sequence, Tuple
+from PerturbationLib import Utilities
+from PerturbationLib.Symmetries import Symmetry
+
+
+def operatorCounts(syms: Sequence[Symmetry], fields: Sequence, trunc: int,
+                   chunksize: int = 2**14) -> List[int]:
+    """
+    :param syms: symmetries of the theory, each must give torusWeights and positiveRoots
+    :param fields: every field and antifield, each treated as an independent commuting variable
+    :param trunc: highest order counted
+    :param chunksize: number of torus points evaluated at once, bounds memory use
+    :return: [number of invariants of order n for n in 0..trunc], order 0 being the identity
+    """
+    weights, roots = torusData(syms, fields)
+    sizes = gridSizes(weights, roots, trunc)
+    npoints = int(numpy.prod(sizes))
+
+    totals = numpy.zeros(trunc + 1, dtype=complex)
+    scale = numpy.zeros(trunc + 1)
+    steps = 2 * numpy.pi / numpy.array(sizes, dtype=float)
+    for start in range(0, npoints, chunksize):
+        index = numpy.arange(start, min(start + chunksize, npoints))
+        angles = numpy.stack(numpy.unravel_index(index, sizes), axis=1) * steps
+        phases = numpy.exp(1j * angles.dot(weights.T))
+        haar = numpy.prod(1 - numpy.exp(1j * angles.dot(roots.T)), axis=1)
+
+        # Power sums chi(z^k) for k = 1..trunc
+        power = numpy.ones_like(phases)
+        sums = [None]
+        for _ in range(trunc):
+            power *= phases
+            sums.append(power.sum(axis=1))
+
+        # Coefficients of exp(sum_k t^k chi(z^k) / k): n a_n = sum_k chi(z^k) a_{n-k}
+        series = [numpy.ones(len(index), dtype=complex)]
+        for n in range(1, trunc + 1):
+            series.append(sum(sums[k] * series[n - k] for k in range(1, n + 1)) / n)
+        for n in range(trunc + 1):
+            terms = haar * series[n]
+            totals[n] += terms.sum()
+            scale[n] = max(scale[n], numpy.abs(terms).max(initial=0))
+
+    counts = totals / npoints
+    rounded = numpy.rint(counts.real)
+    # Terms of size scale cancel to leave the count, beyond 2^52 of them rounding error swamps it
+    if numpy.any(scale * numpy.finfo(float).eps * 64 > 0.5) or numpy.any(numpy.abs(counts - rounded) > 0.1):
+        raise ValueError("Counts too large to find exactly in double precision, lower trunc.")
+    return [int(c) for c in rounded]
+
+
+def torusData(syms: Sequence[Symmetry], fields: Sequence) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Weights of every state of every field on the torus of the product of the symmetries, a
+    field's states being every combination of its states under each symmetry. Rational weights,
+    such as fractional U(1) charges, are scaled to integers along each torus angle by the least
+    common multiple of their denominators over all fields. This only relabels the points of a
+    circle with no roots along it, so the integral is unchanged.
+    :return: weights of shape (total number of states, total rank), roots of shape (number, total rank)
+    """
+    roots = []
+    for sym in syms:
+        r = sym.positiveRoots()
+        if r is None:
+            raise ValueError("Cannot integrate over symmetry {}".format(sym.name))
+        roots.append(r)
+    ranks = [r.shape[1] for r in roots]
+    offsets = numpy.concatenate([[0], numpy.cumsum(ranks)]).astype(int)
+    allroots = numpy.zeros((sum(len(r) for r in roots), offsets[-1]), dtype=int)
+    row = 0
+    for i, r in enumerate(roots):
+        allroots[row:row + len(r), offsets[i]:offsets[i + 1]] = r
+        row += len(r)
+
+    allweights = []
+    for field in fields:
+        parts = []
+        for sym in syms:
+            fsym = next((s for s in field.syms if s.name == sym.name), None)
+            w = fsym.torusWeights() if fsym is not None else None
+            if w is None:
+                raise ValueError("No weights for field {} under {}".format(field, sym.name))
+            parts.append(numpy.asarray(w, dtype=object).reshape(-1, ranks[len(parts)]))
+        for combination in itertools.product(*parts):
+            allweights.append([x for part in combination for x in part])
+    if len(allweights) == 0 or offsets[-1] == 0:
+        return numpy.zeros((len(allweights), offsets[-1]), dtype=int), allroots
+    weights = Utilities.integerColumns(allweights)
+    if numpy.any(allroots[:, numpy.any(weights != numpy.array(allweights, dtype=object), axis=0)]):
+        raise ValueError("Rational weights along an angle with roots.")
+    return weights, allroots
+
+
+def gridSizes(weights: numpy.ndarray, roots: numpy.ndarray, trunc: int) -> Tuple[int, ...]:
+    """
+    Up to order trunc, the integrand's degree along each torus angle is at most trunc times the
+    largest weight along it plus the sum of the roots along it, and a grid of one more point
+    than that degree averages every nonzero power of z away.
+    :return: number of grid points along each angle
+    """
+    biggest = numpy.abs(weights).max(axis=0) if len(weights) > 0 else numpy.zeros(weights.shape[1], dtype=int)
+    degree = trunc * biggest + numpy.abs(roots).sum(axis=0)
+    return tuple(int(d) + 1 for d in degree)
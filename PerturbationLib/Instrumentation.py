@@ -0,0 +1,80 @@
+"""
+Opt-in counters and timers for the hot paths of Lagrangian and diagram generation.
+"""
+import time
+from contextlib import contextmanager
+from typing import Mapping
+
+# Stats collecting counts from code with no handle on a Theory or Feynman (symmetries,
+# tableaux). Set only while an enabled Stats is active, callers check it against None.
+ACTIVE = None
+
+
+class Stats:
+    """
+    Named counters and accumulated wall times. When disabled every method returns
+    immediately, and the inner loops of Theory and Feynman skip instrumentation
+    altogether after checking the enabled flag once.
+    """
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.counters = {}
+        self.times = {}
+
+    def enable(self) -> 'Stats':
+        self.enabled = True
+        return self
+
+    def disable(self) -> 'Stats':
+        self.enabled = False
+        return self
+
+    def reset(self):
+        self.counters = {}
+        self.times = {}
+
+    def count(self, name: str, n: int = 1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def addTime(self, name: str, seconds: float):
+        if self.enabled:
+            self.times[name] = self.times.get(name, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        Accumulate the wall time spent inside the with block under name
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.addTime(name, time.perf_counter() - start)
+
+    @contextmanager
+    def activate(self):
+        """
+        Make this the Stats receiving counts from symmetries and tableaux inside the with block
+        """
+        global ACTIVE
+        if not self.enabled:
+            yield
+            return
+        previous = ACTIVE
+        ACTIVE = self
+        try:
+            yield
+        finally:
+            ACTIVE = previous
+
+    def asDict(self) -> Mapping:
+        return {"counters": dict(self.counters), "times": dict(self.times)}
+
+    def __repr__(self):
+        lines = ["{:<32} {:>12}".format(name, n) for name, n in sorted(self.counters.items())]
+        lines += ["{:<32} {:>11.4f}s".format(name, t) for name, t in sorted(self.times.items())]
+        return "\n".join(lines)
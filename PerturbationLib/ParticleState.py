@@ -3,9 +3,14 @@ A library for SHO level perturbation theory. Mostly for keeping track of constan
 """
 
 import itertools
+import json
+import os
+import shutil
+import tempfile
+import numpy
 import sympy
 from sympy import latex
-from typing import Iterable
+from typing import Generator, Iterable, List, Mapping, Sequence, Tuple, Union
 
 
 class Braket:
@@ -236,7 +241,9 @@ class XOp(Operator):
         return self.__mul__(state)
 
     def __mul__(self, other):
-        if other.__class__==SingleState or other.__class__==State:
+        if other.__class__==MappedState:
+            return other.apply(self)
+        elif other.__class__==SingleState or other.__class__==State:
             return (COp(self.index) * other) + (AOp(self.index) * other)
         elif issubclass(other.__class__,Operator):
             # a * O -> [a O]
@@ -280,7 +287,9 @@ class COp(Operator):
         return self.__mul__(state)
 
     def __mul__(self, other):
-        if other.__class__==State:
+        if other.__class__==MappedState:
+            return other.apply(self)
+        elif other.__class__==State:
             other = other.copy()
             for i in range(len(other.states)):
                 other.states[i].particles[self.index] += 1
@@ -334,7 +343,9 @@ class AOp(Operator):
         return self.__mul__(state)
 
     def __mul__(self, other):
-        if other.__class__==State:
+        if other.__class__==MappedState:
+            return other.apply(self)
+        elif other.__class__==State:
             other = other.copy()
             for i in range(len(other.states)):
                 if other.states[i].particles[self.index]<=0:
@@ -386,6 +397,101 @@ class AOp(Operator):
         return AOp(self.index,self.mult)
 
 
+class FCOp(Operator):
+    '''
+    Fermionic creation operator, c'_i|n> = (-1)^(n_0 + ... + n_{i-1}) |n with mode i filled>, zero if already filled
+    '''
+    def __init__(self, index, mult=1):
+        self.index = index
+        self.mult = mult
+
+    def __call__(self, state):
+        return self.__mul__(state)
+
+    def __mul__(self, other):
+        if other.__class__==FermionState:
+            return other.apply(self)
+        elif issubclass(other.__class__,Operator):
+            # c * O -> [c O]
+            return OpProduct([self, other])
+        new = self.copy()
+        new.mult *= other
+        return new
+
+    def __add__(self, other):
+        if issubclass(other.__class__,Operator):
+            if other.__class__ == OpSum:
+                return OpSum([self] + other.ops)
+            else:
+                return OpSum([self] + [other])
+        else:
+            raise TypeError("Cannot add operator to anything except operators")
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __repr__(self):
+        mstr = "" if (self.mult==1) else latex(self.mult)
+        return mstr+"c'_"+str(self.index)
+
+    def _latex(self, *args):
+        mstr = "" if (self.mult==1) else latex(self.mult)
+        return mstr+"c^{\\dag}_{"+str(self.index)+"}"
+
+    def _repr_latex_(self):
+        return "$"+self._latex()+"$"
+
+    def copy(self):
+        return FCOp(self.index,self.mult)
+
+class FAOp(Operator):
+    '''
+    Fermionic annihilation operator, c_i|n> = (-1)^(n_0 + ... + n_{i-1}) |n with mode i emptied>, zero if already empty
+    '''
+    def __init__(self, index, mult=1):
+        self.index = index
+        self.mult = mult
+
+    def __call__(self, state):
+        return self.__mul__(state)
+
+    def __mul__(self, other):
+        if other.__class__==FermionState:
+            return other.apply(self)
+        elif issubclass(other.__class__,Operator):
+            # c * O -> [c O]
+            return OpProduct([self, other])
+        new = self.copy()
+        new.mult *= other
+        return new
+
+    def __add__(self, other):
+        if issubclass(other.__class__,Operator):
+            if other.__class__ == OpSum:
+                return OpSum([self] + other.ops)
+            else:
+                return OpSum([self] + [other])
+        else:
+            raise TypeError("Cannot add operator to anything except operators")
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __repr__(self):
+        mstr = "" if (self.mult==1) else latex(self.mult)
+        return mstr+"c_"+str(self.index)
+
+    def _latex(self, *args):
+        mstr = "" if (self.mult==1) else latex(self.mult)
+        return mstr+"c_{"+str(self.index)+"}"
+
+    def _repr_latex_(self):
+        return "$"+self._latex()+"$"
+
+    def copy(self):
+        return FAOp(self.index,self.mult)
+
+
 class OpProduct(Operator):
     def __init__(self, ops, mult=1):
         self.ops = [op.copy() for op in ops]
@@ -411,6 +517,8 @@ class OpProduct(Operator):
                 return OpProduct(self.ops + other.ops)
             else:
                 return OpProduct(self.ops + [other])
+        elif other.__class__ == FermionState or other.__class__ == MappedState:
+            return other.apply(self)
         elif other.__class__ == SingleState or other.__class__ == State:
             acc = other
             for op in reversed(self.ops):
@@ -469,6 +577,8 @@ class OpSum(Operator):
                 return OpProduct([self] + other.ops)
             else:
                 return OpProduct([self] + [other])
+        elif other.__class__ == FermionState or other.__class__ == MappedState:
+            return other.apply(self)
         elif other.__class__ == SingleState or other.__class__ == State:
             acc = State([])
             for op in self.ops:
@@ -557,6 +667,534 @@ class DeltaH(Operator):
         return output_states
 
 
+# A product of creation (True) and annihilation (False) operators on modes, written left to
+# right and applied right to left as OpProduct does
+Ladder = Tuple[Tuple[int, bool], ...]
+
+
+def ladderTerms(op: Operator, fermionic: bool = False) -> List[Tuple[object, Ladder]]:
+    """
+    Expand an operator expression into a sum of ladder products, keeping multipliers exact
+    :param op: COp, AOp, XOp or sums and products of them
+    :param fermionic: expand FCOp and FAOp instead, bosonic operators are then rejected
+    :return: [(coefficient, ladder)] with equal ladders combined
+    """
+    terms = {}
+    for coefficient, ladder in _expandLadders(op, fermionic):
+        terms[ladder] = terms.get(ladder, 0) + coefficient
+    return [(c, ladder) for ladder, c in terms.items() if c != 0]
+
+
+def _expandLadders(op: Operator, fermionic: bool = False) -> List[Tuple[object, Ladder]]:
+    if isinstance(op, FCOp if fermionic else COp):
+        return [(op.mult, ((op.index, True),))]
+    elif isinstance(op, FAOp if fermionic else AOp):
+        return [(op.mult, ((op.index, False),))]
+    elif isinstance(op, XOp) and not fermionic:
+        return [(op.mult, ((op.index, True),)), (op.mult, ((op.index, False),))]
+    elif isinstance(op, OpProduct):
+        terms = [(op.mult, ())]
+        for sub in op.ops:
+            terms = [(c1 * c2, l1 + l2) for c1, l1 in terms for c2, l2 in _expandLadders(sub, fermionic)]
+        return terms
+    elif isinstance(op, OpSum):
+        return [(op.mult * c, ladder) for sub in op.ops for c, ladder in _expandLadders(sub, fermionic)]
+    raise TypeError("Cannot expand operator of type {}".format(type(op).__name__))
+
+
+def expectationValues(state: Union[State, SingleState], operators: Sequence[Operator],
+                      covariance: bool = False):
+    """
+    <O> = <psi|O|psi> / <psi|psi> for every operator, and optionally the covariance matrix
+    C_ij = <O_i^dag O_j> - <O_i>^* <O_j>.
+    Operators are expanded into ladder products, and the state left by each suffix of a ladder
+    product is computed once and shared by every product ending in it, across all operators.
+    States are kept as dicts from occupations to coefficients, so sums and inner products are
+    hash lookups rather than comparisons of every pair of terms.
+    :param state: ket
+    :param operators: operator expressions
+    :param covariance: also return the covariance matrix
+    :return: [<O_i>], or ([<O_i>], [[C_ij]]) if covariance
+    """
+    states = state.states if isinstance(state, State) else [state]
+    ket = {}
+    for s in states:
+        key = tuple(s.particles)
+        ket[key] = ket.get(key, 0) + s.mult
+
+    suffixes = {(): ket}
+
+    def applySuffix(ladder: Ladder) -> Mapping[Tuple[int, ...], object]:
+        if ladder not in suffixes:
+            mode, creation = ladder[0]
+            result = {}
+            for occupation, c in applySuffix(ladder[1:]).items():
+                n = occupation[mode]
+                if not creation and n <= 0:
+                    continue
+                new = list(occupation)
+                new[mode] = n + 1 if creation else n - 1
+                new = tuple(new)
+                result[new] = result.get(new, 0) + c * sympy.sqrt(n + 1 if creation else n)
+            suffixes[ladder] = result
+        return suffixes[ladder]
+
+    applied = []
+    for op in operators:
+        result = {}
+        for coefficient, ladder in ladderTerms(op):
+            for occupation, c in applySuffix(ladder).items():
+                result[occupation] = result.get(occupation, 0) + coefficient * c
+        applied.append(result)
+
+    norm = innerProduct(ket, ket)
+    values = [innerProduct(ket, a) / norm for a in applied]
+    if not covariance:
+        return values
+    matrix = [[innerProduct(applied[i], applied[j]) / norm - sympy.conjugate(values[i]) * values[j]
+               for j in range(len(applied))] for i in range(len(applied))]
+    return values, matrix
+
+
+def innerProduct(bra: Mapping[Tuple[int, ...], object], ket: Mapping[Tuple[int, ...], object]):
+    """
+    <bra|ket> for states given as dicts from occupations to coefficients
+    """
+    if len(bra) > len(ket):
+        return sum((sympy.conjugate(bra[k]) * c for k, c in ket.items() if k in bra), 0)
+    return sum((sympy.conjugate(c) * ket[k] for k, c in bra.items() if k in ket), 0)
+
+
+class FermionState:
+    """
+    A sum of fermionic basis states held as NumPy arrays. Each basis state is packed into
+    ceil(nmodes / 64) uint64 words, mode i being bit i % 64 of word i // 64, so bits has shape
+    (number of states, words) and coefficients has one entry per row.
+
+    Operators are applied to every row at once: filling or emptying a mode is an xor with its
+    bit, whether that is allowed is an and, and the sign (-1)^(n_0 + ... + n_{i-1}) is the
+    parity of the popcount of the bits below mode i. Rows left equal are then combined.
+    """
+    WORD = 64
+
+    def __init__(self, occupations: Iterable[Iterable[int]], coefficients: Iterable = None, nmodes: int = None):
+        """
+        FermionState([[1,0,1]]) -> |1,0,1>
+        :param occupations: 0/1 occupation of each mode, one row per basis state
+        :param coefficients: coefficient of each basis state, all 1 if None
+        :param nmodes: number of modes, defaults to the length of the rows
+        """
+        occupations = numpy.asarray([list(o) for o in occupations], dtype=numpy.uint8)
+        if len(occupations) == 0:
+            occupations = numpy.zeros((0, nmodes or 0), dtype=numpy.uint8)
+        if numpy.any(occupations > 1):
+            raise ValueError("Fermionic modes hold at most one particle.")
+        nmodes = occupations.shape[1] if nmodes is None else nmodes
+        if occupations.shape[1] != nmodes:
+            raise ValueError("Occupations do not have {} modes.".format(nmodes))
+        nwords = max(1, -(-nmodes // FermionState.WORD))
+        padded = numpy.zeros((len(occupations), nwords * FermionState.WORD), dtype=numpy.uint8)
+        padded[:, :nmodes] = occupations
+        # Little endian bit order puts mode 64 * w + b at bit b of byte 8 * w + b // 8
+        packed = numpy.packbits(padded, axis=1, bitorder='little')
+        bits = packed.view('<u8').astype(numpy.uint64).reshape(len(occupations), nwords)
+        if coefficients is None:
+            coefficients = numpy.ones(len(occupations))
+        self.nmodes = nmodes
+        self.bits, self.coefficients = _combineRows(bits, _coefficientArray(coefficients))
+
+    @classmethod
+    def fromBits(cls, bits: numpy.ndarray, coefficients: Iterable, nmodes: int) -> 'FermionState':
+        """
+        :param bits: uint64 array of shape (states, words), or (states,) for up to 64 modes
+        :param coefficients: coefficient of each row
+        :param nmodes: number of modes
+        """
+        bits = numpy.asarray(bits, dtype=numpy.uint64)
+        state = cls([], nmodes=nmodes)
+        state.bits, state.coefficients = _combineRows(bits.reshape(len(bits), -1),
+                                                      _coefficientArray(coefficients))
+        return state
+
+    def __len__(self):
+        return len(self.bits)
+
+    def occupations(self) -> numpy.ndarray:
+        """
+        :return: uint8 array of shape (states, nmodes)
+        """
+        packed = self.bits.astype('<u8').view(numpy.uint8).reshape(len(self.bits), -1)
+        return numpy.unpackbits(packed, axis=1, bitorder='little')[:, :self.nmodes]
+
+    def apply(self, op: Operator) -> 'FermionState':
+        """
+        :param op: FCOp, FAOp or sums and products of them
+        :return: op|self>
+        """
+        parts_bits, parts_coefficients = [], []
+        for coefficient, ladder in ladderTerms(op, fermionic=True):
+            bits = self.bits.copy()
+            coefficients = self.coefficients * complex(coefficient)
+            for mode, creation in reversed(ladder):
+                if mode >= self.nmodes:
+                    raise ValueError("Mode {} outside of {} modes.".format(mode, self.nmodes))
+                word, bit = divmod(mode, FermionState.WORD)
+                mask = numpy.uint64(1) << numpy.uint64(bit)
+                occupied = (bits[:, word] & mask) != 0
+                allowed = ~occupied if creation else occupied
+                below = popcount(bits[:, word] & (mask - numpy.uint64(1))).astype(numpy.int64)
+                if word > 0:
+                    below += popcount(bits[:, :word]).sum(axis=1, dtype=numpy.int64)
+                bits = bits[allowed]
+                bits[:, word] ^= mask
+                coefficients = coefficients[allowed] * (1 - 2 * (below[allowed] & 1))
+            parts_bits.append(bits)
+            parts_coefficients.append(coefficients)
+        state = FermionState([], nmodes=self.nmodes)
+        if len(parts_bits) > 0:
+            state.bits, state.coefficients = _combineRows(numpy.concatenate(parts_bits),
+                                                          _coefficientArray(numpy.concatenate(parts_coefficients)))
+        return state
+
+    def innerProduct(self, other: 'FermionState'):
+        """
+        :return: <self|other>
+        """
+        if self.nmodes != other.nmodes:
+            raise ValueError("States have different numbers of modes.")
+        _, inverse = _uniqueRows(numpy.concatenate([self.bits, other.bits]))
+        bra = numpy.zeros(inverse.max() + 1 if len(inverse) else 0, dtype=complex)
+        ket = numpy.zeros_like(bra)
+        bra[inverse[:len(self)]] = numpy.conjugate(self.coefficients)
+        ket[inverse[len(self):]] = other.coefficients
+        value = bra.dot(ket)
+        return value.real if value.imag == 0 else value
+
+    def norm(self) -> float:
+        return float(numpy.sqrt(numpy.sum(numpy.abs(self.coefficients) ** 2)))
+
+    def __add__(self, other: 'FermionState') -> 'FermionState':
+        if other.__class__ != FermionState or other.nmodes != self.nmodes:
+            raise TypeError("Can only add fermionic states with the same modes")
+        return FermionState.fromBits(numpy.concatenate([self.bits, other.bits]),
+                                     numpy.concatenate([self.coefficients, other.coefficients]), self.nmodes)
+
+    def __mul__(self, other) -> 'FermionState':
+        return FermionState.fromBits(self.bits, self.coefficients * complex(other), self.nmodes)
+
+    def __rmul__(self, other) -> 'FermionState':
+        return self.__mul__(other)
+
+    def __neg__(self) -> 'FermionState':
+        return self.__mul__(-1)
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __repr__(self):
+        terms = []
+        for c, occupation in zip(self.coefficients.tolist(), self.occupations().tolist()):
+            mstr = "" if c == 1 else str(c)
+            terms.append(mstr + "|" + ",".join(str(i) for i in occupation) + ">")
+        return " + ".join(terms)
+
+
+def _popcount(words: numpy.ndarray) -> numpy.ndarray:
+    """
+    Number of set bits in each uint64, for NumPy versions without bitwise_count
+    """
+    words = words - ((words >> numpy.uint64(1)) & numpy.uint64(0x5555555555555555))
+    words = (words & numpy.uint64(0x3333333333333333)) + ((words >> numpy.uint64(2)) & numpy.uint64(0x3333333333333333))
+    words = (words + (words >> numpy.uint64(4))) & numpy.uint64(0x0f0f0f0f0f0f0f0f)
+    return (words * numpy.uint64(0x0101010101010101)) >> numpy.uint64(56)
+
+
+popcount = getattr(numpy, "bitwise_count", _popcount)
+
+
+def _coefficientArray(coefficients: Iterable) -> numpy.ndarray:
+    coefficients = numpy.asarray(coefficients, dtype=complex).reshape(-1)
+    return coefficients.real.copy() if not numpy.any(coefficients.imag) else coefficients
+
+
+def _uniqueRows(bits: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    if bits.shape[1] == 1:
+        unique, inverse = numpy.unique(bits[:, 0], return_inverse=True)
+        return unique[:, None], inverse.reshape(-1)
+    unique, inverse = numpy.unique(bits, axis=0, return_inverse=True)
+    return unique, inverse.reshape(-1)
+
+
+def _combineRows(bits: numpy.ndarray, coefficients: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Sum the coefficients of equal rows and drop those which cancel
+    """
+    if len(bits) == 0:
+        return bits.reshape(0, bits.shape[1] if bits.ndim == 2 else 1), coefficients[:0]
+    unique, inverse = _uniqueRows(bits)
+    summed = numpy.zeros(len(unique), dtype=coefficients.dtype)
+    numpy.add.at(summed, inverse, coefficients)
+    keep = summed != 0
+    return unique[keep], summed[keep]
+
+
+class MappedState:
+    """
+    A bosonic state too large for memory, kept in a directory as two flat files mapped with
+    numpy.memmap: the occupations as big endian uint16, one row of nmodes per basis state, and
+    the coefficients as complex128. Rows are unique and sorted, each row read as a string of
+    bytes being its key, so big endian occupations sort the way the keys do.
+
+    Applying an operator streams the rows through in chunks and writes a new state. The terms
+    produced are merged by an external sort: each chunk's worth is sorted and reduced in memory
+    and written out as a run, then runs are merged in pairs, reading them block by block, until
+    one is left. Coefficients are numerical, unlike those of State.
+    """
+    OCCUPATION = numpy.dtype('>u2')
+    COEFFICIENT = numpy.dtype(complex)
+    META = "state.json"
+    OCCUPATIONS = "occupations.bin"
+    COEFFICIENTS = "coefficients.bin"
+
+    def __init__(self, directory: str):
+        """
+        Open a state written by fromArrays, fromState or apply
+        :param directory: directory holding the state
+        """
+        with open(os.path.join(directory, MappedState.META)) as f:
+            self.nmodes = json.load(f)["nmodes"]
+        self.directory = directory
+        self.occupations = _mapFile(os.path.join(directory, MappedState.OCCUPATIONS), MappedState.OCCUPATION,
+                                    self.nmodes)
+        self.coefficients = _mapFile(os.path.join(directory, MappedState.COEFFICIENTS), MappedState.COEFFICIENT)
+        if len(self.occupations) != len(self.coefficients):
+            raise ValueError("Occupations and coefficients of {} differ in length.".format(directory))
+
+    @classmethod
+    def fromArrays(cls, occupations: numpy.ndarray, coefficients: Iterable, directory: str = None,
+                   chunksize: int = 2**20) -> 'MappedState':
+        """
+        :param occupations: occupations of shape (states, nmodes), in any order and possibly repeated
+        :param coefficients: coefficient of each row
+        :param directory: directory to write the state to, a new temporary one if None
+        :param chunksize: number of rows sorted in memory at once
+        """
+        occupations = numpy.asarray(occupations)
+        coefficients = numpy.asarray(coefficients, dtype=MappedState.COEFFICIENT).reshape(-1)
+        pieces = ((occupations[i:i + chunksize], coefficients[i:i + chunksize])
+                  for i in range(0, len(occupations), chunksize))
+        return _sortReduce(pieces, occupations.shape[1], directory, chunksize)
+
+    @classmethod
+    def fromState(cls, state: Union[State, SingleState], directory: str = None,
+                  chunksize: int = 2**20) -> 'MappedState':
+        states = state.states if isinstance(state, State) else [state]
+        return cls.fromArrays(numpy.array([s.particles for s in states]).reshape(len(states), -1),
+                              [complex(s.mult) for s in states], directory, chunksize)
+
+    def __len__(self):
+        return len(self.coefficients)
+
+    def keys(self) -> numpy.ndarray:
+        """
+        :return: one byte string per row, sorted
+        """
+        return self.occupations.view('S{}'.format(MappedState.OCCUPATION.itemsize * self.nmodes)).reshape(-1)
+
+    def chunks(self, chunksize: int = 2**20) -> Generator[Tuple[numpy.ndarray, numpy.ndarray], None, None]:
+        """
+        :yield: (int64 occupations, coefficients) of consecutive rows
+        """
+        for start in range(0, len(self), chunksize):
+            yield (self.occupations[start:start + chunksize].astype(numpy.int64),
+                   numpy.array(self.coefficients[start:start + chunksize]))
+
+    def apply(self, op: Operator, directory: str = None, chunksize: int = 2**20) -> 'MappedState':
+        """
+        The factors of a product are applied one at a time, right to left, each intermediate
+        state being written to disk and removed once the next is done.
+        :param op: COp, AOp, XOp or sums and products of them
+        :param directory: directory to write op|self> to, a new temporary one if None
+        :param chunksize: number of rows processed at once, bounds memory use
+        :return: op|self>
+        """
+        if isinstance(op, OpProduct) and len(op.ops) > 1:
+            factors = [ladderTerms(sub) for sub in reversed(op.ops)]
+            factors[0] = [(op.mult * c, ladder) for c, ladder in factors[0]]
+        else:
+            factors = [ladderTerms(op)]
+        # Intermediate states go beside the result, on the same disk
+        parent = os.path.dirname(os.path.abspath(directory)) if directory is not None else None
+        acc = self
+        for i, terms in enumerate(factors):
+            last = i == len(factors) - 1
+            target = directory if last else tempfile.mkdtemp(prefix="MappedState-", dir=parent)
+            applied = _sortReduce(acc._applyTerms(terms, chunksize), self.nmodes, target, chunksize)
+            if acc is not self:
+                acc.delete()
+            acc = applied
+        return acc
+
+    def _applyTerms(self, terms: Sequence[Tuple[object, Ladder]],
+                    chunksize: int) -> Generator[Tuple[numpy.ndarray, numpy.ndarray], None, None]:
+        limit = numpy.iinfo(MappedState.OCCUPATION).max
+        for chunk, coefficients in self.chunks(chunksize):
+            for coefficient, ladder in terms:
+                factor = coefficients * complex(coefficient)
+                target = chunk.copy()
+                for mode, creation in reversed(ladder):
+                    n = target[:, mode]
+                    if creation:
+                        factor *= numpy.sqrt(n + 1)
+                        target[:, mode] = n + 1
+                    else:
+                        factor *= numpy.sqrt(numpy.maximum(n, 0))
+                        target[:, mode] = n - 1
+                valid = factor != 0
+                if numpy.any(target[valid] > limit):
+                    raise ValueError("Occupation above {} cannot be stored.".format(limit))
+                yield target[valid], factor[valid]
+
+    def innerProduct(self, other: 'MappedState', chunksize: int = 2**20):
+        """
+        :return: <self|other>, found by looking up each block of keys of self in the sorted keys of other
+        """
+        if self.nmodes != other.nmodes:
+            raise ValueError("States have different numbers of modes.")
+        total = 0
+        keys, others = self.keys(), other.keys()
+        if len(others) == 0:
+            return 0
+        for start in range(0, len(self), chunksize):
+            block = numpy.array(keys[start:start + chunksize])
+            position = numpy.minimum(numpy.searchsorted(others, block), len(others) - 1)
+            match = others[position] == block
+            total += numpy.dot(numpy.conjugate(self.coefficients[start:start + chunksize][match]),
+                               other.coefficients[position[match]])
+        return total.real if total.imag == 0 else total
+
+    def toState(self) -> State:
+        return State([SingleState(o, c.real if c.imag == 0 else c)
+                      for o, c in zip(self.occupations.tolist(), self.coefficients.tolist())])
+
+    def delete(self):
+        """
+        Remove the files of this state
+        """
+        self.occupations = self.coefficients = None
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __repr__(self):
+        return "MappedState({} states of {} modes in {})".format(len(self), self.nmodes, self.directory)
+
+
+def _mapFile(path: str, dtype: numpy.dtype, width: int = None) -> numpy.ndarray:
+    shape = (-1,) if width is None else (-1, width)
+    if os.path.getsize(path) == 0:
+        return numpy.zeros(0, dtype=dtype).reshape(shape)
+    return numpy.memmap(path, dtype=dtype, mode='r').reshape(shape)
+
+
+def _writeState(directory: str, nmodes: int, pieces: Iterable[Tuple[numpy.ndarray, numpy.ndarray]]) -> MappedState:
+    """
+    Append sorted rows to the files of a new state
+    """
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, MappedState.OCCUPATIONS), "wb") as occ, \
+            open(os.path.join(directory, MappedState.COEFFICIENTS), "wb") as coef:
+        for occupations, coefficients in pieces:
+            occ.write(numpy.ascontiguousarray(occupations, dtype=MappedState.OCCUPATION).tobytes())
+            coef.write(numpy.ascontiguousarray(coefficients, dtype=MappedState.COEFFICIENT).tobytes())
+    with open(os.path.join(directory, MappedState.META), "w") as f:
+        json.dump({"nmodes": nmodes}, f)
+    return MappedState(directory)
+
+
+def _reduceRows(occupations: numpy.ndarray, coefficients: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Sort rows by key, sum the coefficients of equal rows and drop those which cancel
+    """
+    nmodes = occupations.shape[1]
+    occupations = numpy.ascontiguousarray(occupations, dtype=MappedState.OCCUPATION)
+    keys = occupations.view('S{}'.format(MappedState.OCCUPATION.itemsize * nmodes)).reshape(-1)
+    unique, inverse = numpy.unique(keys, return_inverse=True)
+    summed = numpy.zeros(len(unique), dtype=MappedState.COEFFICIENT)
+    numpy.add.at(summed, inverse.reshape(-1), coefficients)
+    keep = summed != 0
+    return unique[keep].view(MappedState.OCCUPATION).reshape(-1, nmodes), summed[keep]
+
+
+def _sortReduce(pieces: Iterable[Tuple[numpy.ndarray, numpy.ndarray]], nmodes: int, directory: str,
+                chunksize: int) -> MappedState:
+    """
+    External sort of rows arriving in pieces: runs of about chunksize rows are sorted and reduced
+    in memory and written to a scratch directory beside the target, then merged in pairs.
+    """
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix="MappedState-")
+    parent = os.path.dirname(os.path.abspath(directory))
+    with tempfile.TemporaryDirectory(dir=parent, prefix=".runs-") as scratch:
+        runs = []
+
+        def flush(buffered):
+            occupations = numpy.concatenate([o for o, _ in buffered]) if buffered else numpy.zeros((0, nmodes))
+            coefficients = numpy.concatenate([c for _, c in buffered]) if buffered else numpy.zeros(0)
+            path = os.path.join(scratch, str(len(runs)))
+            runs.append(_writeState(path, nmodes, [_reduceRows(occupations, coefficients)]))
+
+        buffered, count = [], 0
+        for occupations, coefficients in pieces:
+            buffered.append((occupations, coefficients))
+            count += len(occupations)
+            if count >= chunksize:
+                flush(buffered)
+                buffered, count = [], 0
+        if buffered or not runs:
+            flush(buffered)
+
+        merged = len(runs)
+        while len(runs) > 1:
+            paired = []
+            for i in range(0, len(runs) - 1, 2):
+                path = os.path.join(scratch, str(merged))
+                merged += 1
+                paired.append(_writeState(path, nmodes, _mergeRuns(runs[i], runs[i + 1], chunksize)))
+                runs[i].delete()
+                runs[i + 1].delete()
+            if len(runs) % 2 == 1:
+                paired.append(runs[-1])
+            runs = paired
+
+        os.makedirs(directory, exist_ok=True)
+        for name in [MappedState.OCCUPATIONS, MappedState.COEFFICIENTS, MappedState.META]:
+            os.replace(os.path.join(runs[0].directory, name), os.path.join(directory, name))
+    return MappedState(directory)
+
+
+def _mergeRuns(a: MappedState, b: MappedState,
+               chunksize: int) -> Generator[Tuple[numpy.ndarray, numpy.ndarray], None, None]:
+    """
+    Merge two sorted runs a block at a time. Rows are only emitted up to the smallest last key
+    of the blocks of runs with rows left beyond them, so every copy of a key is emitted together.
+    """
+    akeys, bkeys = a.keys(), b.keys()
+    i = j = 0
+    while i < len(a) or j < len(b):
+        ablock = numpy.array(akeys[i:i + chunksize])
+        bblock = numpy.array(bkeys[j:j + chunksize])
+        bounds = [block[-1] for block, start, run in [(ablock, i, a), (bblock, j, b)]
+                  if start + len(block) < len(run)]
+        na, nb = len(ablock), len(bblock)
+        if bounds:
+            cutoff = min(bounds)
+            na = numpy.searchsorted(ablock, cutoff, side='right')
+            nb = numpy.searchsorted(bblock, cutoff, side='right')
+        yield _reduceRows(numpy.concatenate([a.occupations[i:i + na], b.occupations[j:j + nb]]),
+                          numpy.concatenate([a.coefficients[i:i + na], b.coefficients[j:j + nb]]))
+        i += na
+        j += nb
+
+
 # ===================================== #
 # Helper functions for above operations # =====================================
 # ===================================== #
@@ -0,0 +1,226 @@
+"""
+Flat phase space generation and Monte Carlo integration of cross sections and decay widths.
+"""
+import math
+import numpy
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Sequence, Tuple, Iterable
+
+
+def rambo(sqrts: float, masses: Sequence[float], npoints: int,
+          rng: numpy.random.Generator) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Generates momenta uniformly in n-body phase space in the centre of mass frame with the
+    RAMBO algorithm (Kleiss, Stirling and Ellis), massive momenta being obtained by rescaling.
+    Weights are normalized to the Lorentz invariant phase space
+    prod_i d^3p_i / ((2 pi)^3 2 E_i) (2 pi)^4 delta^4(P - sum_i p_i).
+    :param sqrts: total energy
+    :param masses: mass of each outgoing particle
+    :param npoints: number of phase space points
+    :param rng: numpy random generator
+    :return: momenta of shape (npoints, n, 4), weights of shape (npoints,)
+    """
+    masses = numpy.asarray(masses, dtype=float)
+    n = len(masses)
+    if n < 2:
+        raise ValueError("RAMBO needs at least two outgoing particles.")
+    if masses.sum() >= sqrts:
+        raise ValueError("Not enough energy to produce the outgoing particles.")
+
+    # Massless momenta with isotropic directions and energies distributed as q e^{-q}
+    r = rng.random((npoints, n, 4))
+    cos = 2.0 * r[..., 0] - 1.0
+    sin = numpy.sqrt(1.0 - cos ** 2)
+    phi = 2.0 * math.pi * r[..., 1]
+    q0 = -numpy.log(r[..., 2] * r[..., 3])
+    q = numpy.stack([q0, q0 * sin * numpy.cos(phi), q0 * sin * numpy.sin(phi), q0 * cos], axis=-1)
+
+    # Boost and scale so that they sum to (sqrts, 0, 0, 0)
+    total = q.sum(axis=1)
+    mass = numpy.sqrt(total[:, 0] ** 2 - numpy.sum(total[:, 1:] ** 2, axis=-1))
+    b = -total[:, 1:] / mass[:, None]
+    gamma = total[:, 0] / mass
+    a = 1.0 / (1.0 + gamma)
+    x = sqrts / mass
+    bq = numpy.einsum('ni,nki->nk', b, q[..., 1:])
+    p = numpy.empty_like(q)
+    p[..., 0] = x[:, None] * (gamma[:, None] * q[..., 0] + bq)
+    p[..., 1:] = x[:, None, None] * (q[..., 1:] + b[:, None, :] * (q[..., 0] + a[:, None] * bq)[..., None])
+
+    logweight = (4 - 3 * n) * math.log(2 * math.pi) + (n - 1) * math.log(math.pi / 2) \
+        + (2 * n - 4) * math.log(sqrts) - math.lgamma(n) - math.lgamma(n - 1)
+    weights = numpy.full(npoints, math.exp(logweight))
+    if numpy.any(masses > 0):
+        p, weights = _massive(p, weights, sqrts, masses)
+    return p, weights
+
+
+def _massive(p: numpy.ndarray, weights: numpy.ndarray, sqrts: float,
+             masses: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Rescale massless momenta summing to sqrts onto mass shells, solving
+    sum_i sqrt(m_i^2 + xi^2 E_i^2) = sqrts for xi by Newton iteration.
+    """
+    e = p[..., 0]
+    m2 = masses[None, :] ** 2
+    xi = numpy.full(len(p), math.sqrt(1.0 - (masses.sum() / sqrts) ** 2))
+    for _ in range(50):
+        energies = numpy.sqrt(m2 + (xi[:, None] * e) ** 2)
+        f = energies.sum(axis=1) - sqrts
+        df = numpy.sum(xi[:, None] * e ** 2 / energies, axis=1)
+        xi = xi - f / df
+        if numpy.all(numpy.abs(f) < 1e-12 * sqrts):
+            break
+    k = numpy.empty_like(p)
+    k[..., 1:] = xi[:, None, None] * p[..., 1:]
+    k[..., 0] = numpy.sqrt(m2 + (xi[:, None] * e) ** 2)
+    kabs = xi[:, None] * e
+    n = p.shape[1]
+    factor = xi ** (2 * n - 3) * numpy.prod(kabs / k[..., 0], axis=1) * sqrts / numpy.sum(kabs ** 2 / k[..., 0], axis=1)
+    return k, weights * factor
+
+
+class RunningMean:
+    """
+    Mean and variance of a stream of values, updated a chunk at a time.
+    Chunks are combined with the pairwise formula of Chan, Golub and LeVeque,
+    so only three numbers are kept however many samples are seen.
+    """
+    def __init__(self, n: int = 0, mean: float = 0.0, m2: float = 0.0):
+        self.n = n
+        self.mean = mean
+        self.m2 = m2
+
+    @classmethod
+    def ofChunk(cls, values: numpy.ndarray) -> 'RunningMean':
+        values = numpy.asarray(values, dtype=float)
+        if len(values) == 0:
+            return cls()
+        mean = float(values.mean())
+        return cls(len(values), mean, float(numpy.sum((values - mean) ** 2)))
+
+    def merge(self, other: 'RunningMean'):
+        """
+        Fold the statistics of other into this accumulator
+        """
+        n = self.n + other.n
+        if n == 0:
+            return
+        delta = other.mean - self.mean
+        self.mean += delta * other.n / n
+        self.m2 += other.m2 + delta ** 2 * self.n * other.n / n
+        self.n = n
+
+    def update(self, values: numpy.ndarray):
+        self.merge(RunningMean.ofChunk(values))
+
+    def variance(self) -> float:
+        return self.m2 / (self.n - 1) if self.n > 1 else float('nan')
+
+    def error(self) -> float:
+        """
+        :return: standard error of the mean
+        """
+        return math.sqrt(self.variance() / self.n) if self.n > 1 else float('nan')
+
+
+def _chunkStats(args) -> Tuple[int, float, float]:
+    function, sqrts, masses, npoints, seed = args
+    momenta, weights = rambo(sqrts, masses, npoints, numpy.random.default_rng(seed))
+    stats = RunningMean.ofChunk(function(momenta) * weights)
+    return stats.n, stats.mean, stats.m2
+
+
+def _chunks(sqrts: float, masses: Sequence[float], nsamples: int, chunksize: int,
+            seed) -> Iterable[Tuple]:
+    seeds = numpy.random.SeedSequence(seed).spawn((nsamples + chunksize - 1) // chunksize)
+    for i, s in enumerate(seeds):
+        yield sqrts, masses, min(chunksize, nsamples - i * chunksize), s
+
+
+def integrate(function: Callable[[numpy.ndarray], numpy.ndarray], sqrts: float, masses: Sequence[float],
+              nsamples: int, chunksize: int = 10000, seed=None, workers: int = 1) -> RunningMean:
+    """
+    Monte Carlo integral of function over n-body phase space.
+    Points are generated and evaluated chunksize at a time, so memory does not grow with
+    nsamples. Every chunk draws from its own random stream spawned from seed, and chunk
+    results are merged in chunk order, so the result depends only on seed and chunksize,
+    not on the number of workers.
+    :param function: maps momenta of shape (N, n, 4) to values of shape (N,), must be picklable
+                     if workers > 1
+    :param sqrts: total energy
+    :param masses: mass of each outgoing particle
+    :param nsamples: total number of phase space points
+    :param chunksize: number of points generated at once
+    :param seed: seed for numpy.random.SeedSequence
+    :param workers: number of processes
+    :return: RunningMean whose mean is the integral and error() its uncertainty
+    """
+    result = RunningMean()
+    tasks = ((function,) + chunk for chunk in _chunks(sqrts, masses, nsamples, chunksize, seed))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for stats in executor.map(_chunkStats, tasks):
+                result.merge(RunningMean(*stats))
+    else:
+        for stats in map(_chunkStats, tasks):
+            result.merge(RunningMean(*stats))
+    return result
+
+
+class _WithIncoming:
+    """
+    Prepends fixed incoming momenta to generated outgoing momenta before calling an amplitude
+    """
+    def __init__(self, amplitude: Callable[[numpy.ndarray], numpy.ndarray], incoming: numpy.ndarray):
+        self.amplitude = amplitude
+        self.incoming = incoming
+
+    def __call__(self, momenta: numpy.ndarray) -> numpy.ndarray:
+        incoming = numpy.broadcast_to(self.incoming, (len(momenta),) + self.incoming.shape)
+        return self.amplitude(numpy.concatenate([incoming, momenta], axis=1))
+
+
+def crossSection(amplitude: Callable[[numpy.ndarray], numpy.ndarray], sqrts: float,
+                 inmasses: Sequence[float], outmasses: Sequence[float], nsamples: int,
+                 symmetry: float = 1.0, **kwargs) -> Tuple[float, float]:
+    """
+    Cross section for two particles colliding head on along z in their centre of mass frame
+    :param amplitude: |M|^2 as a function of momenta (N, 2 + n_out, 4), e.g. a TreeAmplitude
+    :param sqrts: centre of mass energy
+    :param inmasses: masses of the two incoming particles
+    :param outmasses: masses of the outgoing particles
+    :param nsamples: number of phase space points
+    :param symmetry: factor dividing the result for identical outgoing particles (n! for n identical)
+    :param kwargs: passed on to integrate
+    :return: cross section, uncertainty
+    """
+    m1, m2 = inmasses
+    s = sqrts ** 2
+    lam = (s - (m1 + m2) ** 2) * (s - (m1 - m2) ** 2)
+    if lam <= 0:
+        raise ValueError("Not enough energy for the incoming particles.")
+    pz = math.sqrt(lam) / (2 * sqrts)
+    incoming = numpy.array([[math.sqrt(m1 ** 2 + pz ** 2), 0.0, 0.0, pz],
+                            [math.sqrt(m2 ** 2 + pz ** 2), 0.0, 0.0, -pz]])
+    result = integrate(_WithIncoming(amplitude, incoming), sqrts, outmasses, nsamples, **kwargs)
+    flux = 1.0 / (2.0 * math.sqrt(lam) * symmetry)
+    return result.mean * flux, result.error() * flux
+
+
+def decayWidth(amplitude: Callable[[numpy.ndarray], numpy.ndarray], mass: float,
+               outmasses: Sequence[float], nsamples: int, symmetry: float = 1.0, **kwargs) -> Tuple[float, float]:
+    """
+    Decay width of a particle at rest
+    :param amplitude: |M|^2 as a function of momenta (N, 1 + n_out, 4), e.g. a TreeAmplitude
+    :param mass: mass of the decaying particle
+    :param outmasses: masses of the decay products
+    :param nsamples: number of phase space points
+    :param symmetry: factor dividing the result for identical outgoing particles (n! for n identical)
+    :param kwargs: passed on to integrate
+    :return: width, uncertainty
+    """
+    incoming = numpy.array([[mass, 0.0, 0.0, 0.0]])
+    result = integrate(_WithIncoming(amplitude, incoming), mass, outmasses, nsamples, **kwargs)
+    factor = 1.0 / (2.0 * mass * symmetry)
+    return result.mean * factor, result.error() * factor
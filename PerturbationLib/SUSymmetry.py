@@ -1,5 +1,13 @@
+from PerturbationLib import Instrumentation
 from PerturbationLib.Symmetries import Symmetry
-from typing import Sequence, Tuple, List, Iterable, Mapping
+from typing import Dict, Sequence, Tuple, List, Iterable, Mapping, Optional
+import functools
+import itertools
+import numpy
+
+# Decompositions of products of irreps, {(r1, r2): [multiplets]}, shared by every SU instance
+COMBINE_CACHE_SIZE = 4096
+_combineCache = {}
 
 
 class SU(Symmetry):
@@ -44,22 +52,113 @@ class SU(Symmetry):
         Combines two representations of the symmetry.
         :return: [combined repr]
         """
-        t1 = Tableau(rep=r1)
-        t2 = Tableau(rep=r2)
-        ts = t1.combine(t2)
-        return [t.getMultiplet() for t in ts]
+        key = (tuple(r1), tuple(r2))
+        stats = Instrumentation.ACTIVE
+        if key in _combineCache:
+            if stats is not None:
+                stats.count("combine cache hits")
+            return list(_combineCache[key])
+        if stats is not None:
+            stats.count("combine cache misses")
+            with stats.phase("Tableau.combine"):
+                ts = Tableau(rep=r1).combine(Tableau(rep=r2))
+        else:
+            ts = Tableau(rep=r1).combine(Tableau(rep=r2))
+        result = tuple(t.getMultiplet() for t in ts)
+        if len(_combineCache) >= COMBINE_CACHE_SIZE:
+            # Drop the oldest entry, dicts keep insertion order
+            del _combineCache[next(iter(_combineCache))]
+        _combineCache[key] = result
+        return list(result)
 
     def constructWithNewRepr(self, newrepr: Sequence[Tuple[int, ...]]) -> 'SU':
         return SU(self.N, self.name, newrepr)
 
+    def args(self) -> Tuple:
+        return self.N, self.name, self.multiplets
+
     def matchesSymmetry(self, sym: Symmetry) -> bool:
         if isinstance(sym, SU):
             return sym.name == self.name and sym.N == self.N
 
+    def torusWeights(self) -> Optional[numpy.ndarray]:
+        """
+        :return: weights of the multiplets in the Dynkin basis, one row per state
+        """
+        return numpy.vstack([irrepWeights(self.N, m) for m in self.multiplets])
+
+    def positiveRoots(self) -> Optional[numpy.ndarray]:
+        """
+        :return: the roots e_i - e_j, i < j, in the Dynkin basis, as sums of rows of the Cartan matrix
+        """
+        cartan = 2 * numpy.eye(self.N - 1, dtype=int) - numpy.eye(self.N - 1, k=1, dtype=int) \
+            - numpy.eye(self.N - 1, k=-1, dtype=int)
+        return numpy.array([cartan[i:j].sum(axis=0) for i in range(self.N - 1)
+                            for j in range(i + 1, self.N)], dtype=int).reshape(-1, self.N - 1)
+
     def __repr__(self):
         return "SU("+str(self.N)+"){"+(" + ".join([str(x) for x in self.multiplets]))+"}"
 
 
+def combineCacheSnapshot() -> Mapping[Tuple[Tuple[int, ...], Tuple[int, ...]], Tuple[Tuple[int, ...], ...]]:
+    """
+    :return: copy of the irrep product decompositions computed so far, e.g. to send to worker processes
+    """
+    return dict(_combineCache)
+
+
+def clearCombineCache():
+    """
+    Forget every irrep product decomposition computed so far
+    """
+    _combineCache.clear()
+
+
+def warmCombineCache(snapshot: Mapping[Tuple[Tuple[int, ...], Tuple[int, ...]], Tuple[Tuple[int, ...], ...]]):
+    """
+    Add decompositions computed elsewhere (see combineCacheSnapshot) to this process's cache
+    """
+    for key, value in snapshot.items():
+        if len(_combineCache) >= COMBINE_CACHE_SIZE:
+            break
+        _combineCache.setdefault(key, tuple(value))
+
+
+def irrepWeights(N: int, multiplet: Tuple[int, ...]) -> numpy.ndarray:
+    """
+    Weights of an irrep of SU(N), repeated by multiplicity. The character is the Schur
+    polynomial of the partition lambda_i = a_i + ... + a_{N-1}, whose monomials x^e are the
+    contents of the semistandard tableaux, and x^e is the weight (e_1 - e_2, ..., e_{N-1} - e_N)
+    in the Dynkin basis.
+    :param N: N of SU(N)
+    :param multiplet: Dynkin labels (a_1, ..., a_{N-1})
+    :return: integer array of shape (dimension, N - 1)
+    """
+    shape = tuple(sum(multiplet[i:]) for i in range(N - 1)) + (0,)
+    contents = _schurMonomials(shape)
+    exponents = numpy.array(list(contents.keys()), dtype=int).reshape(-1, N)
+    counts = numpy.array(list(contents.values()), dtype=int)
+    return numpy.repeat(exponents[:, :-1] - exponents[:, 1:], counts, axis=0)
+
+
+@functools.lru_cache(maxsize=256)
+def _schurMonomials(shape: Tuple[int, ...]) -> Dict[Tuple[int, ...], int]:
+    """
+    {exponents: multiplicity} of s_shape(x_1, ..., x_n), n = len(shape), from the branching rule
+    s_lambda(x_1, ..., x_n) = sum over mu interlacing lambda of s_mu(x_1, ..., x_{n-1}) x_n^(|lambda| - |mu|)
+    """
+    if len(shape) == 1:
+        return {(shape[0],): 1}
+    monomials = {}
+    ranges = [range(shape[i + 1], shape[i] + 1) for i in range(len(shape) - 1)]
+    for mu in itertools.product(*ranges):
+        last = sum(shape) - sum(mu)
+        for exponents, count in _schurMonomials(tuple(mu)).items():
+            key = exponents + (last,)
+            monomials[key] = monomials.get(key, 0) + count
+    return monomials
+
+
 class Tableau:
     """
     A tableau object for SU(N) combinations
@@ -92,6 +191,8 @@ class Tableau:
         :param other: another Tableau instance
         :return: [Tableau]
         """
+        if Instrumentation.ACTIVE is not None:
+            Instrumentation.ACTIVE.count("Tableau.combine")
         structure = self.getRows()
         letters = list(other.getRows())
         takeList = [self]
@@ -160,6 +261,8 @@ class Tableau:
         return True
 
     def placeLetter(self, i: int, r: int, c: int):
+        if Instrumentation.ACTIVE is not None:
+            Instrumentation.ACTIVE.count("tableau placements")
         if self.canPlaceLetter(i, r, c):
             if i in self.letterrows[r]:
                 self.letterrows[r][i] += 1
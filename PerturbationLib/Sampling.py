@@ -0,0 +1,211 @@
+"""
+Monte Carlo estimates of the number of Lagrangian terms and of vertex paths, for theories and
+orders where calculateL or listPaths cannot finish. The cost of an estimate is set by the
+number of samples rather than by the size of the space sampled.
+"""
+import math
+import numpy
+from statistics import NormalDist
+from typing import Callable, List, Mapping, Sequence, Tuple
+from PerturbationLib import Utilities
+from PerturbationLib.Fock import FockBasis
+from PerturbationLib.Feynman import Feynman
+from PerturbationLib.PhaseSpace import RunningMean
+from PerturbationLib.Theory import Theory, Field, hasSinglets
+
+
+class Estimate:
+    """
+    An estimated count with a confidence interval, exact when every case was checked
+    """
+    def __init__(self, value: float, low: float, high: float, samples: int, exact: bool = False):
+        self.value = value
+        self.low = low
+        self.high = high
+        self.samples = samples
+        self.exact = exact
+
+    @classmethod
+    def ofCount(cls, count: int, samples: int = 0) -> 'Estimate':
+        return cls(float(count), float(count), float(count), samples, exact=True)
+
+    def __repr__(self):
+        if self.exact:
+            return "Estimate({:g}, exact)".format(self.value)
+        return "Estimate({:g}, [{:g}, {:g}], samples={})".format(self.value, self.low, self.high, self.samples)
+
+
+def wilsonInterval(hits: int, samples: int, confidence: float = 0.95) -> Tuple[float, float]:
+    """
+    Wilson score interval for a binomial proportion, which unlike the normal approximation
+    stays sensible when hits is 0 or samples.
+    :param hits: number of successes
+    :param samples: number of trials
+    :param confidence: probability the interval covers the true proportion
+    :return: lower and upper bound on the proportion
+    """
+    if samples == 0:
+        return 0.0, 1.0
+    z = _quantile(confidence)
+    p = hits / samples
+    denominator = 1 + z ** 2 / samples
+    centre = (p + z ** 2 / (2 * samples)) / denominator
+    half = z * math.sqrt(p * (1 - p) / samples + z ** 2 / (4 * samples ** 2)) / denominator
+    return max(0.0, centre - half), min(1.0, centre + half)
+
+
+def estimateTerms(theory: Theory, samples: int, predicate: Callable[[List[Field]], bool] = None,
+                  orderweights: Sequence[float] = None, confidence: float = 0.95,
+                  seed=None) -> Tuple[Estimate, List[Estimate]]:
+    """
+    Estimates the number of multisets of up to theory.trunc fields and antifields whose product
+    contains a singlet, i.e. the number of terms calculateL(filter_anti_dups=False) gives, or
+    of those for which predicate also holds, e.g. the terms involving a given field.
+
+    Multisets of each order n are numbered by a FockBasis over the fields and antifields and
+    sampled uniformly by drawing ranks from its sector of total n, so the space is never
+    listed. Samples are split between orders in proportion to orderweights, by default the
+    number of multisets of each order, making the whole sample uniform. Weighting short
+    orders more heavily spends more samples where terms are dense. An order given at least as
+    many samples as it has multisets is checked exhaustively instead, and is exact.
+    :param theory: theory whose terms are counted
+    :param samples: total number of multisets to check, at least one per order is checked
+    :param predicate: only count terms whose list of fields satisfies it
+    :param orderweights: positive weight of each order 1..trunc in the allocation of samples
+    :param confidence: coverage of the intervals
+    :param seed: seed for numpy.random.default_rng
+    :return: estimate of the total, [estimate for order n for n in 0..trunc], order 0 being empty
+    """
+    rng = numpy.random.default_rng(seed)
+    allfields = list(theory.fields) + [f.antifield() for f in theory.fields]
+    basis = FockBasis(len(allfields), theory.trunc, total=True)
+    sizes = [0] + [basis.sectorRange(n)[1] - basis.sectorRange(n)[0] for n in range(1, theory.trunc + 1)]
+    weights = sizes[1:] if orderweights is None else list(orderweights)
+    if len(weights) != theory.trunc or any(w <= 0 for w in weights):
+        raise ValueError("Need a positive weight for each order from 1 to trunc.")
+    allocation = [0] + [max(1, int(round(samples * w / sum(weights)))) for w in weights]
+
+    abelian, charges = theory.abelianChargeMatrix(allfields)
+    syms = [s for i, s in enumerate(theory.syms) if i not in abelian]
+    z = _quantile(confidence)
+    estimates = [Estimate.ofCount(0)]
+    variance = 0.0
+    with theory.stats.phase("estimateTerms"):
+        for n in range(1, theory.trunc + 1):
+            start, stop = basis.sectorRange(n)
+            exact = allocation[n] >= sizes[n]
+            ranks = numpy.arange(start, stop) if exact else rng.integers(start, stop, allocation[n])
+            # Each distinct multiset is checked once however often it is drawn
+            distinct, inverse = numpy.unique(ranks, return_inverse=True)
+            counts = basis.unrank(distinct)
+            passes = numpy.all(counts.dot(charges) == 0, axis=1)
+            found = numpy.zeros(len(distinct), dtype=bool)
+            for i in numpy.flatnonzero(passes):
+                encoding = Theory._candidate(allfields, counts[i])
+                found[i] = (predicate is None or predicate(encoding)) and hasSinglets(syms, encoding)
+            theory.stats.count("multisets sampled", len(ranks))
+
+            if exact:
+                estimates.append(Estimate.ofCount(int(found.sum()), len(ranks)))
+                continue
+            hits = int(found[inverse.reshape(-1)].sum())
+            low, high = wilsonInterval(hits, len(ranks), confidence)
+            # Terms seen are certainly there
+            estimates.append(Estimate(sizes[n] * hits / len(ranks), max(sizes[n] * low, float(found.sum())),
+                                      sizes[n] * high, len(ranks)))
+            # Agresti-Coull proportion keeps the variance of the total nonzero when hits is 0
+            p = (hits + z ** 2 / 2) / (len(ranks) + z ** 2)
+            variance += sizes[n] ** 2 * p * (1 - p) / (len(ranks) + z ** 2)
+
+    return _combine(estimates, variance, z, sum(sizes)), estimates
+
+
+def estimatePaths(feyn: Feynman, startstate: Mapping[Field, int], endstate: Mapping[Field, int],
+                  maxorder: int, samples: int, confidence: float = 0.95,
+                  seed=None) -> Tuple[Estimate, List[Estimate]]:
+    """
+    Estimates the number of paths listPaths would give with Knuth's random walk estimator.
+    Each walk starts at startstate and repeatedly steps through one of the vertices which can
+    apply there, chosen uniformly, multiplying its weight by the number of choices. The weight
+    at each visit of endstate is an unbiased estimate of the number of paths of that length,
+    and the walks are averaged. Vertices come from the table's index, and those which the
+    charge bounds show cannot reach endstate in the vertices left are never chosen, which
+    removes only branches without paths and so keeps the estimate unbiased while lowering its
+    variance. The intervals rest on the central limit theorem, and as the weights can be
+    heavy tailed they should be read with caution for small samples.
+    :param feyn: Feynman whose vertices are used
+    :param startstate: Start state  as dict{field: num_particles}
+    :param endstate: State of interest as dict{field: num_particles}
+    :param maxorder: maximum number of vertices allowed
+    :param samples: number of walks
+    :param confidence: coverage of the intervals
+    :param seed: seed for numpy.random.default_rng
+    :return: estimate of the total, [estimate for paths with i vertices for i in 0..maxorder]
+    """
+    if samples < 2:
+        raise ValueError("Need at least two walks to estimate their spread.")
+    rng = numpy.random.default_rng(seed)
+    start = tuple(int(x) for x in feyn.convertDictToVec(startstate))
+    end = tuple(int(x) for x in feyn.convertDictToVec(endstate))
+    bound = Utilities.linearLowerBound(end, feyn.charges, feyn.effects)
+    if bound(start) > maxorder:
+        return Estimate.ofCount(0), [Estimate.ofCount(0) for _ in range(maxorder + 1)]
+
+    index = feyn.vertexTable.index
+    nodelist = index.nodelist
+    children = {}
+
+    def choices(state: Tuple[int, ...], remaining: int) -> List[Tuple[int, ...]]:
+        key = (state, remaining)
+        if key not in children:
+            found = []
+            for n in index.forward(state):
+                _, taken, given, _ = nodelist[n]
+                nextstate = Utilities.applyVectorNode(state, taken, given)
+                if nextstate is not None and bound(nextstate) <= remaining - 1:
+                    found.append(nextstate)
+            children[key] = found
+        return children[key]
+
+    weights = numpy.zeros((samples, maxorder + 1))
+    with feyn.stats.phase("estimatePaths"):
+        for s in range(samples):
+            state, weight = start, 1.0
+            for depth in range(maxorder + 1):
+                if state == end and depth > 0:
+                    weights[s, depth] = weight
+                following = choices(state, maxorder - depth) if depth < maxorder else []
+                if len(following) == 0:
+                    break
+                weight *= len(following)
+                state = following[rng.integers(len(following))]
+        feyn.stats.count("paths sampled", samples)
+
+    z = _quantile(confidence)
+    # Paths have at least one vertex, as with listPaths
+    estimates = [Estimate.ofCount(0)] + [_meanEstimate(weights[:, i], z) for i in range(1, maxorder + 1)]
+    return _meanEstimate(weights.sum(axis=1), z), estimates
+
+
+def _quantile(confidence: float) -> float:
+    if not 0 < confidence < 1:
+        raise ValueError("Confidence must lie strictly between 0 and 1.")
+    return NormalDist().inv_cdf((1 + confidence) / 2)
+
+
+def _combine(estimates: Sequence[Estimate], variance: float, z: float, population: int) -> Estimate:
+    """
+    Total of independent estimates, with a normal interval from the sum of their variances
+    """
+    value = sum(e.value for e in estimates)
+    if all(e.exact for e in estimates):
+        return Estimate.ofCount(int(value), sum(e.samples for e in estimates))
+    half = z * math.sqrt(variance)
+    return Estimate(value, max(value - half, 0.0), min(value + half, float(population)),
+                    sum(e.samples for e in estimates))
+
+
+def _meanEstimate(values: numpy.ndarray, z: float) -> Estimate:
+    stats = RunningMean.ofChunk(values)
+    half = z * stats.error()
+    return Estimate(stats.mean, max(0.0, stats.mean - half), stats.mean + half, stats.n)
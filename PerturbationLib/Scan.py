@@ -0,0 +1,139 @@
+"""
+Calculate the Lagrangians of many variants of a theory, e.g. every assignment of charges
+from a grid, on a pool of processes.
+"""
+import hashlib
+import itertools
+import json
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Callable, Generator, Iterable, List, Mapping, Tuple, Union
+from PerturbationLib import SUSymmetry, Utilities
+from PerturbationLib.Theory import Theory, Interaction
+
+# (parameters, kinetic terms, interaction terms)
+ScanResult = Tuple[Mapping[str, Any], List[Interaction], List[Interaction]]
+
+
+def parameterPoints(parameter_grid: Union[Mapping[str, Iterable], Iterable[Mapping[str, Any]]]
+                    ) -> List[Mapping[str, Any]]:
+    """
+    :param parameter_grid: dict{name: values}, giving every combination of values, or a list of
+                           dict{name: value}, giving each point as is
+    :return: [dict{name: value}]
+    """
+    if isinstance(parameter_grid, Mapping):
+        names = list(parameter_grid.keys())
+        return [dict(zip(names, values)) for values in itertools.product(*parameter_grid.values())]
+    return [dict(point) for point in parameter_grid]
+
+
+def scan(theory_factory: Callable[..., Theory],
+         parameter_grid: Union[Mapping[str, Iterable], Iterable[Mapping[str, Any]]],
+         workers: int = 1, checkpoint: str = None, filter_anti_dups: bool = True
+         ) -> Generator[ScanResult, None, None]:
+    """
+    Run calculateL for theory_factory(**point) at every point of the grid, yielding results
+    as they finish, so not in grid order when workers > 1.
+
+    The first point not already done is calculated here before the pool starts, and the SU
+    irrep decompositions it needed are handed to each worker, which keeps its own cache warm
+    over all the points it is given.
+
+    If checkpoint is given every result is appended to that file as it arrives, after a key
+    identifying theory_factory and filter_anti_dups. Rerunning the same scan with the same
+    checkpoint yields the stored results first and only calculates the points missing from
+    it, and a checkpoint written by a different scan raises a ValueError.
+    :param theory_factory: makes a Theory from keyword parameters, must be picklable if workers > 1
+    :param parameter_grid: see parameterPoints
+    :param workers: number of processes
+    :param checkpoint: path of a file recording finished points
+    :param filter_anti_dups: as passed to calculateL
+    :yield: (parameters, Lk, Lint)
+    """
+    points = parameterPoints(parameter_grid)
+    done = set()
+    key = _scanKey(theory_factory, filter_anti_dups)
+    records = []
+    if checkpoint is not None:
+        records, end = Utilities.readPickleLog(checkpoint)
+        if len(records) > 0 and records[0] != key:
+            raise ValueError("Checkpoint {} belongs to a different scan.".format(checkpoint))
+        for index, params, lk, lint in records[1:]:
+            if index < len(points) and points[index] == params and index not in done:
+                done.add(index)
+                yield params, lk, lint
+        if os.path.exists(checkpoint):
+            # Drop a record cut short by an interrupted scan before appending to the file
+            os.truncate(checkpoint, end)
+    todo = [i for i in range(len(points)) if i not in done]
+    if len(todo) == 0:
+        return
+
+    log = open(checkpoint, "ab") if checkpoint is not None else None
+    try:
+        def append(entry):
+            pickle.dump(entry, log)
+            log.flush()
+            os.fsync(log.fileno())
+
+        def record(index: int, lk: List[Interaction], lint: List[Interaction]) -> ScanResult:
+            if log is not None:
+                append((index, points[index], lk, lint))
+            return points[index], lk, lint
+
+        if log is not None and len(records) == 0:
+            append(key)
+
+        # Warm up the decomposition cache on the first point
+        first = todo.pop(0)
+        yield record(*_evaluate((theory_factory, first, points[first], filter_anti_dups)))
+
+        tasks = ((theory_factory, i, points[i], filter_anti_dups) for i in todo)
+        if workers > 1 and len(todo) > 0:
+            with ProcessPoolExecutor(max_workers=workers, initializer=SUSymmetry.warmCombineCache,
+                                     initargs=(SUSymmetry.combineCacheSnapshot(),)) as executor:
+                # Keep a bounded number of points in flight so huge grids are not all submitted at once
+                pending = set()
+                for task in tasks:
+                    pending.add(executor.submit(_evaluate, task))
+                    if len(pending) >= 4 * workers:
+                        finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in finished:
+                            yield record(*future.result())
+                while pending:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        yield record(*future.result())
+        else:
+            for task in tasks:
+                yield record(*_evaluate(task))
+    finally:
+        if log is not None:
+            log.close()
+
+
+def readCheckpoint(path: str) -> List[Tuple[int, Mapping[str, Any], List[Interaction], List[Interaction]]]:
+    """
+    :param path: checkpoint file written by scan
+    :return: [(grid index, parameters, Lk, Lint)] for each finished point
+    """
+    return Utilities.readPickleLog(path)[0][1:]
+
+
+def _scanKey(theory_factory: Callable[..., Theory], filter_anti_dups: bool) -> str:
+    """
+    Identifies the scan a checkpoint belongs to by the factory's qualified name and the
+    calculateL options, the grid being checked point by point
+    """
+    name = [getattr(theory_factory, '__module__', None),
+            getattr(theory_factory, '__qualname__', type(theory_factory).__qualname__)]
+    return hashlib.sha256(json.dumps([name, filter_anti_dups]).encode()).hexdigest()
+
+
+def _evaluate(task: Tuple) -> Tuple[int, List[Interaction], List[Interaction]]:
+    theory_factory, index, params, filter_anti_dups = task
+    theory = theory_factory(**params)
+    theory.calculateL(filter_anti_dups=filter_anti_dups)
+    return index, theory.Lk, theory.Lint
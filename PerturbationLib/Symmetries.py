@@ -1,15 +1,91 @@
 from abc import ABCMeta, abstractmethod
-from typing import Sequence, Tuple
+from fractions import Fraction
+from PerturbationLib import Instrumentation, Utilities
+from typing import Optional, Sequence, Tuple
+import numpy
+import weakref
 
+# Largest number of products memoized on each symmetry, the oldest being dropped first
+MEMO_SIZE = 256
 
-class Symmetry(metaclass=ABCMeta):
+
+class SymmetryMeta(ABCMeta):
+    """
+    Interns symmetries: constructing a symmetry equal to one which already exists returns the
+    existing object, so each distinct value is validated once and equal values are identical.
+    """
+    def __call__(cls, *args, **kwargs):
+        argkey = (cls, args, tuple(sorted(kwargs.items()))) if kwargs else (cls, args)
+        try:
+            hash(argkey)
+        except TypeError:
+            argkey = _freeze(argkey)
+            try:
+                hash(argkey)
+            except TypeError:
+                argkey = None
+        if argkey is not None:
+            sym = cls._byArgs.get(argkey)
+            if sym is not None:
+                return sym
+
+        sym = super().__call__(*args, **kwargs)
+        sym = cls._interned.setdefault((cls, sym.args()), sym)
+        object.__setattr__(sym, '_frozen', True)
+        if argkey is not None:
+            cls._byArgs[argkey] = sym
+        return sym
+
+
+def clearMemos():
+    """
+    Forget the products, conjugates and singlets memoized on every symmetry, e.g. to time
+    combine afresh or to release what a long run has accumulated
+    """
+    for sym in list(Symmetry._interned.values()):
+        sym._memo.clear()
+
+
+def _exactCharge(q):
+    """
+    :return: q as an int if it is whole, else as a Fraction
+    """
+    q = Utilities.rational(q)
+    return int(q) if q.denominator == 1 else q
+
+
+def _freeze(value):
+    """
+    Turn nested lists and arrays of constructor arguments into hashable tuples
+    """
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        pass
+    if hasattr(value, 'tolist'):
+        value = value.tolist()
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+class Symmetry(metaclass=SymmetryMeta):
     """
     A class containing information as to how to
     combine and calculate representations.
     Multiplets are stored in (a,b,c...) notation to
     remove ambiguity. A conversion method will be implemented for
     each class.
+
+    Symmetries are immutable and interned (see SymmetryMeta), so they compare and hash by
+    identity, and the results of combine, inverse and singlet are memoized on each object, up
+    to MEMO_SIZE of them (see also clearMemos).
     """
+    # Every symmetry by its constructor arguments, and by the arguments given when it was made
+    _interned = weakref.WeakValueDictionary()
+    _byArgs = weakref.WeakValueDictionary()
+
     def __init__(self, name: str, multiplets: Sequence[Tuple[int, ...]]):
         """
         Create a symmetry
@@ -18,9 +94,25 @@ class Symmetry(metaclass=ABCMeta):
         """
         self.name = name
         if multiplets is None:
-            self.multiplets = [self.singletRepr()]
+            self.multiplets = (self.singletRepr(),)
         else:
-            self.multiplets = list(multiplets)
+            self.multiplets = tuple(tuple(m) if isinstance(m, list) else m for m in multiplets)
+        # {other symmetry: product, "inverse": conjugate, "singlet": singlet}
+        self._memo = {}
+
+    def __setattr__(self, key, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError("Symmetries are immutable")
+        object.__setattr__(self, key, value)
+
+    def __reduce__(self):
+        return type(self), self.args()
+
+    def args(self) -> Tuple:
+        """
+        :return: constructor arguments recreating this symmetry
+        """
+        return self.name, self.multiplets
 
     def combine(self, sym: 'Symmetry') -> 'Symmetry':
         """
@@ -28,12 +120,24 @@ class Symmetry(metaclass=ABCMeta):
         :param sym: other U(N) with same N
         :return: new U(N) with sum of multiplets
         """
+        result = self._memo.get(sym)
+        if result is not None:
+            if Instrumentation.ACTIVE is not None:
+                Instrumentation.ACTIVE.count("combine memo hits")
+            return result
         if self.matchesSymmetry(sym):
+            if Instrumentation.ACTIVE is not None:
+                Instrumentation.ACTIVE.count("Symmetry.combine")
             mapRepr = []
             for r1 in self.multiplets:
                 for r2 in sym.multiplets:
                     mapRepr += self.combineRepr(r1, r2)
-            return self.constructWithNewRepr(mapRepr)
+            result = self.constructWithNewRepr(tuple(mapRepr))
+            if len(self._memo) >= MEMO_SIZE:
+                # Drop the oldest entry, dicts keep insertion order
+                del self._memo[next(iter(self._memo))]
+            self._memo[sym] = result
+            return result
         raise Exception("Symmetries do not match: "+self.name+", "+sym.name)
 
     def singlet(self) -> 'Symmetry':
@@ -41,14 +145,47 @@ class Symmetry(metaclass=ABCMeta):
         Gives a singlet of the given group
         :return:
         """
-        return self.constructWithNewRepr([self.singletRepr()])
+        if "singlet" not in self._memo:
+            self._memo["singlet"] = self.constructWithNewRepr((self.singletRepr(),))
+        return self._memo["singlet"]
 
     def inverse(self) -> 'Symmetry':
         """
         Gives the conjugate representation
         :return:
         """
-        return self.constructWithNewRepr(self.inverseRepr())
+        if "inverse" not in self._memo:
+            inverse = self.constructWithNewRepr(tuple(self.inverseRepr()))
+            self._memo["inverse"] = inverse
+            inverse._memo.setdefault("inverse", self)
+        return self._memo["inverse"]
+
+    def abelianCharges(self) -> Optional[Sequence[int]]:
+        """
+        For abelian symmetries holding a single multiplet, the charges which add when combining,
+        so that a product contains a singlet exactly when they sum to zero. Theory uses these
+        to check many candidate terms at once.
+        :return: charge vector, or None if the symmetry is not of that form
+        """
+        return None
+
+    def torusWeights(self) -> Optional[numpy.ndarray]:
+        """
+        Weights of every state of the multiplets as coordinates on a maximal torus of the group,
+        so that the character is sum_w z^w. Used with positiveRoots to integrate characters over
+        the group when counting invariants (see HilbertSeries). Coordinates along which no root
+        points may be rational, as U(1) charges often are: HilbertSeries rescales each of them
+        to integers over all fields together, which leaves the integral unchanged.
+        :return: array of shape (number of states, rank), or None if not available
+        """
+        return None
+
+    def positiveRoots(self) -> Optional[numpy.ndarray]:
+        """
+        :return: positive roots in the coordinates of torusWeights, shape (number of roots, rank),
+                 or None if not available
+        """
+        return None
 
     def __call__(self, *args: Tuple[int, ...]) -> 'Symmetry':
         return self.constructWithNewRepr(args)
@@ -130,6 +267,9 @@ class U(Symmetry):
         """
         return U(self.N, self.name, newrepr)
 
+    def args(self) -> Tuple:
+        return self.N, self.name, self.multiplets
+
     def combineRepr(self, r1, r2) -> Sequence[Tuple[int, ...]]:
         """
         Combines the multiplets for two U(N) symmetries, returns new multiplet
@@ -159,6 +299,19 @@ class U(Symmetry):
         else:
             raise Exception("U(N>1) not yet implemented")
 
+    def abelianCharges(self) -> Optional[Sequence[int]]:
+        if self.N == 1 and len(self.multiplets) == 1:
+            return self.multiplets[0]
+        return None
+
+    def torusWeights(self) -> Optional[numpy.ndarray]:
+        if self.N != 1:
+            return None
+        return numpy.array([[m[0]] for m in self.multiplets], dtype=object).reshape(-1, 1)
+
+    def positiveRoots(self) -> Optional[numpy.ndarray]:
+        return numpy.zeros((0, 1), dtype=int) if self.N == 1 else None
+
     def matchesSymmetry(self, sym: 'Symmetry') -> bool:
         if isinstance(sym, U):
             return self.name == sym.name and self.N == sym.N
@@ -166,3 +319,63 @@ class U(Symmetry):
 
     def __repr__(self):
         return "U("+str(self.N)+"){"+(" + ".join([str(x) for x in self.multiplets]))+"}"
+
+
+class U1Product(Symmetry):
+    """
+    U(1)^k, k abelian symmetries at once. Each multiplet is a vector of k charges, combining
+    adds them and a singlet has every charge zero. Charges are held exactly, as ints or as
+    Fractions for fractional ones like hypercharge 1/6.
+    """
+    def __init__(self, k: int, name: str = None, multiplets: Sequence[Tuple[int, ...]] = None):
+        self.k = k
+        super().__init__(name or 'U(1)^'+str(k), multiplets)
+        self.multiplets = tuple(tuple(_exactCharge(q) for q in m) for m in self.multiplets)
+        for m in self.multiplets:
+            if len(m) != self.k:
+                raise Exception("Multiplet of incorrect size")
+
+    def constructWithNewRepr(self, newrepr: Sequence[Tuple[int, ...]]) -> 'U1Product':
+        return U1Product(self.k, self.name, newrepr)
+
+    def args(self) -> Tuple:
+        return self.k, self.name, self.multiplets
+
+    def combineRepr(self, r1: Tuple[int, ...], r2: Tuple[int, ...]) -> Sequence[Tuple[int, ...]]:
+        return [tuple(a + b for a, b in zip(r1, r2))]
+
+    def containsSinglet(self) -> bool:
+        return self.singletRepr() in self.multiplets
+
+    def singletRepr(self) -> Tuple[int, ...]:
+        return tuple(0 for _ in range(self.k))
+
+    def inverseRepr(self) -> Sequence[Tuple[int, ...]]:
+        return [tuple(-q for q in m) for m in self.multiplets]
+
+    def abelianCharges(self) -> Optional[Sequence[int]]:
+        if len(self.multiplets) == 1:
+            return self.multiplets[0]
+        return None
+
+    def torusWeights(self) -> Optional[numpy.ndarray]:
+        return self.charges()
+
+    def positiveRoots(self) -> Optional[numpy.ndarray]:
+        return numpy.zeros((0, self.k), dtype=int)
+
+    def charges(self) -> numpy.ndarray:
+        """
+        :return: array of shape (number of multiplets, k), of objects if any charge is fractional
+        """
+        exact = any(isinstance(q, Fraction) for m in self.multiplets for q in m)
+        return numpy.array(self.multiplets, dtype=object if exact else int).reshape(-1, self.k)
+
+    def matchesSymmetry(self, sym: 'Symmetry') -> bool:
+        if isinstance(sym, U1Product):
+            return self.name == sym.name and self.k == sym.k
+        return False
+
+    def __repr__(self):
+        return "U(1)^"+str(self.k)+"{"+(" + ".join(["("+", ".join(str(q) for q in m)+")"
+                                                    for m in self.multiplets]))+"}"
@@ -1,6 +1,14 @@
-from PerturbationLib import Utilities
+from PerturbationLib import HilbertSeries, Utilities
+from PerturbationLib.Instrumentation import Stats
 from PerturbationLib.Symmetries import Symmetry
-from typing import Iterable, MutableMapping, List, Sequence
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, MutableMapping, List, Sequence, Set, Tuple
+import hashlib
+import json
+import os
+import tempfile
+import time
+import numpy
 
 
 class Field:
@@ -121,12 +129,16 @@ class Theory:
     """
     def __init__(self, *symmetries: Symmetry, fields: Sequence[Field] = None,
                  gaugefields: MutableMapping[Symmetry, Field] = None,
-                 trunc: int = 4):
+                 trunc: int = 4, stats: Stats = None, cache: 'LagrangianCache' = None):
         self.syms = symmetries
         self.fields = []
         self.trunc = trunc
         self.Lk = None
         self.Lint = None
+        # Counters and timers, disabled unless a Stats(enabled=True) is given or stats.enable() is called
+        self.stats = Stats() if stats is None else stats
+        # Optional Cache.LagrangianCache consulted before calculating the Lagrangian
+        self.cache = cache
         if gaugefields is None:
             self.gaugeFields = {}
         else:
@@ -159,7 +171,10 @@ class Theory:
         :return: return kinetic terms
         """
         if (self.Lk is None) or (self.Lint is None):
+            self.stats.count("Lagrangian cache misses")
             self.calculateL(filter_anti_dups=filter_anti_dups)
+        else:
+            self.stats.count("Lagrangian cache hits")
         return self.Lk
 
     def getInt(self, filter_anti_dups=True) -> List[Interaction]:
@@ -167,41 +182,192 @@ class Theory:
         :return: interactions terms
         """
         if (self.Lk is None) or (self.Lint is None):
+            self.stats.count("Lagrangian cache misses")
             self.calculateL(filter_anti_dups=filter_anti_dups)
+        else:
+            self.stats.count("Lagrangian cache hits")
         return self.Lint
 
-    def calculateL(self, filter_anti_dups=True) -> None:
+    def calculateL(self, filter_anti_dups=True, workers: int = 1, checkpoint: str = None,
+                   interval: float = 60.0) -> None:
         """
         Populate with all allowed interactions and kinetic terms
+        :param filter_anti_dups: keep one term of each pair of conjugate terms, otherwise both
+        :param workers: number of processes checking candidates for singlets, the terms and
+                        their labels are the same for any number of workers
+        :param checkpoint: path of a file recording progress through the candidates, from which
+                           an interrupted run of the same theory resumes, removed once done. With
+                           workers > 1 progress is recorded once the parallel checks are over
+        :param interval: minimum number of seconds between writes of the checkpoint
         """
+        with self.stats.activate(), self.stats.phase("calculateL"):
+            if self.cache is not None:
+                cached = self.cache.load(self, filter_anti_dups)
+                if cached is not None:
+                    self.stats.count("disk cache hits")
+                    self.Lk, self.Lint = cached
+                    return
+                self.stats.count("disk cache misses")
+            self._calculateL(filter_anti_dups, workers, checkpoint, interval)
+            if self.cache is not None:
+                self.cache.store(self, self.Lk, self.Lint, filter_anti_dups)
+
+    def _calculateL(self, filter_anti_dups: bool, workers: int, checkpoint: str = None,
+                    interval: float = 60.0) -> None:
         self.Lk = []
         self.Lint = []
+        stats = self.stats
+        instrumented = stats.enabled
+
+        # A term and its conjugate contain singlets together, so only one of each pair of
+        # multisets of up to trunc fields and antifields is checked
+        allfields = list(self.fields) + [f.antifield() for f in self.fields]
+        with stats.phase("candidate enumeration"):
+            pairs = Utilities.conjugateCanonicalCounts(len(self.fields), self.trunc)
+            candidates = [self._candidate(allfields, m + a) for m, a in pairs]
+        stats.count("candidates generated", len(candidates))
+
+        # Candidates before position were checked by an earlier run, found holds the pairs accepted
+        position, found = 0, []
+        if checkpoint is not None:
+            key = self.contentHash() + ("f" if filter_anti_dups else "a")
+            position, found = readLCheckpoint(checkpoint, key)
+            if position > 0:
+                stats.count("candidates resumed", position)
+            written = time.monotonic()
+
+        # Abelian charges are summed for all candidates at once, leaving only the other symmetries
+        # to be combined one candidate at a time
+        syms = self.syms
+        passes = None
+        abelian, charges = self.abelianChargeMatrix(allfields)
+        if len(abelian) > 0 and len(candidates) > 0:
+            with stats.phase("abelian prefilter"):
+                passes = abelianSinglets(allfields, candidates, charges)
+            syms = [s for i, s in enumerate(self.syms) if i not in abelian]
+
+        # Check every candidate in parallel up front, then accept them below in serial order
+        allowed = None
+        if workers > 1 and len(candidates) - position > 1:
+            survivors = range(position, len(candidates)) if passes is None \
+                else (position + numpy.flatnonzero(passes[position:])).tolist()
+            with stats.phase("parallel singlet checks"):
+                checked = shardedSinglets(syms, allfields, [candidates[i] for i in survivors], workers)
+            allowed = set(survivors[i] for i in checked)
+            stats.count("singlet checks", len(survivors))
+
+        for index in range(position, len(candidates)):
+            encoding = candidates[index]
+            if allowed is not None:
+                allhavesinglets = index in allowed
+            elif passes is not None and not passes[index]:
+                allhavesinglets = False
+                if instrumented:
+                    stats.count("candidates rejected by charges")
+            else:
+                if instrumented:
+                    start = time.perf_counter()
+                allhavesinglets = hasSinglets(syms, encoding)
+                if instrumented:
+                    stats.count("singlet checks")
+                    stats.addTime("symmetry combination", time.perf_counter() - start)
+
+            if allhavesinglets:
+                found.append(index)
+            if checkpoint is not None and time.monotonic() - written >= interval:
+                writeLCheckpoint(checkpoint, key, index + 1, found)
+                written = time.monotonic()
+                stats.count("checkpoints written")
+
+        accepted = []
+        for index in found:
+            m, a = pairs[index]
+            accepted.append((m + a, candidates[index]))
+            if not filter_anti_dups and m != a:
+                accepted.append((a + m, self._candidate(allfields, a + m)))
+                if instrumented:
+                    stats.count("conjugate partners reconstructed")
+
+        # Partners go back to their place in the order of all multisets, as the couplings are
+        # numbered in that order
+        if not filter_anti_dups:
+            accepted.sort(key=lambda t: (len(t[1]), tuple(-k for k in t[0])))
 
-        # Make all combinations of trunc #fields and trunc #antifields
         intnum = 0
-        fieldweights = [(f, self.trunc) for f in self.fields] + [(f.antifield(), self.trunc) for f in self.fields]
-        seen_l = set()
-        for encoding in sorted(Utilities.truncCombinations(fieldweights, self.trunc), key=lambda k: len(k)):
-            field_name_tuple = tuple(sorted([field.name for field in encoding]))
-            if filter_anti_dups and field_name_tuple in seen_l:
-                continue
-
-            accsyms = [s.singlet() for s in self.syms]  # Start with all singlets
-            for field in encoding:
-                accsyms = field.combineWithSyms(accsyms)
-
-            # Make sure there's a singlet in each symmetry
-            allhavesinglets = True
-            for s in accsyms:
-                allhavesinglets = allhavesinglets and s.containsSinglet()
+        for _, encoding in accepted:
+            if instrumented:
+                start = time.perf_counter()
+            # Only a field times its own antifield is kinetic, a neutral field's f f is a coupling
+            if len(encoding) != 2 or encoding[0].name != encoding[1].name or encoding[0].anti == encoding[1].anti:
+                self.Lint.append(Interaction(encoding, "g_{"+str(intnum)+"}"))
+                intnum += 1
+            else:
+                self.Lk.append(Interaction(encoding, "m_{"+str(encoding[0].name)+"}"))
+            if instrumented:
+                stats.count("interactions constructed")
+                stats.addTime("interaction construction", time.perf_counter() - start)
+        if checkpoint is not None and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+    @staticmethod
+    def _candidate(allfields: Sequence[Field], counts: Sequence[int]) -> List[Field]:
+        return [f for f, k in zip(allfields, counts) for _ in range(k)]
+
+    def countOperators(self, trunc: int = None) -> List[int]:
+        """
+        Number of independent invariant operators of each order, from the Hilbert series of the
+        fields and antifields (see HilbertSeries.operatorCounts) rather than by listing them, so
+        far higher orders are in reach than with calculateL.
+
+        This counts invariant polynomials in commuting fields, with multiplicity. calculateL keeps
+        each multiset of fields whose product contains a singlet, so the two agree when every
+        such multiset gives exactly one invariant, as with only abelian symmetries.
+        :param trunc: highest order, defaults to self.trunc
+        :return: [number of invariants of order n for n in 0..trunc]
+        """
+        trunc = self.trunc if trunc is None else trunc
+        allfields = list(self.fields) + [f.antifield() for f in self.fields]
+        with self.stats.phase("countOperators"):
+            return HilbertSeries.operatorCounts(self.syms, allfields, trunc)
 
-            if allhavesinglets:
-                seen_l.add(field_name_tuple)
-                if len(encoding) != 2 or encoding[0].name != encoding[1].name:
-                    self.Lint.append(Interaction(encoding, "g_{"+str(intnum)+"}"))
-                    intnum += 1
-                else:
-                    self.Lk.append(Interaction(encoding, "m_{"+str(encoding[0].name)+"}"))
+    def abelianChargeMatrix(self, fields: Sequence[Field]) -> Tuple[List[int], numpy.ndarray]:
+        """
+        Collect the charges of the symmetries for which every field gives abelianCharges
+        :param fields: fields and antifields
+        :return: [index of symmetry in self.syms], integer array of shape (len(fields), total number of charges)
+        """
+        abelian = []
+        columns = []
+        for i, sym in enumerate(self.syms):
+            charges = []
+            for field in fields:
+                fsym = next((s for s in field.syms if s.name == sym.name), None)
+                q = fsym.abelianCharges() if fsym is not None else None
+                if q is None:
+                    break
+                charges.append(list(q))
+            else:
+                abelian.append(i)
+                # Fractional charges are scaled to integers, which keeps which sums vanish
+                columns.append(Utilities.integerColumns(charges).reshape(len(fields), -1))
+        if len(columns) == 0:
+            return abelian, numpy.zeros((len(fields), 0), dtype=int)
+        return abelian, numpy.hstack(columns)
+
+    def contentHash(self) -> str:
+        """
+        Hash of everything calculateL depends on: the symmetries, the fields in order with
+        their multiplets, and the truncation. Stable across processes and sessions.
+        :return: hex digest
+        """
+        def describe(sym: Symmetry) -> list:
+            return [type(sym).__name__, sym.name, getattr(sym, 'N', None),
+                    [[str(Utilities.rational(x)) for x in m] for m in sym.multiplets]]
+
+        content = [self.trunc,
+                   [describe(sym) for sym in self.syms],
+                   [[f.name, f.anti, [describe(sym) for sym in f.syms]] for f in self.fields]]
+        return hashlib.sha256(json.dumps(content).encode()).hexdigest()
 
     def fieldAllowed(self, field: Field) -> bool:
         """
@@ -242,3 +408,119 @@ class Theory:
     def _repr_latex_(self):
         return "${}$".format(self._latex())
 
+
+def hasSinglets(syms: Sequence[Symmetry], encoding: Sequence[Field]) -> bool:
+    """
+    :param syms: symmetries of the theory
+    :param encoding: fields of a candidate term
+    :return: true if the product of the fields contains a singlet of every symmetry
+    """
+    accsyms = [s.singlet() for s in syms]  # Start with all singlets
+    for field in encoding:
+        accsyms = field.combineWithSyms(accsyms)
+
+    # Make sure there's a singlet in each symmetry
+    for s in accsyms:
+        if not s.containsSinglet():
+            return False
+    return True
+
+
+def readLCheckpoint(path: str, key: str) -> Tuple[int, List[int]]:
+    """
+    :param path: checkpoint written by calculateL
+    :param key: content hash of the theory and filter flag the checkpoint must belong to
+    :return: number of candidates checked, [index of each accepted candidate], nothing if no file
+    """
+    if not os.path.exists(path):
+        return 0, []
+    try:
+        with open(path) as f:
+            record = json.load(f)
+        position, found = int(record["position"]), [int(i) for i in record["found"]]
+    except (ValueError, KeyError, TypeError):
+        raise ValueError("Unreadable checkpoint {}".format(path))
+    if record.get("key") != key:
+        raise ValueError("Checkpoint {} belongs to a different calculation.".format(path))
+    return position, found
+
+
+def writeLCheckpoint(path: str, key: str, position: int, found: Sequence[int]):
+    """
+    Write progress of calculateL to a temporary file and rename it into place, so an interruption
+    leaves either the previous checkpoint or the new one
+    :param path: checkpoint file
+    :param key: content hash of the theory and filter flag
+    :param position: number of candidates checked
+    :param found: indices of the candidates accepted among them
+    """
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump({"key": key, "position": position, "found": list(found)}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmppath, path)
+    except BaseException:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
+
+def abelianSinglets(fields: Sequence[Field], candidates: Sequence[Sequence[Field]],
+                    charges: numpy.ndarray) -> numpy.ndarray:
+    """
+    Check the abelian charges of all candidates at once as a product of the matrix of field
+    counts with the charge matrix.
+    :param fields: every field and antifield the candidates are made of
+    :param candidates: candidate terms
+    :param charges: array of shape (len(fields), number of charges)
+    :return: boolean array, true where every charge of a candidate sums to zero
+    """
+    findex = {id(f): i for i, f in enumerate(fields)}
+    rows = numpy.repeat(numpy.arange(len(candidates)), [len(c) for c in candidates])
+    cols = numpy.fromiter((findex[id(f)] for c in candidates for f in c), dtype=int, count=len(rows))
+    counts = numpy.zeros((len(candidates), len(fields)), dtype=int)
+    numpy.add.at(counts, (rows, cols), 1)
+    return numpy.all(counts.dot(charges) == 0, axis=1)
+
+
+def shardedSinglets(syms: Sequence[Symmetry], fields: Sequence[Field],
+                    candidates: Sequence[Sequence[Field]], workers: int) -> Set[int]:
+    """
+    Check candidates for singlets on a pool of processes. Candidates are split into contiguous
+    ranges of indices, a few per worker since later (longer) candidates cost more, and are sent
+    as tuples of indices into fields.
+    :param syms: symmetries of the theory
+    :param fields: every field and antifield the candidates are made of
+    :param candidates: candidate terms
+    :param workers: number of processes
+    :return: indices of candidates containing a singlet of every symmetry
+    """
+    findex = {id(f): i for i, f in enumerate(fields)}
+    codes = [tuple(findex[id(f)] for f in encoding) for encoding in candidates]
+    nshards = min(len(codes), 4 * workers)
+    bounds = [len(codes) * i // nshards for i in range(nshards + 1)]
+    shards = [(bounds[i], codes[bounds[i]:bounds[i+1]]) for i in range(nshards)]
+    allowed = set()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_initShardWorker,
+                             initargs=(list(syms), list(fields))) as executor:
+        for indices in executor.map(_checkShard, shards):
+            allowed.update(indices)
+    return allowed
+
+
+_shardSyms = None
+_shardFields = None
+
+
+def _initShardWorker(syms: List[Symmetry], fields: List[Field]):
+    global _shardSyms, _shardFields
+    _shardSyms = syms
+    _shardFields = fields
+
+
+def _checkShard(shard: Tuple[int, List[Tuple[int, ...]]]) -> List[int]:
+    offset, codes = shard
+    return [offset + i for i, code in enumerate(codes)
+            if hasSinglets(_shardSyms, [_shardFields[c] for c in code])]
@@ -1,7 +1,10 @@
 import math
+import os
+import pickle
 import numpy
+from fractions import Fraction
 from functools import reduce
-from typing import Sequence, TypeVar, List, Tuple, Generator, Mapping
+from typing import Sequence, TypeVar, List, Tuple, Generator, Mapping, Dict, Optional, Callable, Iterable
 
 T = TypeVar('T')
 
@@ -56,6 +59,41 @@ def weightedTruncatedPowerset(values: Sequence[Tuple[T, int]], trunc: int, depth
         return wh + woh
 
 
+def conjugateCanonicalCounts(n: int, trunc: int) -> List[Tuple[Tuple[int, ...], Tuple[int, ...]]]:
+    """
+    Multisets of n fields and their n antifields with between 1 and trunc members, one for each
+    conjugate pair. The multiset with m_i copies of field i and a_i of antifield i is conjugate
+    to (a, m), and only the one with m >= a lexicographically is produced, so self conjugate
+    multisets (m == a) appear once and the rest stand for themselves and their partner.
+    They are ordered as truncCombinations orders the fields followed by the antifields: by size,
+    then by the counts (m, a) descending, so the representative is the first of its pair.
+    :param n: number of fields
+    :param trunc: largest multiset
+    :return: [(m, a)]
+    """
+    pairs = []
+    for m in _countVectors(n, trunc):
+        for a in _countVectors(n, trunc - sum(m), m):
+            if sum(m) + sum(a) > 0:
+                pairs.append((m, a))
+    return sorted(pairs, key=lambda p: (sum(p[0]) + sum(p[1]), tuple(-k for k in p[0] + p[1])))
+
+
+def _countVectors(n: int, budget: int, bound: Tuple[int, ...] = None) -> Generator[Tuple[int, ...], None, None]:
+    """
+    :yield: vectors of n non negative integers summing to at most budget, and lexicographically
+            at most bound if given, in descending lexicographic order
+    """
+    if n == 0:
+        yield ()
+        return
+    top = budget if bound is None else min(budget, bound[0])
+    for first in range(top, -1, -1):
+        tight = bound is not None and first == bound[0]
+        for rest in _countVectors(n - 1, budget - first, bound[1:] if tight else None):
+            yield (first,) + rest
+
+
 def genInOutPairs(fieldvec: Sequence[int],
                   swapvec: Sequence[int] = None) -> Generator[Tuple[numpy.ndarray, numpy.ndarray], None, None]:
     """
@@ -102,25 +140,459 @@ def chooseNFromM(n: int, m: int) -> Generator[List[int], None, None]:
                 yield [i] + tail
 
 
-def genVectorPaths(start: Sequence[int], end: Sequence[int],
-                   nodes: Mapping[T, Tuple[Sequence[int], Sequence[int]]],
-                   trunc: int) -> Generator[List[Tuple[T, Sequence[int], Sequence[int]]], None, None]:
-    start, end = numpy.asarray(start), numpy.asarray(end)
-    if trunc == 0:
-        yield []
-
-    for node in nodes:
-        node_tuple = (node, nodes[node][0], nodes[node][1])
-        required_particles, produced_particles = numpy.asarray(nodes[node][0]), numpy.asarray(nodes[node][1])
-        comb = start + required_particles
-        if not numpy.all(numpy.positive(comb)):
-            continue
-        after_inter = comb + produced_particles
-        if numpy.array_equal(after_inter, end):
-            yield [node_tuple]
-        else:
-            for subpath in genVectorPaths(start, end, nodes, trunc - 1):
-                yield [node_tuple] + subpath
+def applyVectorNode(state: Tuple[int, ...], taken: Sequence[int],
+                    given: Sequence[int]) -> Optional[Tuple[int, ...]]:
+    """
+    Apply a node to a vector of particle counts
+    :param state: particle counts before the node
+    :param taken: (non-positive) particles removed by the node
+    :param given: particles added by the node
+    :return: particle counts after the node, or None if state lacks the required particles
+    """
+    after = []
+    for s, t, g in zip(state, taken, given):
+        c = s + t
+        if c < 0:
+            return None
+        after.append(c + g)
+    return tuple(after)
+
+
+def reverseVectorNode(state: Tuple[int, ...], taken: Sequence[int],
+                      given: Sequence[int]) -> Optional[Tuple[int, ...]]:
+    """
+    Undo a node, the inverse of applyVectorNode
+    :param state: particle counts after the node
+    :param taken: (non-positive) particles removed by the node
+    :param given: particles added by the node
+    :return: particle counts before the node, or None if the node could not have produced state
+    """
+    before = []
+    for s, t, g in zip(state, taken, given):
+        c = s - g
+        if c < 0:
+            return None
+        before.append(c - t)
+    return tuple(before)
+
+
+def _asNodeList(nodes) -> List[Tuple[T, Tuple[int, ...], Tuple[int, ...], Tuple]]:
+    """
+    Normalize nodes given either as {node: (taken, given)} or as [(node, taken, given)]
+    :return: [(node, taken, given, original_tuple)] with taken and given as tuples of ints
+    """
+    if isinstance(nodes, Mapping):
+        nodes = [(node, nodes[node][0], nodes[node][1]) for node in nodes]
+    return [(node, tuple(int(x) for x in taken), tuple(int(x) for x in given), (node, taken, given))
+            for node, taken, given in nodes]
+
+
+class NodeIndex:
+    """
+    Nodes indexed by the vector entries which must be nonzero for them to apply: the particles
+    they take going forward, and those they give going backward. The nodes which may apply to
+    a state are looked up by the set of its nonzero entries as a bitmask, and remembered for
+    that set, so searches skip nodes needing particle types the state lacks. Nodes keep their
+    order, so searches using the index visit nodes as they would by scanning the whole list.
+    """
+    def __init__(self, nodes):
+        """
+        :param nodes: list of (node, taken, given) or {node: (taken, given)}
+        """
+        self.nodelist = _asNodeList(nodes)
+        self.needs = [_bitmask(-t for t in taken) for _, taken, _, _ in self.nodelist]
+        self.gives = [_bitmask(given) for _, _, given, _ in self.nodelist]
+        self._forward = {}
+        self._backward = {}
+
+    def __len__(self):
+        return len(self.nodelist)
+
+    def forward(self, state: Sequence[int]) -> Tuple[int, ...]:
+        """
+        :return: indices of the nodes whose taken particle types are all present in state
+        """
+        present = _bitmask(state)
+        found = self._forward.get(present)
+        if found is None:
+            found = tuple(i for i, need in enumerate(self.needs) if need & ~present == 0)
+            self._forward[present] = found
+        return found
+
+    def backward(self, state: Sequence[int]) -> Tuple[int, ...]:
+        """
+        :return: indices of the nodes whose given particle types are all present in state
+        """
+        present = _bitmask(state)
+        found = self._backward.get(present)
+        if found is None:
+            found = tuple(i for i, give in enumerate(self.gives) if give & ~present == 0)
+            self._backward[present] = found
+        return found
+
+
+def _bitmask(counts: Iterable[int]) -> int:
+    """
+    :return: integer with bit j set where counts[j] > 0
+    """
+    mask = 0
+    for j, c in enumerate(counts):
+        if c > 0:
+            mask |= 1 << j
+    return mask
+
+
+def integerColumns(values) -> numpy.ndarray:
+    """
+    Scale each column of rational values by the least common multiple of its denominators, so
+    that charges like hypercharge 1/6 become integers while keeping their ratios. Floats are
+    read as the nearest fraction with denominator at most 10**6.
+    :param values: 2d array-like of ints, floats or Fractions
+    :return: int array of the same shape
+    """
+    rows = [[rational(x) for x in row] for row in values]
+    ncols = len(rows[0]) if len(rows) > 0 else 0
+    scaled = numpy.zeros((len(rows), ncols), dtype=int)
+    for j in range(ncols):
+        scale = reduce(lambda a, b: a * b // math.gcd(a, b), (row[j].denominator for row in rows), 1)
+        for i, row in enumerate(rows):
+            scaled[i, j] = int(row[j] * scale)
+    return scaled
+
+
+def rational(x) -> Fraction:
+    """
+    :param x: int, float or Fraction, floats being read as the nearest fraction with
+    denominator at most 10**6 so that 1/6 is exactly a sixth
+    :return: exact value as a Fraction
+    """
+    return Fraction(x).limit_denominator(10**6) if isinstance(x, float) else Fraction(x)
+
+
+def nodeEffects(nodes, weights: Sequence[Sequence[int]]) -> numpy.ndarray:
+    """
+    Change of each linear quantity (particle numbers, charges) caused by each node
+    :param nodes: list of (node, taken, given) or {node: (taken, given)}
+    :param weights: [weight per vector entry] for each quantity
+    :return: array of shape (len(nodes), len(weights))
+    """
+    nodelist = _asNodeList(nodes)
+    deltas = numpy.array([numpy.add(taken, given) for _, taken, given, _ in nodelist], dtype=int)
+    return deltas.reshape(len(nodelist), -1).dot(numpy.asarray(weights, dtype=int).T)
+
+
+def linearLowerBound(target: Sequence[int], weights: Sequence[Sequence[int]], effects: numpy.ndarray,
+                     reverse: bool = False) -> Callable[[Tuple[int, ...]], float]:
+    """
+    Builds an admissible estimate of the number of nodes separating a state from target:
+    each quantity must be moved from its value at the state to its value at target, and
+    no node moves it further than the largest step any node makes in that direction.
+    Quantities which no node changes (conserved charges) give an infinite bound on mismatch.
+    :param target: vector of particle counts to reach
+    :param weights: [weight per vector entry] for each quantity
+    :param effects: result of nodeEffects for the same weights
+    :param reverse: bound the nodes leading from target to the state instead
+    :return: function state -> lower bound on the number of nodes between state and target
+    """
+    weights = numpy.asarray(weights, dtype=int).reshape(-1, len(target))
+    effects = numpy.asarray(effects).reshape(-1, len(weights))
+    if reverse:
+        effects = -effects
+    goal = weights.dot(numpy.asarray(target, dtype=int))
+    up = numpy.maximum(effects.max(axis=0, initial=0), 0).astype(float)
+    down = numpy.maximum(-effects.min(axis=0, initial=0), 0).astype(float)
+    cache = {}
+
+    def bound(state: Tuple[int, ...]) -> float:
+        if state not in cache:
+            need = goal - weights.dot(state)
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                steps = numpy.where(need > 0, need / up, numpy.where(need < 0, -need / down, 0.0))
+            cache[state] = float(numpy.ceil(steps.max(initial=0.0)))
+        return cache[state]
+    return bound
+
+
+def vectorPathLayers(start: Tuple[int, ...], nodes, depth: int,
+                     reverse: bool = False, bound: Callable[[Tuple[int, ...]], float] = None) -> List[Dict[Tuple[int, ...], int]]:
+    """
+    Breadth first expansion of the number of paths reaching each state.
+    :param start: initial vector of particle counts
+    :param nodes: list of (node, taken, given)
+    :param depth: number of layers to expand
+    :param reverse: expand backwards from start (treated as the end state) instead
+    :param bound: optional lower bound on the nodes from a state to the far end, states with
+                  bound(state) > depth - i are dropped from layer i
+    :return: [{state: number of paths of length i}] for i in 0..depth
+    """
+    return _expandLayers(tuple(int(x) for x in start), NodeIndex(nodes), depth, reverse, bound)
+
+
+def _expandLayers(start: Tuple[int, ...], index: NodeIndex, depth: int, reverse: bool,
+                  bound: Callable[[Tuple[int, ...]], float] = None) -> List[Dict[Tuple[int, ...], int]]:
+    step = reverseVectorNode if reverse else applyVectorNode
+    lookup = index.backward if reverse else index.forward
+    nodelist = index.nodelist
+    layers = [{start: 1}]
+    for i in range(1, depth + 1):
+        layer = {}
+        for state, count in layers[-1].items():
+            for n in lookup(state):
+                _, taken, given, _ = nodelist[n]
+                nextstate = step(state, taken, given)
+                if nextstate is not None:
+                    layer[nextstate] = layer.get(nextstate, 0) + count
+        if bound is not None:
+            layer = {state: count for state, count in layer.items() if bound(state) <= depth - i}
+        layers.append(layer)
+    return layers
+
+
+def countVectorPaths(start: Sequence[int], end: Sequence[int], nodes, trunc: int,
+                     weights: Sequence[Sequence[int]] = None, effects: numpy.ndarray = None,
+                     stats=None, index: NodeIndex = None) -> List[int]:
+    """
+    Counts the paths from start to end without enumerating them, by meeting a forward
+    expansion from start with a backward expansion from end halfway.
+    :param start: initial vector of particle counts
+    :param end: final vector of particle counts
+    :param nodes: list of (node, taken, given) or {node: (taken, given)}
+    :param trunc: maximum number of nodes
+    :param weights: optional linear quantities used to prune states, see linearLowerBound
+    :param effects: nodeEffects for weights, computed if not given
+    :param stats: optional Instrumentation.Stats counting the states expanded
+    :param index: NodeIndex of nodes, built if not given
+    :return: [number of paths using i nodes] for i in 0..trunc, entry 0 always being 0 as a path
+             has at least one node, even when start is end (see genVectorPaths)
+    """
+    index = NodeIndex(nodes) if index is None else index
+    nodelist = index.nodelist
+    start = tuple(int(x) for x in start)
+    end = tuple(int(x) for x in end)
+    tostart, toend = None, None
+    if weights is not None:
+        if effects is None:
+            effects = nodeEffects([entry[3] for entry in nodelist], weights)
+        tostart = linearLowerBound(start, weights, effects, reverse=True)
+        toend = linearLowerBound(end, weights, effects)
+        if toend(start) > trunc:
+            return [0 for _ in range(trunc + 1)]
+    forward = _expandLayers(start, index, trunc - trunc // 2, False, _shifted(toend, trunc // 2))
+    backward = _expandLayers(end, index, trunc // 2, True, _shifted(tostart, trunc - trunc // 2))
+    if stats is not None:
+        stats.count("states expanded", sum(len(layer) for layer in forward + backward))
+    counts = [0]
+    for order in range(1, trunc + 1):
+        f, b = forward[order - order // 2], backward[order // 2]
+        if len(f) > len(b):
+            f, b = b, f
+        counts.append(sum(n * b[state] for state, n in f.items() if state in b))
+    return counts
+
+
+def _shifted(bound: Callable[[Tuple[int, ...]], float], offset: int) -> Optional[Callable[[Tuple[int, ...]], float]]:
+    """
+    Lower bound for the remainder of a path once offset nodes are reserved for the other half
+    """
+    if bound is None:
+        return None
+    return lambda state: bound(state) - offset
+
+
+def genVectorPaths(start: Sequence[int], end: Sequence[int], nodes, trunc: int,
+                   weights: Sequence[Sequence[int]] = None, effects: numpy.ndarray = None,
+                   stats=None, index: NodeIndex = None,
+                   after: Sequence[int] = None) -> Generator[List[Tuple[T, Sequence[int], Sequence[int]]], None, None]:
+    """
+    Generates each sequence of between one and trunc nodes taking start to end, so the empty
+    path is never generated even when start is end.
+    Paths come in depth first order, nodes being tried in the order given and each path
+    coming before its extensions, so a run can be resumed from the last path it generated.
+    The number of paths leaving each (state, remaining nodes) pair is memoized so that only
+    branches which reach end are explored; states further than trunc//2 nodes from end are
+    recognized from a backward expansion and pruned once the remaining budget drops below it.
+    If weights are given, branches whose linearLowerBound exceeds the remaining budget are cut
+    at any depth.
+    :param start: initial vector of particle counts
+    :param end: final vector of particle counts
+    :param nodes: list of (node, taken, given) or {node: (taken, given)}
+    :param trunc: maximum number of nodes
+    :param weights: optional linear quantities used to prune states, see linearLowerBound
+    :param effects: nodeEffects for weights, computed if not given
+    :param stats: optional Instrumentation.Stats counting memo hits and pruned branches
+    :param index: NodeIndex of nodes, built if not given
+    :param after: indices into nodes of a path generated before, only the paths following it are generated
+    :yield: [(node, taken, given)]
+    """
+    index = NodeIndex(nodes) if index is None else index
+    nodelist = index.nodelist
+    start = tuple(int(x) for x in start)
+    end = tuple(int(x) for x in end)
+    after = () if after is None else tuple(int(n) for n in after)
+    toend = None
+    if weights is not None:
+        if effects is None:
+            effects = nodeEffects([entry[3] for entry in nodelist], weights)
+        toend = linearLowerBound(end, weights, effects)
+
+    # Minimum number of nodes from each state to end, up to half the budget
+    horizon = trunc // 2
+    distance = {}
+    for i, layer in enumerate(_expandLayers(end, index, horizon, True)):
+        for state in layer:
+            distance.setdefault(state, i)
+
+    memo = {}
+
+    def remainingPaths(state: Tuple[int, ...], remaining: int) -> int:
+        """Number of non-empty paths from state to end using at most remaining nodes"""
+        if remaining <= 0:
+            return 0
+        if remaining <= horizon and distance.get(state, horizon + 1) > remaining:
+            if stats is not None:
+                stats.count("branches pruned by distance")
+            return 0
+        if toend is not None and toend(state) > remaining:
+            if stats is not None:
+                stats.count("branches pruned by bound")
+            return 0
+        key = (state, remaining)
+        if stats is not None:
+            stats.count("path memo hits" if key in memo else "path memo misses")
+        if key not in memo:
+            total = 0
+            for n in index.forward(state):
+                _, taken, given, _ = nodelist[n]
+                nextstate = applyVectorNode(state, taken, given)
+                if nextstate is not None:
+                    total += (nextstate == end) + remainingPaths(nextstate, remaining - 1)
+            memo[key] = total
+        return memo[key]
+
+    def walk(state: Tuple[int, ...], remaining: int, skip: Tuple[int, ...]) -> Generator[List, None, None]:
+        # skip is what is left of after below this state, everything up to it has been generated
+        for n in index.forward(state):
+            if skip and n < skip[0]:
+                continue
+            _, taken, given, node_tuple = nodelist[n]
+            nextstate = applyVectorNode(state, taken, given)
+            if nextstate is None:
+                continue
+            resumed = bool(skip) and n == skip[0]
+            if nextstate == end and not resumed:
+                yield [node_tuple]
+            if remainingPaths(nextstate, remaining - 1) > 0:
+                for subpath in walk(nextstate, remaining - 1, skip[1:] if resumed else ()):
+                    yield [node_tuple] + subpath
+
+    if remainingPaths(start, trunc) > 0:
+        yield from walk(start, trunc, after)
+
+
+class VectorPathSearch:
+    """
+    Breadth first search from one start state which is kept between queries, so that asking
+    for longer paths only expands the layers not yet reached and any number of end states can
+    be looked up in the same layers.
+
+    Layer i holds the number of paths of i nodes reaching each state, together with the
+    states each node leads to from it. Counting the paths to an end state reads them off the
+    layers, and listing them walks the stored edges, skipping states which cannot reach the
+    end in time, in the same order as genVectorPaths. Unlike genVectorPaths nothing is pruned
+    while expanding, as the end states are not known then.
+    """
+    def __init__(self, start: Sequence[int], nodes, stats=None, index: NodeIndex = None):
+        """
+        :param start: initial vector of particle counts
+        :param nodes: list of (node, taken, given) or {node: (taken, given)}
+        :param stats: optional Instrumentation.Stats counting the layers and states expanded
+        :param index: NodeIndex of nodes, built if not given
+        """
+        self.start = tuple(int(x) for x in start)
+        self.index = NodeIndex(nodes) if index is None else index
+        self.nodelist = self.index.nodelist
+        self.stats = stats
+        self.layers = [{self.start: 1}]
+        # edges[i][state] = [(node index, next state)] for states of layer i
+        self.edges = []
+
+    @property
+    def depth(self) -> int:
+        return len(self.layers) - 1
+
+    def extend(self, depth: int):
+        """
+        Expand layers until paths of depth nodes are known
+        """
+        while self.depth < depth:
+            layer, edges = {}, {}
+            for state, count in self.layers[-1].items():
+                out = []
+                for n in self.index.forward(state):
+                    _, taken, given, _ = self.nodelist[n]
+                    nextstate = applyVectorNode(state, taken, given)
+                    if nextstate is not None:
+                        out.append((n, nextstate))
+                        layer[nextstate] = layer.get(nextstate, 0) + count
+                edges[state] = out
+            self.edges.append(edges)
+            self.layers.append(layer)
+            if self.stats is not None:
+                self.stats.count("layers expanded")
+                self.stats.count("states expanded", len(layer))
+
+    def countPaths(self, end: Sequence[int], trunc: int) -> List[int]:
+        """
+        :return: [number of paths from start to end using i nodes] for i in 0..trunc, entry 0 always being 0
+        """
+        self.extend(trunc)
+        end = tuple(int(x) for x in end)
+        return [0] + [self.layers[i].get(end, 0) for i in range(1, trunc + 1)]
+
+    def paths(self, end: Sequence[int], trunc: int) -> Generator[List[Tuple[T, Sequence[int], Sequence[int]]], None, None]:
+        """
+        :yield: each sequence of at most trunc nodes taking start to end, as [(node, taken, given)]
+        """
+        self.extend(trunc)
+        end = tuple(int(x) for x in end)
+        # alive[i]: states of layer i with a non-empty continuation reaching end within trunc nodes
+        alive = [set() for _ in range(trunc + 1)]
+        for i in range(trunc - 1, -1, -1):
+            for state, out in self.edges[i].items():
+                if any(nextstate == end or nextstate in alive[i + 1] for _, nextstate in out):
+                    alive[i].add(state)
+
+        def walk(state: Tuple[int, ...], i: int) -> Generator[List, None, None]:
+            for n, nextstate in self.edges[i][state]:
+                node_tuple = self.nodelist[n][3]
+                if nextstate == end:
+                    yield [node_tuple]
+                if nextstate in alive[i + 1]:
+                    for subpath in walk(nextstate, i + 1):
+                        yield [node_tuple] + subpath
+
+        if self.start in alive[0]:
+            yield from walk(self.start, 0)
+
+
+def readPickleLog(path: str) -> Tuple[List, int]:
+    """
+    Read a file of records appended one pickle.dump at a time, stopping at a record cut short
+    by an interrupted writer
+    :param path: log file, which need not exist
+    :return: records, number of bytes up to the end of the last complete record
+    """
+    records = []
+    end = 0
+    if not os.path.exists(path):
+        return records, end
+    with open(path, "rb") as f:
+        while True:
+            try:
+                records.append(pickle.load(f))
+            except (EOFError, pickle.UnpicklingError, ValueError, IndexError):
+                return records, end
+            end = f.tell()
 
 
 if __name__ == "__main__":
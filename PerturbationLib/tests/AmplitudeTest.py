@@ -0,0 +1,51 @@
+import numpy
+
+from PerturbationLib.Amplitude import TreeAmplitude
+from PerturbationLib.PhaseSpace import rambo, decayWidth
+from PerturbationLib.tests.FeynmanTest import makeTheory
+
+
+def minkowski(p):
+    return p[..., 0] ** 2 - numpy.sum(p[..., 1:] ** 2, axis=-1)
+
+
+def DecayMatchesFeynmanRules():
+    t = makeTheory()
+    couplings = {"g_{1}": 0.5, "g_{2}": 0.7, "g_{3}": -1.3, "g_{4}": 0.4, "g_{7}": 2.1, "g_{9}": 1.1,
+                 "m_{\\phi}": 0.25, "m_{\\psi}": 9.0}
+    amp = TreeAmplitude.fromProcess(t, {("\\psi", False): 1}, {("\\phi", False): 2, ("\\zeta", False): 1},
+                                    couplings)
+    # The g_{1} insertion on the outgoing zeta leg is not amputated
+    assert len(amp.diagrams) == 4
+
+    rng = numpy.random.default_rng(1)
+    momenta = rng.normal(size=(1000, 4, 4))
+    momenta[:, 0] = momenta[:, 1:].sum(axis=1)
+    p1, p2, k = momenta[:, 1], momenta[:, 2], momenta[:, 3]
+
+    expected = 2 * couplings["g_{7}"] \
+        + 2 * couplings["g_{2}"] * couplings["g_{3}"] / (minkowski(p1 + k) - couplings["m_{\\phi}"]) \
+        + 2 * couplings["g_{2}"] * couplings["g_{3}"] / (minkowski(p2 + k) - couplings["m_{\\phi}"]) \
+        + 2 * couplings["g_{2}"] * couplings["g_{4}"] / (minkowski(p1 + p2) - couplings["m_{\\psi}"])
+    assert numpy.allclose(amp.amplitude(momenta), expected)
+    assert numpy.allclose(amp(momenta), expected ** 2)
+
+
+def OnShellIsFinite():
+    t = makeTheory()
+    couplings = {"g_{1}": 0.5, "g_{2}": 0.7, "g_{3}": -1.3, "g_{4}": 0.4, "g_{7}": 2.1, "g_{9}": 1.1,
+                 "m_{\\phi}": 0.25, "m_{\\psi}": 9.0}
+    amp = TreeAmplitude.fromProcess(t, {("\\psi", False): 1}, {("\\phi", False): 2, ("\\zeta", False): 1},
+                                    couplings)
+    mass, outmasses = 10.0, [0.5, 0.5, 0.0]
+    outgoing, _ = rambo(mass, outmasses, 1000, numpy.random.default_rng(2))
+    momenta = numpy.concatenate([numpy.tile([[[mass, 0.0, 0.0, 0.0]]], (len(outgoing), 1, 1)), outgoing], axis=1)
+    assert numpy.all(numpy.isfinite(amp.amplitude(momenta)))
+
+    width, error = decayWidth(amp, mass, outmasses, 1000, symmetry=2, seed=2)
+    assert numpy.isfinite(width) and numpy.isfinite(error) and width > 0
+
+
+if __name__ == "__main__":
+    DecayMatchesFeynmanRules()
+    OnShellIsFinite()
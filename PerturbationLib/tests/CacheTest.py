@@ -0,0 +1,82 @@
+import os
+import tempfile
+
+from PerturbationLib.Cache import LagrangianCache
+from PerturbationLib.Theory import Theory, Field
+from PerturbationLib.Symmetries import U
+from PerturbationLib.SUSymmetry import SU
+
+
+def makeTheory(charge=2, cache=None, trunc=4):
+    usym = U(1)
+    susym = SU(2)
+    t = Theory(usym, susym, trunc=trunc, cache=cache)
+    t.addField(Field("\\phi", usym((1,)), susym((1,))))
+    t.addField(Field("\\psi", usym((charge,)), susym((0,))))
+    t.addField(Field("\\zeta", usym((0,)), susym((0,))))
+    return t
+
+
+def ContentHash():
+    assert makeTheory().contentHash() == makeTheory().contentHash()
+    assert makeTheory().contentHash() != makeTheory(charge=3).contentHash()
+    assert makeTheory().contentHash() != makeTheory(trunc=3).contentHash()
+
+
+def RoundTrip():
+    with tempfile.TemporaryDirectory() as directory:
+        cache = LagrangianCache(directory)
+        first = makeTheory(cache=cache)
+        first.stats.enable()
+        expected = repr(first)
+        assert first.stats.counters["disk cache misses"] == 1
+
+        second = makeTheory(cache=cache)
+        second.stats.enable()
+        assert repr(second) == expected
+        assert second.stats.counters["disk cache hits"] == 1
+        assert [i.intRepr for i in second.getInt()] == [i.intRepr for i in first.getInt()]
+
+        # A different theory does not pick up the cached terms
+        other = makeTheory(charge=3, cache=cache)
+        assert repr(other) == repr(makeTheory(charge=3))
+
+        # Corrupt files are ignored and replaced
+        path = cache.path(cache.key(first))
+        with open(path, "wb") as f:
+            f.write(b"PLLC garbage")
+        assert repr(makeTheory(cache=cache)) == expected
+        assert cache.load(first) is not None
+
+
+def FractionalCharges():
+    # Charges differing only in their fractional parts are different theories
+    hashes = [makeTheory(charge=charge).contentHash() for charge in [0, 1 / 6, 1 / 3]]
+    assert len(set(hashes)) == 3
+    with tempfile.TemporaryDirectory() as directory:
+        cache = LagrangianCache(directory)
+        assert repr(makeTheory(charge=0, cache=cache)) == repr(makeTheory(charge=0))
+        assert repr(makeTheory(charge=1 / 6, cache=cache)) == repr(makeTheory(charge=1 / 6))
+        assert repr(makeTheory(charge=0)) != repr(makeTheory(charge=1 / 6))
+
+
+def Eviction():
+    with tempfile.TemporaryDirectory() as directory:
+        cache = LagrangianCache(directory)
+        for charge in range(5):
+            makeTheory(charge=charge, cache=cache).calculateL()
+        sizes = [os.path.getsize(os.path.join(directory, n)) for n in os.listdir(directory)]
+        assert len(sizes) == 5
+
+        cache.maxbytes = sum(sizes) - 1
+        os.utime(cache.path(cache.key(makeTheory(charge=0))), (0, 0))
+        cache.evict()
+        assert len(os.listdir(directory)) == 4
+        assert cache.load(makeTheory(charge=0)) is None
+
+
+if __name__ == "__main__":
+    ContentHash()
+    RoundTrip()
+    FractionalCharges()
+    Eviction()
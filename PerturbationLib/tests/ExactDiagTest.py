@@ -0,0 +1,76 @@
+import numpy
+
+from PerturbationLib.ExactDiag import assemble, assembleBlocks, lowestEigenpairs, compileOperator, \
+    conservedQuantities
+from PerturbationLib.ParticleState import SingleState, State, XOp, COp, AOp
+
+
+def MatchesParticleState():
+    # Applying operators to states ignores the multipliers of products, so none are used here
+    op = COp(0) * AOp(1) + XOp(0) * XOp(1) * XOp(1) + AOp(0) * AOp(0) * COp(1)
+    matrix, basis = assemble(op, cutoff=3)
+    matrix = matrix.toarray()
+    states = basis.states()
+    index = {tuple(s): i for i, s in enumerate(states.tolist())}
+    for j, s in enumerate(states.tolist()):
+        result = op * SingleState(s)
+        result = result.states if isinstance(result, State) else [result]
+        column = numpy.zeros(len(states))
+        for r in result:
+            if tuple(r.particles) in index:
+                column[index[tuple(r.particles)]] += float(r.mult)
+        assert numpy.allclose(column, matrix[:, j])
+
+
+def CoupledOscillators():
+    # n_0 + n_1 + g (a'_0 a_1 + a'_1 a_0) conserves total number, its normal modes have 1 +- g
+    g = 0.3
+    op = COp(0) * AOp(0) + COp(1) * AOp(1) + g * (COp(0) * AOp(1)) + g * (COp(1) * AOp(0))
+    values, vectors, basis = lowestEigenpairs(op, cutoff=9, k=6, total=True)
+    expected = sorted(a * (1 + g) + b * (1 - g) for a in range(10) for b in range(10) if a + b <= 9)[:6]
+    assert numpy.allclose(values, expected)
+
+    # Large enough for the sparse solver
+    op = op + 0.1 * (XOp(0) * XOp(0) * XOp(1) * XOp(1))
+    values, vectors, basis = lowestEigenpairs(op, cutoff=20, k=3, total=True)
+    matrix, _ = assemble(op, cutoff=20, total=True)
+    assert numpy.allclose(values, numpy.linalg.eigvalsh(matrix.toarray())[:3])
+    assert numpy.allclose(matrix.dot(vectors), vectors * values, atol=1e-8)
+
+
+def ConservedQuantities():
+    def names(op):
+        return [name for name, _, _ in conservedQuantities(compileOperator(op), 3)]
+
+    assert names(COp(0) * AOp(1) + COp(1) * AOp(0) + COp(2) * AOp(2)) == ["N_2", "N"]
+    assert names(XOp(0) * XOp(0) + XOp(1) * XOp(2)) == ["P_0", "P"]
+    assert names(XOp(0) + XOp(1) * XOp(2)) == []
+
+
+def Blocks():
+    g = 0.3
+    op = COp(0) * AOp(0) + COp(1) * AOp(1) + g * (COp(0) * AOp(1)) + g * (COp(1) * AOp(0)) \
+        + 0.1 * (COp(0) * COp(0) * AOp(1) * AOp(1)) + 0.1 * (COp(1) * COp(1) * AOp(0) * AOp(0))
+    blocks, basis, quantities = assembleBlocks(op, cutoff=30, total=True)
+    assert len(blocks) == 31
+    assert sum(len(ranks) for _, ranks in blocks.values()) == len(basis)
+
+    # Blocks are the diagonal blocks of the full matrix, which has nothing outside them
+    full, _ = assemble(op, cutoff=30, total=True)
+    nnz = 0
+    for matrix, ranks in blocks.values():
+        assert numpy.allclose(full[ranks][:, ranks].toarray(), matrix.toarray())
+        nnz += matrix.nnz
+    assert nnz == full.nnz
+
+    # Sector by sector diagonalization finds the same lowest eigenpairs as the whole matrix
+    values, vectors, basis = lowestEigenpairs(op, cutoff=30, k=4, total=True)
+    assert numpy.allclose(values, numpy.linalg.eigvalsh(full.toarray())[:4])
+    assert numpy.allclose(full.dot(vectors), vectors * values)
+
+
+if __name__ == "__main__":
+    MatchesParticleState()
+    CoupledOscillators()
+    ConservedQuantities()
+    Blocks()
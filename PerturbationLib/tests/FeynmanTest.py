@@ -1,11 +1,16 @@
+import os
+import tempfile
+
 import numpy
 
-from PerturbationLib.Feynman import Feynman
+from PerturbationLib.Feynman import Feynman, Diagram
 from PerturbationLib.Theory import Theory, Field
-from PerturbationLib.Symmetries import U
+from PerturbationLib.Symmetries import U, U1Product
 from PerturbationLib.SUSymmetry import SU
+from PerturbationLib import Utilities
 
-if __name__ == "__main__":
+
+def makeTheory():
     usym = U(1)
     susym = SU(2)
 
@@ -16,22 +21,248 @@ if __name__ == "__main__":
     t.addField(f2)
     f3 = Field("\zeta", usym((0,)), susym((0,)))
     t.addField(f3)
+    return t
 
-    print(t.getInt())
 
+def PathsReachEnd():
+    startd = {("\psi", False): 1}
+    endd = {("\phi", False): 2}
+
+    feyn = Feynman(makeTheory())
+    paths = list(feyn.listPaths(startd, endd, maxorder=3))
+
+    endvec = feyn.convertDictToVec(endd)
+    for path in paths:
+        start = feyn.convertDictToVec(startd)
+        for inter in path:
+            start += inter[1]
+            assert numpy.all(start >= 0)
+            start += inter[2]
+        assert numpy.array_equal(start, endvec)
+
+    counts = feyn.countPaths(startd, endd, maxorder=3)
+    assert sum(counts) == len(paths)
+    for order in range(1, 4):
+        assert counts[order] == len([p for p in paths if len(p) == order])
+
+    # Paths back to the start state have at least one vertex, counted or listed
+    loops = list(feyn.listPaths(startd, startd, maxorder=3))
+    for incremental in [False, True]:
+        counts = feyn.countPaths(startd, startd, maxorder=3, incremental=incremental)
+        assert counts[0] == 0 and sum(counts) == len(loops)
+
+
+def ChargeBoundsPrune():
+    feyn = Feynman(makeTheory())
+    startd = {("\psi", False): 1}
+
+    # U(1) charge 2 cannot become charge 1
+    assert feyn.lowerBound(startd, {("\phi", False): 1}) == float('inf')
+    assert sum(feyn.countPaths(startd, {("\phi", False): 1}, maxorder=6)) == 0
+    assert len(list(feyn.listPaths(startd, {("\phi", False): 1}, maxorder=6))) == 0
+
+    endd = {("\phi", False): 2}
+    assert feyn.lowerBound(startd, endd) == 1
+    unpruned = Utilities.countVectorPaths(feyn.convertDictToVec(startd), feyn.convertDictToVec(endd),
+                                          feyn.inters, 4)
+    assert unpruned == feyn.countPaths(startd, endd, maxorder=4)
+
+    # Weights alone are enough, the effects are worked out from the nodes
+    startvec, endvec = feyn.convertDictToVec(startd), feyn.convertDictToVec(endd)
+    assert Utilities.countVectorPaths(startvec, endvec, feyn.inters, 4, weights=feyn.charges) == unpruned
+    assert len(list(Utilities.genVectorPaths(startvec, endvec, feyn.inters, 3, weights=feyn.charges))) \
+        == len(list(feyn.listPaths(startd, endd, maxorder=3)))
+
+    # Charges of U1Product reach the bound too
+    product = U1Product(2)
+    t = Theory(product, trunc=3)
+    t.addField(Field("a", product((1, 1))))
+    t.addField(Field("b", product((-2, -2))))
+    feyn = Feynman(t)
+    names = feyn.chargenames
+    assert "Q_0(U(1)^2)" in names and "Q_1(U(1)^2)" in names
+    assert list(feyn.charges[names.index("Q_1(U(1)^2)")]) == [1, -2, -1, 2]
+    assert feyn.lowerBound({("a", False): 1}, {("b", False): 1}) == float('inf')
+
+
+def DiagramsAreDistinct():
+    feyn = Feynman(makeTheory())
+    startd = {("\psi", False): 1}
+    endd = {("\phi", False): 2}
+
+    diagrams = feyn.listDiagrams(startd, endd, maxorder=1)
+    assert len(diagrams) == 1
+    assert len(diagrams[0].vertices) == 1
+
+    diagrams = feyn.listDiagrams(startd, endd, maxorder=3)
+    assert len(set(diagrams)) == len(diagrams)
+    assert all(d.isConnected() for d in diagrams)
+    assert len(diagrams) >= len(feyn.listDiagrams(startd, endd, maxorder=2))
+
+
+def DiagramIsomorphism():
+    t = makeTheory()
+    feyn = Feynman(t)
+    phi, psi, zeta = feyn.convertDictToFields({("\phi", False): 1, ("\psi", False): 1, ("\zeta", False): 1})
+    decay = [i for i in t.getInt() if repr(i) == "g_{2}\\phi\\phi\\bar{\\psi}"][0]
+    emission = [i for i in t.getInt() if repr(i) == "g_{3}\\phi\\zeta\\bar{\\phi}"][0]
+
+    # Emit a zeta from either of the two phi lines, then order the outgoing particles both ways
+    start = list(Diagram(psi).applyInteraction(decay, {psi: 1}, {phi: 2}))
+    assert len(start) == 1
+    emitted = list(start[0].applyInteraction(emission, {phi: 1}, {phi: 1, zeta: 1}))
+    assert len(emitted) == 1
+    closed = list(emitted[0].close(phi, phi, zeta)) + list(emitted[0].close(phi, zeta, phi))
+    assert len(closed) == 4
+    assert len(set(closed)) == 4
+    assert list(emitted[0].close(phi, phi, zeta))[0] != list(emitted[0].close(phi, zeta, phi))[0]
+
+
+def SymmetryFactors():
+    feyn = Feynman(makeTheory())
+    diagrams = feyn.listDiagrams({("\psi", False): 1}, {("\phi", False): 2}, maxorder=2)
+
+    # psi -> phi phi at a single g_{2} vertex: two ways to attach the identical phi legs
+    tree = diagrams[0]
+    assert len(tree.vertices) == 1
+    assert tree.weight() == 2
+    assert tree.symmetryFactor() == 1
+
+    # The bubble where both phi rescatter through g_{8} has its two internal lines exchanged
+    bubble = [d for d in diagrams if len(d.vertices) == 2 and
+              sorted(v.label for v in d.vertices) == ["g_{2}\\phi\\phi\\bar{\\psi}",
+                                                      "g_{8}\\phi\\phi\\bar{\\phi}\\bar{\\phi}"]]
+    assert len(bubble) == 1
+    assert bubble[0].symmetryFactor() == 2
+    assert bubble[0].weight() == 4
+
+
+def StatsCounters():
+    startd = {("\psi", False): 1}
+    endd = {("\phi", False): 2}
+
+    # Disabled stats record nothing
+    t = makeTheory()
+    Feynman(t).listDiagrams(startd, endd, maxorder=3)
+    assert t.stats.counters == {} and t.stats.times == {}
+
+    t = makeTheory()
+    t.stats.enable()
+    feyn = Feynman(t)
+    diagrams = feyn.listDiagrams(startd, endd, maxorder=3)
+    counters = t.stats.counters
+    assert feyn.stats is t.stats
+    # Only one of each conjugate pair is generated and every one is checked
+    assert counters["singlet checks"] + counters["candidates rejected by charges"] == counters["candidates generated"]
+    assert counters["interactions constructed"] == len(t.getK()) + len(t.getInt())
+    # Products seen by earlier theories in this process come from the memo on the interned symmetries
+    assert counters.get("Symmetry.combine", 0) + counters.get("combine memo hits", 0) > 0
+    assert counters["closed diagrams"] >= len(diagrams)
+    assert counters["paths"] == sum(feyn.countPaths(startd, endd, maxorder=3))
+    assert "calculateL" in t.stats.times and "listDiagrams" in t.stats.times
+    assert all(name in str(t.stats) for name in counters)
+
+
+def IncrementalSearch():
+    startd = {("\psi", False): 1}
+    ends = [{("\phi", False): 2}, {("\phi", False): 2, ("\zeta", False): 1}]
+    feyn = Feynman(makeTheory())
+
+    def keys(paths):
+        return [[(repr(inter), tuple(taken), tuple(given)) for inter, taken, given in path] for path in paths]
+
+    # Raising the order extends the one search kept for the start state, for every end state
+    for maxorder in range(1, 4):
+        for endd in ends:
+            assert keys(feyn.listPaths(startd, endd, maxorder, incremental=True)) \
+                == keys(feyn.listPaths(startd, endd, maxorder))
+            assert feyn.countPaths(startd, endd, maxorder, incremental=True) == feyn.countPaths(startd, endd, maxorder)
+        assert list(feyn.searches.values())[0].depth == maxorder
+    assert len(feyn.searches) == 1
+
+    assert len(feyn.listDiagrams(startd, ends[0], maxorder=3, incremental=True)) \
+        == len(feyn.listDiagrams(startd, ends[0], maxorder=3))
+
+
+def VertexTable():
     startd = {("\psi", False): 1}
     endd = {("\phi", False): 2}
+    feyn = Feynman(makeTheory())
+    table = feyn.vertexTable
+    assert len(table) == len(feyn.inters)
+    for rule, (inter, taken, given) in zip(table, feyn.inters):
+        assert rule.inter is inter and rule.coupling == inter.coupling
+        assert rule.taken == tuple(taken) and rule.given == tuple(given)
+        legs = 1
+        for field in set(inter.fields):
+            legs *= [1, 1, 2, 6, 24][inter.fields.count(field)]
+        assert rule.factor == legs
+
+    # Compatible rules are exactly those taking only particle types present
+    state = tuple(int(x) for x in feyn.convertDictToVec(startd))
+    compatible = table.compatible(state)
+    assert compatible == [r for r in table if all(s > 0 for s, t in zip(state, r.taken) if t < 0)]
+    assert len(compatible) < len(table)
+
+    # Paths found through the index are those of trying every interaction at every step
+    def scan(state, remaining):
+        if tuple(state) == tuple(feyn.convertDictToVec(endd)):
+            yield []
+        if remaining == 0:
+            return
+        for inter, taken, given in feyn.inters:
+            after = numpy.array(state) + taken
+            if numpy.all(after >= 0):
+                for rest in scan(after + given, remaining - 1):
+                    yield [(repr(inter), tuple(taken), tuple(given))] + rest
+    expected = list(scan(feyn.convertDictToVec(startd), 3))
+    found = [[(repr(inter), tuple(taken), tuple(given)) for inter, taken, given in path]
+             for path in feyn.listPaths(startd, endd, maxorder=3)]
+    assert found == expected
+
+
+def CheckpointedPaths():
+    startd = {("\\psi", False): 1}
+    endd = {("\\phi", False): 2}
+    feyn = Feynman(makeTheory())
+
+    def keys(paths):
+        return [[(repr(inter), tuple(taken), tuple(given)) for inter, taken, given in path] for path in paths]
+
+    expected = keys(feyn.listPaths(startd, endd, maxorder=3))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "paths.log")
+        # Runs stopped after a few paths each, the last leaving half a record behind
+        for stop in [1, 7, 60]:
+            paths = feyn.listPaths(startd, endd, maxorder=3, checkpoint=path, interval=0)
+            assert keys(next(paths) for _ in range(stop)) == expected[:stop]
+            paths.close()
+        with open(path, "ab") as f:
+            f.write(b"\x80\x04")
+
+        assert keys(Feynman(makeTheory()).listPaths(startd, endd, maxorder=3, checkpoint=path)) == expected
+        # A finished checkpoint is replayed as is
+        assert keys(feyn.listPaths(startd, endd, maxorder=3, checkpoint=path)) == expected
+
+        try:
+            list(feyn.listPaths(startd, endd, maxorder=2, checkpoint=path))
+            assert False
+        except ValueError:
+            pass
+
+
+if __name__ == "__main__":
+    t = makeTheory()
+    print(t.getInt())
 
     feyn = Feynman(t)
-    print(feyn)
-    # paths = feyn.listPaths(startd, endd, maxorder=4)
-    #
-    # endvec = feyn.convertDictToVec(endd)
-    #
-    # for path in paths:
-    #     start = feyn.convertDictToVec(startd)
-    #     print(path)
-    #     for inter in path:
-    #         start += inter[1] + inter[2]
-    #         print(inter[1], inter[2], start)
-    #     assert(numpy.array_equal(start, endvec))
+    print(feyn.countPaths({("\psi", False): 1}, {("\phi", False): 2}, maxorder=4))
+    PathsReachEnd()
+    ChargeBoundsPrune()
+    DiagramsAreDistinct()
+    DiagramIsomorphism()
+    SymmetryFactors()
+    StatsCounters()
+    IncrementalSearch()
+    VertexTable()
+    CheckpointedPaths()
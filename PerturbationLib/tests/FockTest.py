@@ -0,0 +1,45 @@
+import itertools
+import numpy
+
+from PerturbationLib.Fock import FockBasis
+
+
+def RankRoundTrip():
+    for nmodes, cutoff in [(1, 5), (2, 4), (3, 4), (5, 3)]:
+        for total in [True, False]:
+            basis = FockBasis(nmodes, cutoff, total=total)
+            states = basis.states()
+            assert len(states) == len(basis)
+            assert numpy.array_equal(basis.rank(states), numpy.arange(len(basis)))
+
+            # Every state is numbered once, and states outside the basis get -1
+            candidates = numpy.array(list(itertools.product(range(cutoff + 2), repeat=nmodes)))
+            ranks = basis.rank(candidates)
+            inside = candidates.sum(axis=1) <= cutoff if total else numpy.all(candidates <= cutoff, axis=1)
+            assert numpy.array_equal(ranks >= 0, inside)
+            assert len(set(ranks[inside].tolist())) == inside.sum()
+
+
+def Sectors():
+    basis = FockBasis(4, 6)
+    states = basis.states()
+    assert numpy.all(numpy.diff(states.sum(axis=1)) >= 0)
+    for n in range(7):
+        start, stop = basis.sectorRange(n)
+        assert numpy.all(states[start:stop].sum(axis=1) == n)
+
+
+def LargeBasis():
+    # 30 modes with up to 12 excitations, far too many states to list
+    basis = FockBasis(30, 12)
+    rng = numpy.random.default_rng(1)
+    ranks = rng.integers(0, len(basis), size=10000)
+    states = basis.unrank(ranks)
+    assert numpy.all(states.sum(axis=1) <= 12)
+    assert numpy.array_equal(basis.rank(states), ranks)
+
+
+if __name__ == "__main__":
+    RankRoundTrip()
+    Sectors()
+    LargeBasis()
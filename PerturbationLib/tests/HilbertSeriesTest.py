@@ -0,0 +1,58 @@
+import collections
+
+from PerturbationLib.Theory import Theory, Field
+from PerturbationLib.Symmetries import U, U1Product
+from PerturbationLib.SUSymmetry import SU, irrepWeights
+
+
+def countByOrder(theory: Theory):
+    theory.calculateL(filter_anti_dups=False)
+    counts = collections.Counter(len(term.fields) for term in theory.Lk + theory.Lint)
+    return [1] + [counts.get(n, 0) for n in range(1, theory.trunc + 1)]
+
+
+def MatchesCalculateL():
+    # Every multiset with zero charge is exactly one invariant
+    u = U(1)
+    theory = Theory(u, fields=[Field('a', u((1,))), Field('b', u((-2,))), Field('c', u((0,)))], trunc=5)
+    assert theory.countOperators() == countByOrder(theory)
+
+    p = U1Product(2)
+    theory = Theory(p, fields=[Field('a', p((1, 0))), Field('b', p((1, -1))), Field('c', p((-2, 1)))], trunc=5)
+    assert theory.countOperators() == countByOrder(theory)
+
+    # Only (H^dag H)^n survives the U(1), and Sym^n(N) x Sym^n(N bar) holds one singlet
+    for N in [2, 3]:
+        su = SU(N)
+        fundamental = tuple([1] + [0] * (N - 2))
+        theory = Theory(su, u, fields=[Field('H', su(fundamental), u((1,)))], trunc=6)
+        assert theory.countOperators() == countByOrder(theory)
+
+
+def FractionalCharges():
+    # Hypercharge-like charges count as their integer multiples do
+    u = U(1)
+    fractional = Theory(u, fields=[Field('a', u((1 / 6,))), Field('b', u((-1 / 3,))), Field('c', u((0.5,)))], trunc=5)
+    integral = Theory(u, fields=[Field('a', u((1,))), Field('b', u((-2,))), Field('c', u((3,)))], trunc=5)
+    assert fractional.countOperators() == integral.countOperators() == countByOrder(fractional)
+
+    su = SU(2)
+    theory = Theory(su, u, fields=[Field('H', su((1,)), u((0.5,)))], trunc=4)
+    assert theory.countOperators() == countByOrder(theory)
+
+
+def KnownSeries():
+    # A triplet of SU(2) and its conjugate are two vectors of SO(3), whose invariants are
+    # polynomials in their three dot products
+    su2 = SU(2)
+    theory = Theory(su2, fields=[Field('p', su2((2,)))], trunc=10)
+    assert theory.countOperators() == [1, 0, 3, 0, 6, 0, 10, 0, 15, 0, 21]
+
+    # Irrep dimensions
+    assert [len(irrepWeights(3, m)) for m in [(0, 0), (1, 0), (1, 1), (2, 0), (3, 0), (2, 1)]] == [1, 3, 8, 6, 10, 15]
+
+
+if __name__ == "__main__":
+    MatchesCalculateL()
+    FractionalCharges()
+    KnownSeries()
@@ -0,0 +1,64 @@
+import math
+import numpy
+
+from PerturbationLib.PhaseSpace import rambo, integrate, decayWidth, RunningMean
+from PerturbationLib.Amplitude import TreeAmplitude
+from PerturbationLib.tests.FeynmanTest import makeTheory
+
+
+def ones(momenta):
+    return numpy.ones(len(momenta))
+
+
+def MomentaOnShell():
+    masses = [0.0, 1.0, 2.5]
+    p, w = rambo(10.0, masses, 1000, numpy.random.default_rng(0))
+    assert numpy.allclose(p.sum(axis=1), [10.0, 0.0, 0.0, 0.0])
+    m2 = p[..., 0] ** 2 - numpy.sum(p[..., 1:] ** 2, axis=-1)
+    assert numpy.allclose(m2, numpy.array(masses) ** 2)
+    assert numpy.all(w > 0)
+
+
+def PhaseSpaceVolumes():
+    # Two body: sqrt(lambda(s, m1^2, m2^2)) / (8 pi s)
+    s, m1, m2 = 100.0, 1.0, 3.0
+    lam = (s - (m1 + m2) ** 2) * (s - (m1 - m2) ** 2)
+    result = integrate(ones, math.sqrt(s), [m1, m2], 10000, chunksize=1000, seed=1)
+    assert abs(result.mean - math.sqrt(lam) / (8 * math.pi * s)) < 1e-10
+
+    # Three massless bodies: s / (256 pi^3)
+    result = integrate(ones, 10.0, [0.0, 0.0, 0.0], 10000, chunksize=1000, seed=1)
+    assert abs(result.mean - 100.0 / (256 * math.pi ** 3)) < 1e-10
+
+
+def ChunkingIsDeterministic():
+    serial = integrate(ones, 10.0, [0.5, 0.5, 0.5], 20000, chunksize=3000, seed=7)
+    parallel = integrate(ones, 10.0, [0.5, 0.5, 0.5], 20000, chunksize=3000, seed=7, workers=2)
+    assert serial.n == parallel.n == 20000
+    assert serial.mean == parallel.mean
+    assert serial.m2 == parallel.m2
+
+    values = numpy.random.default_rng(3).normal(size=1001)
+    acc = RunningMean()
+    for chunk in numpy.array_split(values, 7):
+        acc.update(chunk)
+    assert abs(acc.mean - values.mean()) < 1e-12
+    assert abs(acc.variance() - values.var(ddof=1)) < 1e-12
+
+
+def DecayWidth():
+    g = 0.3
+    amp = TreeAmplitude.fromProcess(makeTheory(), {("\\psi", False): 1}, {("\\phi", False): 2},
+                                    {"g_{2}": g})
+    mass, m = 10.0, 1.0
+    width, error = decayWidth(amp, mass, [m, m], 1000, symmetry=2)
+    pstar = math.sqrt(mass ** 2 / 4 - m ** 2)
+    expected = (2 * g) ** 2 * pstar / (8 * math.pi * mass ** 2) / 2
+    assert abs(width - expected) < 1e-12
+
+
+if __name__ == "__main__":
+    MomentaOnShell()
+    PhaseSpaceVolumes()
+    ChunkingIsDeterministic()
+    DecayWidth()
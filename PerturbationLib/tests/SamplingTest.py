@@ -0,0 +1,69 @@
+import collections
+
+from PerturbationLib.Feynman import Feynman
+from PerturbationLib.Sampling import estimateTerms, estimatePaths, wilsonInterval
+from PerturbationLib.tests.FeynmanTest import makeTheory
+
+
+def countByOrder(theory, predicate=None):
+    theory.calculateL(filter_anti_dups=False)
+    counts = collections.Counter(len(term.fields) for term in theory.Lk + theory.Lint
+                                 if predicate is None or predicate(term.fields))
+    return [counts.get(n, 0) for n in range(theory.trunc + 1)]
+
+
+def ExhaustiveOrdersAreExact():
+    # Enough samples to check every multiset gives the exact counts
+    theory = makeTheory()
+    total, perorder = estimateTerms(theory, 10000, seed=0)
+    assert total.exact and [e.value for e in perorder] == countByOrder(theory)
+
+    def hasZeta(fields):
+        return any(f.name == "\\zeta" for f in fields)
+    total, perorder = estimateTerms(theory, 10000, predicate=hasZeta, seed=0)
+    assert [e.value for e in perorder] == countByOrder(theory, hasZeta)
+
+
+def TermIntervalsCover():
+    theory = makeTheory()
+    expected = countByOrder(theory)
+    for seed in range(5):
+        total, perorder = estimateTerms(theory, 40, seed=seed)
+        assert not total.exact and total.samples >= 40
+        assert total.low <= sum(expected) <= total.high
+        for e, count in zip(perorder, expected):
+            assert e.low <= count <= e.high
+
+    # Weighting the short orders checks them exhaustively and samples the rest
+    total, perorder = estimateTerms(theory, 60, orderweights=[10, 10, 1, 1], seed=0)
+    assert perorder[1].exact and perorder[2].exact and not perorder[4].exact
+
+    low, high = wilsonInterval(0, 100)
+    assert low == 0 and 0 < high < 0.05
+
+
+def PathIntervalsCover():
+    feyn = Feynman(makeTheory())
+    startd = {("\\psi", False): 1}
+    endd = {("\\phi", False): 2}
+    counts = feyn.countPaths(startd, endd, maxorder=3)
+    total, perorder = estimatePaths(feyn, startd, endd, 3, 4000, seed=1)
+    assert total.low <= sum(counts) <= total.high
+    for e, count in zip(perorder, counts):
+        assert e.low <= count <= e.high
+
+    # As with listPaths, a path back to the start state has at least one vertex
+    total, perorder = estimatePaths(feyn, startd, startd, 3, 2000, seed=1)
+    assert perorder[0].exact and perorder[0].value == 0
+    counts = feyn.countPaths(startd, startd, maxorder=3)
+    assert total.low <= sum(counts) <= total.high
+
+    # Charge mismatch is known to allow no paths without sampling
+    total, _ = estimatePaths(feyn, startd, {("\\phi", False): 1}, 3, 100)
+    assert total.exact and total.value == 0
+
+
+if __name__ == "__main__":
+    ExhaustiveOrdersAreExact()
+    TermIntervalsCover()
+    PathIntervalsCover()
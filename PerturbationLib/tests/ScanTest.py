@@ -0,0 +1,71 @@
+import os
+import tempfile
+
+from PerturbationLib.Scan import scan, parameterPoints, readCheckpoint
+from PerturbationLib.Theory import Theory, Field
+from PerturbationLib.Symmetries import U
+from PerturbationLib.SUSymmetry import SU
+
+
+def makeTheory(q1, q2, doublet, trunc=3):
+    usym = U(1)
+    susym = SU(2)
+    t = Theory(usym, susym, trunc=trunc)
+    t.addField(Field("\\phi", usym((q1,)), susym((1 if doublet else 0,))))
+    t.addField(Field("\\psi", usym((q2,)), susym((0,))))
+    return t
+
+
+def makeOtherTheory(q1, q2, doublet):
+    return makeTheory(q1, q2, doublet, trunc=4)
+
+
+GRID = {"q1": [0, 1, 2], "q2": [-2, -1, 1], "doublet": [False, True]}
+
+
+def summary(results):
+    return sorted((tuple(sorted(p.items())), repr(lk), repr(lint)) for p, lk, lint in results)
+
+
+def MatchesSerial():
+    expected = []
+    for params in parameterPoints(GRID):
+        t = makeTheory(**params)
+        expected.append((params, t.getK(), t.getInt()))
+    assert len(expected) == 18
+    assert summary(scan(makeTheory, GRID)) == summary(expected)
+    assert summary(scan(makeTheory, GRID, workers=3)) == summary(expected)
+
+
+def Resume():
+    with tempfile.TemporaryDirectory() as directory:
+        checkpoint = os.path.join(directory, "scan.ckpt")
+        full = summary(scan(makeTheory, GRID))
+
+        # Stop part way, then resume
+        partial = scan(makeTheory, GRID, checkpoint=checkpoint)
+        for _ in range(5):
+            next(partial)
+        partial.close()
+        assert len(list(readCheckpoint(checkpoint))) == 5
+
+        # A cut off last record is ignored
+        with open(checkpoint, "ab") as f:
+            f.write(b"\x80\x04\x95")
+        assert summary(scan(makeTheory, GRID, workers=2, checkpoint=checkpoint)) == full
+        assert len(readCheckpoint(checkpoint)) == 18
+        assert summary(scan(makeTheory, GRID, checkpoint=checkpoint)) == full
+
+        # A checkpoint of a different scan is refused
+        for factory, filter_anti_dups in [(makeTheory, False), (makeOtherTheory, True)]:
+            try:
+                list(scan(factory, GRID, checkpoint=checkpoint, filter_anti_dups=filter_anti_dups))
+                assert False, "mismatched checkpoint accepted"
+            except ValueError:
+                pass
+        assert len(readCheckpoint(checkpoint)) == 18
+
+
+if __name__ == "__main__":
+    MatchesSerial()
+    Resume()
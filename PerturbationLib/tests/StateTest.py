@@ -1,3 +1,6 @@
+import numpy
+import os
+import tempfile
 from PerturbationLib.ParticleState import *
 
 
@@ -22,3 +25,101 @@ def C():
     a_, a = COp(0), AOp(0)
     b = SingleState([0, 0])
     assert 2 == (a_ * a_ * b).transpose() * (a_ * (a_ + a) * b)
+
+
+def ExpectationValues():
+    a_, a = COp(0), AOp(0)
+    b_, b = COp(1), AOp(1)
+    psi = SingleState([1, 0]) + SingleState([0, 2]) + SingleState([2, 1])
+    operators = [a_ * a, b_ * b, a_ * b + b_ * a, XOp(0) * XOp(1), a_ * a * b_ * b]
+
+    values, covariance = expectationValues(psi, operators, covariance=True)
+    norm = psi.transpose() * psi
+    for op, value in zip(operators, values):
+        assert sympy.simplify(value - (psi.transpose() * (op * psi)) / norm) == 0
+
+    # Number operators commute with each other, covariance is <AB> - <A><B>
+    n0, n1 = a_ * a, b_ * b
+    assert sympy.simplify(covariance[0][1] - (values[4] - values[0] * values[1])) == 0
+    assert sympy.simplify(covariance[0][0] - (expectationValues(psi, [n0 * n0])[0] - values[0] ** 2)) == 0
+
+
+def FermionAnticommutation():
+    # {c_i, c'_j} = delta_ij and {c'_i, c'_j} = 0 on a superposition spanning two words
+    rng = numpy.random.default_rng(0)
+    nmodes = 70
+    psi = FermionState(rng.integers(0, 2, size=(50, nmodes)), rng.normal(size=50))
+    for i, j in [(0, 0), (3, 5), (63, 64), (69, 2), (64, 64)]:
+        anti = (FAOp(i) * FCOp(j) + FCOp(j) * FAOp(i)) * psi
+        if i == j:
+            assert numpy.allclose(anti.innerProduct(psi), psi.innerProduct(psi))
+            assert numpy.allclose((anti + -psi).coefficients, 0)
+        else:
+            assert len(anti) == 0
+        assert len((FCOp(i) * FCOp(j) + FCOp(j) * FCOp(i)) * psi) == 0
+
+
+def FermionSigns():
+    occupation = [1, 0, 1, 1, 0]
+    psi = FermionState([occupation])
+    for mode in range(5):
+        sign = (-1) ** sum(occupation[:mode])
+        if occupation[mode]:
+            result = FAOp(mode) * psi
+            expected = list(occupation)
+            expected[mode] = 0
+        else:
+            result = FCOp(mode) * psi
+            expected = list(occupation)
+            expected[mode] = 1
+        assert result.occupations().tolist() == [expected]
+        assert result.coefficients.tolist() == [sign]
+    # Number operators count occupied modes
+    number = FCOp(0) * FAOp(0) + FCOp(2) * FAOp(2) + FCOp(3) * FAOp(3) + FCOp(4) * FAOp(4)
+    assert (number * psi).coefficients.tolist() == [3]
+
+
+def MappedStateMatchesState():
+    rng = numpy.random.default_rng(2)
+    occupations = rng.integers(0, 4, size=(300, 3))
+    coefficients = rng.normal(size=300)
+    a_, a = COp(0), AOp(0)
+    b_, b = COp(1), AOp(1)
+    op = XOp(2) * (a_ * b + b_ * a) * (a_ + a) * XOp(2)
+
+    # Reference: apply the expanded ladders to a dict of occupations
+    expected = {}
+    for occupation, c in zip(occupations.tolist(), coefficients):
+        for coefficient, ladder in ladderTerms(op):
+            n = list(occupation)
+            amplitude = c * float(coefficient)
+            for mode, creation in reversed(ladder):
+                if not creation and n[mode] == 0:
+                    amplitude = 0
+                    break
+                amplitude *= numpy.sqrt(n[mode] + 1 if creation else n[mode])
+                n[mode] += 1 if creation else -1
+            if amplitude != 0:
+                expected[tuple(n)] = expected.get(tuple(n), 0) + amplitude
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Tiny chunks force many runs and merges
+        psi = MappedState.fromArrays(occupations, coefficients, os.path.join(directory, "psi"), chunksize=16)
+        result = psi.apply(op, os.path.join(directory, "result"), chunksize=16)
+        assert sorted(os.listdir(directory)) == ["psi", "result"]
+        keys = result.keys()
+        assert numpy.all(keys[1:] > keys[:-1])
+        found = dict(zip(map(tuple, result.occupations.tolist()), result.coefficients.real.tolist()))
+        assert found.keys() == {k for k, v in expected.items() if abs(v) > 1e-9}
+        assert all(numpy.isclose(found[k], expected[k]) for k in found)
+        norm = sum(v ** 2 for v in expected.values())
+        assert numpy.isclose(result.innerProduct(result, chunksize=16), norm)
+        assert numpy.isclose(MappedState(result.directory).innerProduct(result), norm)
+
+
+if __name__ == "__main__":
+    B()
+    ExpectationValues()
+    FermionAnticommutation()
+    FermionSigns()
+    MappedStateMatchesState()
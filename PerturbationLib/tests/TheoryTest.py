@@ -1,13 +1,228 @@
-from PerturbationLib.Symmetries import U
+import os
+import tempfile
+
+import PerturbationLib.Theory as TheoryModule
+from PerturbationLib.Cache import encode
+from PerturbationLib.Symmetries import U, U1Product, MEMO_SIZE, clearMemos
+from PerturbationLib.SUSymmetry import SU
 from PerturbationLib.Theory import Theory, Field
 from PerturbationLib.Utilities import *
 
 
+def ShardedMatchesSerial():
+    usym = U(1)
+    susym = SU(2)
+
+    def makeTheory():
+        t = Theory(usym, susym, trunc=4)
+        t.addField(Field("\\phi", usym((1,)), susym((1,))))
+        t.addField(Field("\\psi", usym((-2,)), susym((0,))))
+        t.addField(Field("\\zeta", usym((0,)), susym((1,))))
+        return t
+
+    for filter_anti_dups in [True, False]:
+        serial = makeTheory()
+        serial.calculateL(filter_anti_dups=filter_anti_dups)
+        sharded = makeTheory()
+        sharded.calculateL(filter_anti_dups=filter_anti_dups, workers=3)
+        assert repr(serial) == repr(sharded)
+
+
+def ProductMatchesSeparateU1():
+    ua, ub, susym = U(1, 'a'), U(1, 'b'), SU(2)
+    product = U1Product(2)
+    separate = Theory(ua, ub, susym, trunc=4)
+    combined = Theory(product, susym, trunc=4)
+    for i, (qa, qb, d) in enumerate([(1, 0, 1), (-1, 2, 0), (0, -1, 1), (2, 1, 0)]):
+        separate.addField(Field("f_{}".format(i), ua((qa,)), ub((qb,)), susym((d,))))
+        combined.addField(Field("f_{}".format(i), product((qa, qb)), susym((d,))))
+    assert repr(separate) == repr(combined)
+    assert product((1, -2)).combine(product((-1, 2))).containsSinglet()
+    assert not product((1, -2)).combine(product((1, 2))).containsSinglet()
+
+
+def FractionalCharges():
+    # Hypercharge-like charges must not be truncated by the vectorized charge check
+    usym = U(1)
+    t = Theory(usym, trunc=3)
+    t.addField(Field("a", usym((1 / 6,))))
+    t.addField(Field("b", usym((-1 / 3,))))
+    t.calculateL(filter_anti_dups=False)
+    assert sorted(repr(term) for term in t.Lint) == ["g_{0}aab", "g_{1}\\bar{a}\\bar{a}\\bar{b}"]
+    assert t.abelianChargeMatrix(t.fields)[1].tolist() == [[1], [-2]]
+
+
+def FractionalProductCharges():
+    # U1Product must keep fractional charges exactly, as separate U(1) factors do
+    ua, ub, susym = U(1, 'a'), U(1, 'b'), SU(2)
+    product = U1Product(2)
+    separate = Theory(ua, ub, susym, trunc=4)
+    combined = Theory(product, susym, trunc=4)
+    for i, (qa, qb, d) in enumerate([(1 / 6, 0, 1), (-1 / 3, 1 / 2, 0), (0, -1 / 2, 1), (1 / 2, 1, 0)]):
+        separate.addField(Field("f_{}".format(i), ua((qa,)), ub((qb,)), susym((d,))))
+        combined.addField(Field("f_{}".format(i), product((qa, qb)), susym((d,))))
+    assert repr(separate) == repr(combined)
+    assert not product((1 / 6, 0)).combine(product((1 / 6, 0))).containsSinglet()
+    assert product((1 / 6, 1 / 2)).combine(product((-1 / 6, -1 / 2))).containsSinglet()
+
+
+def KineticTermsAreUnique():
+    # A neutral field's zeta zeta is a coupling, only zeta zetabar is its kinetic term
+    usym = U(1)
+    t = Theory(usym, trunc=3)
+    t.addField(Field("\\phi", usym((1,))))
+    t.addField(Field("\\zeta", usym((0,))))
+    for filter_anti_dups in [True, False]:
+        t.calculateL(filter_anti_dups=filter_anti_dups)
+        labels = [k.coupling for k in t.getK()]
+        assert len(labels) == len(set(labels)) == 2
+        assert all(k.fields[0].anti != k.fields[1].anti for k in t.getK())
+        assert any(repr(term).endswith("\\zeta\\zeta") and term.coupling.startswith("g_")
+                   for term in t.getInt())
+
+
+def SymmetriesAreInterned():
+    import pickle
+    susym = SU(3)
+    a = susym((1, 0))
+    assert a is SU(3, multiplets=[(1, 0)]) and a is SU(3, 'SU(3)', [[1, 0]])
+    assert a.inverse() is susym((0, 1)) and a.inverse().inverse() is a
+    assert a.combine(a.inverse()) is a.combine(a.inverse())
+    assert a.combine(a.inverse()).containsSinglet()
+    assert pickle.loads(pickle.dumps(a)) is a
+    try:
+        a.multiplets = ((0, 0),)
+        assert False, "symmetries should be immutable"
+    except AttributeError:
+        pass
+
+
+def MemoIsBounded():
+    u1 = U(1)
+    a = u1((1,))
+    for q in range(MEMO_SIZE + 10):
+        a.combine(u1((q,)))
+    assert len(a._memo) <= MEMO_SIZE
+    assert a.combine(u1((2,))) is u1((3,))
+    clearMemos()
+    assert len(a._memo) == 0
+    assert a.combine(u1((2,))) is u1((3,))
+
+
+def ConjugatePairs():
+    susym = SU(3)
+    usym = U(1)
+
+    def makeTheory():
+        t = Theory(susym, usym, trunc=4)
+        t.addField(Field("q", susym((1, 0)), usym((1,))))
+        t.addField(Field("g", susym((1, 1)), usym((0,))))
+        t.addField(Field("s", susym((0, 0)), usym((0,))))
+        return t
+
+    # Filtering keeps exactly one term of each conjugate pair
+    filtered, full = makeTheory(), makeTheory()
+    filtered.calculateL(filter_anti_dups=True)
+    full.calculateL(filter_anti_dups=False)
+
+    def key(inter):
+        return tuple(sorted((f.name, f.anti) for f in inter.fields))
+
+    def conjugate(k):
+        return tuple(sorted((name, not anti) for name, anti in k))
+
+    kept = set(key(i) for i in filtered.Lk + filtered.Lint)
+    every = set(key(i) for i in full.Lk + full.Lint)
+    assert len(kept) == len(filtered.Lk + filtered.Lint)
+    assert kept | set(conjugate(k) for k in kept) == every
+    assert all(conjugate(k) not in kept or conjugate(k) == k for k in kept)
+
+    # Only one of each pair of candidates is enumerated
+    pairs = conjugateCanonicalCounts(3, 4)
+    selfconjugate = sum(1 for m, a in pairs if m == a)
+    assert 2 * len(pairs) - selfconjugate == len(truncCombinations([(i, 4) for i in range(6)], 4))
+    assert len(set(pairs)) == len(pairs)
+    assert all(m >= a for m, a in pairs)
+
+
+def CheckpointResume():
+    usym = U(1)
+    susym = SU(2)
+
+    def makeTheory(trunc=4):
+        t = Theory(usym, susym, trunc=trunc)
+        t.addField(Field("\\phi", usym((1,)), susym((1,))))
+        t.addField(Field("\\psi", usym((-2,)), susym((0,))))
+        t.addField(Field("\\zeta", usym((0,)), susym((1,))))
+        return t
+
+    class Interrupted(Exception):
+        pass
+
+    def interruptAfter(n):
+        calls = [0]
+
+        def check(syms, encoding):
+            calls[0] += 1
+            if calls[0] > n:
+                raise Interrupted()
+            return hasSinglets(syms, encoding)
+        return check
+
+    hasSinglets = TheoryModule.hasSinglets
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "L.json")
+        for filter_anti_dups in [True, False]:
+            expected = makeTheory()
+            expected.calculateL(filter_anti_dups=filter_anti_dups)
+
+            # Die twice part way through, each run picking up where the last stopped
+            for n in [3, 5]:
+                TheoryModule.hasSinglets = interruptAfter(n)
+                try:
+                    makeTheory().calculateL(filter_anti_dups=filter_anti_dups, checkpoint=path, interval=0)
+                    assert False
+                except Interrupted:
+                    pass
+                finally:
+                    TheoryModule.hasSinglets = hasSinglets
+                assert os.path.exists(path)
+
+            resumed = makeTheory()
+            resumed.calculateL(filter_anti_dups=filter_anti_dups, checkpoint=path, interval=0)
+            assert repr(resumed) == repr(expected)
+            assert encode(resumed, resumed.Lk, resumed.Lint, "0" * 64) == encode(expected, expected.Lk, expected.Lint, "0" * 64)
+            assert not os.path.exists(path)
+
+        # A checkpoint of another theory is refused rather than silently mixed in
+        TheoryModule.hasSinglets = interruptAfter(3)
+        try:
+            makeTheory().calculateL(checkpoint=path, interval=0)
+        except Interrupted:
+            pass
+        finally:
+            TheoryModule.hasSinglets = hasSinglets
+        try:
+            makeTheory(trunc=3).calculateL(checkpoint=path)
+            assert False
+        except ValueError:
+            pass
+
+
 if __name__ == "__main__":
     usym = U(1)
-    t = Theory([usym], trunc=4)
+    t = Theory(usym, trunc=4)
     f = Field("\phi", usym((1,)))
     t.addField(f)
     f = Field("\psi", usym((-3,)))
     t.addField(f)
     print(t)
+    ShardedMatchesSerial()
+    ProductMatchesSeparateU1()
+    FractionalCharges()
+    FractionalProductCharges()
+    KineticTermsAreUnique()
+    SymmetriesAreInterned()
+    MemoIsBounded()
+    ConjugatePairs()
+    CheckpointResume()